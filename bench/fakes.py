@@ -0,0 +1,405 @@
+# File: bench/fakes.py — локальные заглушки внешних сервисов для бенчмарка: TGStat, OpenAI, Telethon, Bot API
+
+from __future__ import annotations
+import asyncio
+import json
+import random
+import time
+import zlib
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+Body = Union[bytes, AsyncIterator[bytes]]
+Response = Tuple[int, Dict[str, str], Body]
+
+_REASONS = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def _seed(name: str) -> int:
+    """Стабильное зерно по имени канала: одинаковые данные от запуска к запуску."""
+    return zlib.crc32(name.lower().lstrip("@").encode("utf-8"))
+
+
+class Latency:
+    """Задержка ответа: среднее + гауссов джиттер, не меньше нуля."""
+
+    def __init__(self, mean: float = 0.0, jitter: float = 0.0):
+        self.mean = mean
+        self.jitter = jitter
+
+    async def sleep(self, rnd: random.Random) -> None:
+        delay = rnd.gauss(self.mean, self.jitter) if self.jitter else self.mean
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class FakeHTTPServer(ABC):
+    """
+    Минимальный HTTP/1.1-сервер на asyncio с keep-alive и chunked-ответами.
+    Подклассы реализуют handle(); задержка и доля ошибок задаются при создании.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500, seed: Optional[int] = None):
+        self.latency = Latency(latency, jitter)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rnd = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: set = set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер (port=0 — свободный порт) и возвращает базовый URL."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Открытые keep-alive соединения закрываем сами, иначе их обработчики отменяются при выходе
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "errors": self.errors}
+
+    def inject_error(self) -> bool:
+        if self.error_rate and self.rnd.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    @abstractmethod
+    async def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Response:
+        """Ответ на запрос: (статус, заголовки, тело — байты или асинхронный поток чанков)."""
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = line.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                url = urlsplit(target)
+                self.requests += 1
+                status, out_headers, payload = await self.handle(method, url.path, dict(parse_qsl(url.query)), body)
+                await self._write(writer, status, out_headers, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Отмена при остановке заглушки — обычное завершение соединения
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _write(writer: asyncio.StreamWriter, status: int, headers: Dict[str, str], payload: Body) -> None:
+        head = f"HTTP/1.1 {status} {_REASONS.get(status, 'Status')}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        if isinstance(payload, bytes):
+            writer.write((head + f"Content-Length: {len(payload)}\r\n\r\n").encode("latin-1") + payload)
+            await writer.drain()
+            return
+        writer.write((head + "Transfer-Encoding: chunked\r\n\r\n").encode("latin-1"))
+        async for chunk in payload:
+            writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def _json(status: int, data: Any, **headers: str) -> Response:
+    return status, {"Content-Type": "application/json", **headers}, json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+class FakeTGStat(FakeHTTPServer):
+    """Эндпоинты TGStat, которые использует collect_tgstat_data: channels/* и posts/stat."""
+
+    def _channel(self, query: Dict[str, str]) -> Tuple[str, random.Random]:
+        channel = query.get("channelId", "")
+        return channel, random.Random(_seed(channel))
+
+    def _payload(self, endpoint: str, query: Dict[str, str]) -> Optional[Any]:
+        channel, rnd = self._channel(query)
+        subs = rnd.randint(2_000, 400_000)
+        reach = int(subs * rnd.uniform(0.05, 0.4))
+        today = datetime.now(timezone.utc).date()
+        days = [(today - timedelta(days=i)).isoformat() for i in range(30, 0, -1)]
+
+        if endpoint == "channels/get":
+            return {"username": channel, "title": f"Канал {channel}", "participants_count": subs, "category": "bench"}
+        if endpoint == "channels/stat":
+            return {"participants_count": subs, "avg_post_reach": reach, "err_percent": round(reach / subs * 100, 2),
+                    "daily_reach": reach * 2, "ci_index": round(rnd.uniform(0, 50), 2), "mentions_count": rnd.randint(0, 300)}
+        if endpoint == "channels/subscribers":
+            return [{"period": d, "participants_count": subs - (30 - i) * rnd.randint(0, 50)} for i, d in enumerate(days)]
+        if endpoint == "channels/views":
+            return [{"period": d, "views_count": int(reach * rnd.uniform(0.7, 1.3))} for d in days]
+        if endpoint == "channels/err":
+            return [{"period": d, "err": round(reach / subs * 100 * rnd.uniform(0.8, 1.2), 2)} for d in days]
+        if endpoint in ("channels/mentions", "channels/forwards", "channels/adposts"):
+            limit = int(query.get("limit", 10))
+            return {"items": [{"id": i, "channel_id": rnd.randint(1, 10**6), "date": days[-1 - i % 30]} for i in range(limit)]}
+        if endpoint == "channels/posts":
+            last_id = 1000 + rnd.randint(0, 5000)
+            return [{"id": last_id - i, "views": int(reach * rnd.uniform(0.5, 1.5))} for i in range(int(query.get("limit", 5)))]
+        if endpoint == "posts/stat":
+            return {"viewsCount": int(reach * rnd.uniform(0.5, 1.5)), "forwardsCount": rnd.randint(0, 200),
+                    "mentionsCount": rnd.randint(0, 20), "reactionsCount": rnd.randint(0, 500)}
+        return None
+
+    async def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Response:
+        await self.latency.sleep(self.rnd)
+        if self.inject_error():
+            return _json(self.error_status, {"status": "error", "ok": False, "error": "injected error"})
+        data = self._payload(path.strip("/"), query)
+        if data is None:
+            return _json(404, {"status": "error", "ok": False, "error": f"unknown method {path}"})
+        # collect_tgstat_data смотрит на ok/result, metrics — на response/result
+        return _json(200, {"status": "ok", "ok": True, "response": data, "result": data})
+
+
+class FakeOpenAI(FakeHTTPServer):
+    """
+    POST /v1/chat/completions: обычный ответ или SSE-стрим.
+    latency — время до первого токена, token_delay — пауза между чанками стрима.
+    Ошибка по умолчанию — 429 с Retry-After, как при исчерпании лимита.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 429, token_delay: float = 0.005, chunk_chars: int = 16,
+                 seed: Optional[int] = None):
+        super().__init__(latency, jitter, error_rate, error_status, seed)
+        self.token_delay = token_delay
+        self.chunk_chars = chunk_chars
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @staticmethod
+    def verdict(prompt: str) -> str:
+        rnd = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        color = rnd.choice(["green", "yellow", "red"])
+        fake = {"green": rnd.randint(3, 15), "yellow": rnd.randint(15, 35), "red": rnd.randint(35, 80)}[color]
+        return json.dumps({
+            "traffic_light": {"color": color, "recommendation": "Стендовый вердикт бенчмарка"},
+            "fakes_estimate": {"fake_probability_percent": fake, "real_users_percent": 100 - fake,
+                               "explanation": "Ответ сгенерирован локальной заглушкой OpenAI."},
+            "short_recommendations": ["ERR в норме", "Рост подписчиков равномерный", "Охват стабилен"],
+        }, ensure_ascii=False)
+
+    async def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Response:
+        if not path.endswith("/chat/completions"):
+            return _json(404, {"error": {"message": f"unknown path {path}", "type": "invalid_request_error"}})
+        await self.latency.sleep(self.rnd)
+        if self.inject_error():
+            return _json(self.error_status, {"error": {"message": "injected error", "type": "rate_limit_error"}},
+                         **({"retry-after": "0"} if self.error_status == 429 else {}))
+
+        request = json.loads(body or b"{}")
+        prompt = "".join(str(m.get("content", "")) for m in request.get("messages", []))
+        text = self.verdict(prompt)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.completion_tokens += usage["completion_tokens"]
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request.get("model", "bench")}
+
+        if not request.get("stream"):
+            return _json(200, {**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]})
+
+        async def events() -> AsyncIterator[bytes]:
+            def event(data: Dict[str, Any]) -> bytes:
+                return f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', **data}, ensure_ascii=False)}\n\n".encode("utf-8")
+
+            yield event({"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+            for i in range(0, len(text), self.chunk_chars):
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+                yield event({"choices": [{"index": 0, "delta": {"content": text[i:i + self.chunk_chars]}, "finish_reason": None}]})
+            yield event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            yield event({"choices": [], "usage": usage})
+            yield b"data: [DONE]\n\n"
+
+        return 200, {"Content-Type": "text/event-stream"}, events()
+
+    def stats(self) -> Dict[str, int]:
+        return {**super().stats(), "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens}
+
+
+class FakeBotAPI(FakeHTTPServer):
+    """
+    Bot API для python-telegram-bot: POST /bot<token>/<method>.
+    Запоминает отправленные и отредактированные сообщения по чатам, чтобы проверить,
+    что и в каком порядке увидел каждый пользователь.
+    """
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        super().__init__(latency, jitter, error_rate, error_status=500, seed=seed)
+        # chat_id -> [(метод, текст)]
+        self.messages: Dict[int, List[Tuple[str, str]]] = {}
+        self.calls: Dict[str, int] = {}
+        self._ids = 0
+
+    def _message(self, chat_id: int, text: str) -> Dict[str, Any]:
+        self._ids += 1
+        return {"message_id": self._ids, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"}}
+
+    async def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Response:
+        await self.latency.sleep(self.rnd)
+        if self.inject_error():
+            return _json(500, {"ok": False, "error_code": 500, "description": "injected error"})
+        api_method = path.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        try:
+            params = json.loads(body) if body.startswith(b"{") else dict(parse_qsl(body.decode("utf-8")))
+        except ValueError:
+            params = {}
+        if api_method == "getMe":
+            return _json(200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}})
+        if api_method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            self.messages.setdefault(chat_id, []).append((api_method, params.get("text", "")))
+            return _json(200, {"ok": True, "result": self._message(chat_id, params.get("text", ""))})
+        return _json(200, {"ok": True, "result": True})
+
+
+class FakeTelegramClient:
+    """
+    Заменяет telethon.TelegramClient в пуле: канал, полная информация и посты
+    генерируются детерминированно по username с настраиваемой задержкой на вызов.
+    """
+
+    latency = Latency(0.1)
+    error_rate = 0.0
+    rnd = random.Random()
+    calls = 0
+    errors = 0
+
+    def __init__(self, session: str, api_id: int, api_hash: str):
+        self.session = session
+
+    @classmethod
+    def configure(cls, latency: float = 0.1, jitter: float = 0.0, error_rate: float = 0.0,
+                  seed: Optional[int] = None) -> None:
+        cls.latency = Latency(latency, jitter)
+        cls.error_rate = error_rate
+        cls.rnd = random.Random(seed)
+        cls.calls = 0
+        cls.errors = 0
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        return {"requests": cls.calls, "errors": cls.errors}
+
+    async def _call(self) -> None:
+        cls = type(self)
+        cls.calls += 1
+        await cls.latency.sleep(cls.rnd)
+        if cls.error_rate and cls.rnd.random() < cls.error_rate:
+            cls.errors += 1
+            raise ConnectionError("injected Telegram error")
+
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    async def get_input_entity(self, username: str):
+        await self._call()
+        return SimpleNamespace(username=username.lstrip("@"))
+
+    async def __call__(self, request):
+        """Поддерживается только GetFullChannelRequest — его и вызывает парсер."""
+        await self._call()
+        username = getattr(request.channel, "username", "")
+        rnd = random.Random(_seed(username))
+        return SimpleNamespace(
+            chats=[SimpleNamespace(title=f"Канал {username}")],
+            full_chat=SimpleNamespace(about="Канал для нагрузочного теста", participants_count=rnd.randint(2_000, 400_000)),
+        )
+
+    async def get_messages(self, entity, limit: Optional[int] = None, min_id: int = 0, max_id: int = 0,
+                           ids: Optional[List[int]] = None):
+        await self._call()
+        rnd = random.Random(_seed(entity.username))
+        subs = rnd.randint(2_000, 400_000)
+        last_id = 1000 + rnd.randint(0, 5000)
+        if ids is not None:
+            wanted = [i for i in ids if 0 < i <= last_id]
+        else:
+            top = min(last_id, max_id - 1) if max_id else last_id
+            wanted = [i for i in range(top, max(min_id, 0), -1)][: limit or 100]
+        return [self._message(entity.username, i, last_id, subs) for i in wanted]
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, offset_id: int = 0):
+        """История от новых к старым порциями по 100, как у Telethon (один вызов API на порцию)."""
+        rnd = random.Random(_seed(entity.username))
+        subs = rnd.randint(2_000, 400_000)
+        # Для глубокого скана у канала длинная история
+        last_id = 20_000 + rnd.randint(0, 5000)
+        top = min(last_id, offset_id - 1) if offset_id else last_id
+        remaining = limit if limit is not None else top
+        for start in range(top, 0, -100):
+            if remaining <= 0:
+                return
+            await self._call()
+            for i in range(start, max(start - min(100, remaining), 0), -1):
+                yield self._message(entity.username, i, last_id, subs)
+            remaining -= 100
+
+    @staticmethod
+    def _message(username: str, msg_id: int, last_id: int, subs: int):
+        rnd = random.Random(_seed(username) ^ msg_id)
+        age_hours = (last_id - msg_id) * 6 + rnd.uniform(0, 6)
+        views = int(subs * rnd.uniform(0.05, 0.35) * min(1.0, 0.3 + age_hours / 48))
+        return SimpleNamespace(
+            id=msg_id,
+            date=datetime.now(timezone.utc) - timedelta(hours=age_hours),
+            views=views,
+            forwards=int(views * rnd.uniform(0, 0.02)),
+            reactions=SimpleNamespace(results=[SimpleNamespace(count=int(views * rnd.uniform(0, 0.03)))]),
+            fwd_from=None if rnd.random() > 0.05 else object(),
+            reply_to=None,
+            message=f"Пост {msg_id} канала {username}",
+            media=None,
+        )
+
+
+def install_fake_telethon(latency: float = 0.1, jitter: float = 0.0, error_rate: float = 0.0,
+                          seed: Optional[int] = None) -> None:
+    """Подменяет Telethon в parser_core на FakeTelegramClient (вызывать до start_clients)."""
+    from parser_core import client_pool, telegram_parser
+
+    FakeTelegramClient.configure(latency, jitter, error_rate, seed)
+    client_pool.TelegramClient = FakeTelegramClient
+    telegram_parser.TELETHON_OK = True
+    telegram_parser.API_ID = telegram_parser.API_ID or 1
+    telegram_parser.API_HASH = telegram_parser.API_HASH or "bench"
+    if not hasattr(telegram_parser, "GetFullChannelRequest"):
+        # Telethon не установлен — заглушке достаточно поля channel
+        telegram_parser.GetFullChannelRequest = lambda channel: SimpleNamespace(channel=channel)
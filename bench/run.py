@@ -0,0 +1,312 @@
+# File: bench/run.py — нагрузочный прогон бота на локальных заглушках TGStat, OpenAI и Telegram
+
+"""
+Запуск (из корня репозитория):
+
+    python -m bench.run --users 20 --requests 5
+    python -m bench.run --users 50 --openai-latency 2 --openai-errors 0.1 --label before-cache
+    python -m bench.run --compare            # сравнить два последних прогона
+
+N пользователей параллельно отправляют ссылки в handle_message и ждут ответа,
+как в реальном чате. Каждый прогон дописывается JSON-строкой в bench/results.jsonl.
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional
+
+from bench.fakes import FakeOpenAI, FakeTGStat, FakeTelegramClient, install_fake_telethon
+
+DEFAULT_OUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+
+# Ответы handle_message/run_analysis, после которых запрос считается завершённым
+_DONE_OK = "Выберите действие:"
+_DONE_ERROR = "Ошибка при анализе"
+_REJECTED = "⏳"
+_PRELIMINARY = "Предварительный вывод"
+
+
+def percentiles(values: List[float], scale: float = 1.0) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def q(p: float) -> float:
+        return round(values[min(len(values) - 1, int(p * len(values)))] * scale, 4)
+
+    return {"count": len(values), "mean": round(sum(values) / len(values) * scale, 4),
+            "p50": q(0.5), "p90": q(0.9), "p95": q(0.95), "p99": q(0.99), "max": round(values[-1] * scale, 4)}
+
+
+class FakeMessage:
+    """Сообщение чата с reply_text/edit_text; отслеживает, когда анализ закончился."""
+
+    def __init__(self, chat: "FakeChat", text: str = ""):
+        self.chat = chat
+        self.text = text
+        self.from_user = chat.user
+
+    async def reply_text(self, text: str, reply_markup=None, **kwargs) -> "FakeMessage":
+        self.chat.observe(text)
+        return FakeMessage(self.chat, text)
+
+    async def edit_text(self, text: str, reply_markup=None, **kwargs) -> "FakeMessage":
+        self.text = text
+        self.chat.observe(text)
+        return self
+
+
+_update_ids = itertools.count(1)
+
+
+class FakeChat:
+    """Переписка одного пользователя с ботом: один запрос в работе за раз."""
+
+    def __init__(self, user_id: int):
+        self.user = SimpleNamespace(id=user_id, username=f"bench_user_{user_id}")
+        self.started = 0.0
+        self.preliminary: Optional[float] = None
+        self.outcome: Optional[str] = None
+        self.done = asyncio.Event()
+
+    def reset(self) -> None:
+        self.started = time.perf_counter()
+        self.preliminary = None
+        self.outcome = None
+        self.done.clear()
+
+    def observe(self, text: str) -> None:
+        if self.preliminary is None and _PRELIMINARY in text:
+            self.preliminary = time.perf_counter() - self.started
+        if text == _DONE_OK:
+            self.outcome = "ok"
+        elif text.startswith(_DONE_ERROR):
+            self.outcome = "error"
+        elif text.startswith(_REJECTED):
+            self.outcome = "rejected"
+        if self.outcome:
+            self.done.set()
+
+    def update(self, text: str):
+        return SimpleNamespace(update_id=next(_update_ids), message=FakeMessage(self, text), effective_user=self.user,
+                               effective_chat=SimpleNamespace(id=self.user.id))
+
+
+async def _loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.05) -> None:
+    """Задержка event loop: насколько позже запланированного просыпается таймер."""
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - t0 - interval)
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    tmp = tempfile.mkdtemp(prefix="arhy-bench-")
+    tgstat = FakeTGStat(args.tgstat_latency, args.tgstat_jitter, args.tgstat_errors, seed=args.seed)
+    openai_srv = FakeOpenAI(args.openai_latency, args.openai_jitter, args.openai_errors,
+                            token_delay=args.openai_token_delay, seed=args.seed)
+    tgstat_url = await tgstat.start()
+    openai_url = await openai_srv.start()
+
+    # Настройки читаются модулями при импорте, поэтому окружение готовим до import main
+    os.environ.pop("METRICS_PORT", None)
+    os.environ.update({
+        "TGSTAT_BASE_URL": tgstat_url,
+        "TGSTAT_TOKEN": "bench",
+        "OPENAI_BASE_URL": openai_url + "/v1",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_STREAM": "1" if args.stream else "0",
+        "ANALYSIS_CONCURRENCY": str(args.concurrency),
+        "ANALYSIS_QUEUE_SIZE": str(args.queue_size),
+        "USER_DB_PATH": os.path.join(tmp, "users.db"),
+        "CHANNEL_INDEX_PATH": os.path.join(tmp, "channels.db"),
+        "STATE_DB_PATH": os.path.join(tmp, "state.db"),
+        "POST_STORE_PATH": os.path.join(tmp, "posts.db"),
+        "SNAPSHOT_DIR": os.path.join(tmp, "snapshots"),
+        "SNAPSHOT_ENABLED": "0",
+        "USER_LOG_PATH": os.path.join(tmp, "user_log.csv"),
+        "APP_LOG_PATH": os.path.join(tmp, "app_log.jsonl"),
+    })
+    os.environ.pop("CACHE_DISK_PATH", None)
+    install_fake_telethon(args.telegram_latency, args.telegram_jitter, args.telegram_errors, seed=args.seed)
+
+    import main as bot
+    from bot.services.telemetry import telemetry
+
+    # Один процесс на свежих базах: подхватывать чужие анализы некому, Bot API не нужен
+    application = SimpleNamespace(bot_data={}, bot=None)
+    await bot.post_init(application)
+
+    chats = [FakeChat(100_000 + i) for i in range(args.users)]
+    for chat in chats:
+        await bot.handle_message(chat.update("Предоставить свои данные"), None)
+
+    latencies: List[float] = []
+    preliminary: List[float] = []
+    outcomes: Dict[str, int] = {"ok": 0, "error": 0, "rejected": 0, "timeout": 0}
+    lag: List[float] = []
+    stop_lag = asyncio.Event()
+    counter = iter(range(10**9))
+
+    async def user(chat: FakeChat) -> None:
+        for _ in range(args.requests):
+            channel = next(counter) % args.channels if args.channels else next(counter)
+            chat.reset()
+            await bot.handle_message(chat.update(f"https://t.me/bench_channel_{channel}"), None)
+            try:
+                await asyncio.wait_for(chat.done.wait(), args.timeout)
+            except asyncio.TimeoutError:
+                outcomes["timeout"] += 1
+                continue
+            outcomes[chat.outcome] += 1
+            if chat.outcome == "ok":
+                latencies.append(time.perf_counter() - chat.started)
+                if chat.preliminary is not None:
+                    preliminary.append(chat.preliminary)
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    lag_task = asyncio.create_task(_loop_lag(lag, stop_lag))
+    t0 = time.perf_counter()
+    try:
+        await asyncio.gather(*(user(chat) for chat in chats))
+        wall = time.perf_counter() - t0
+    finally:
+        stop_lag.set()
+        await lag_task
+        traced_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+        tracemalloc.stop()
+        await bot.post_shutdown(application)
+        await tgstat.stop()
+        await openai_srv.stop()
+        if args.keep:
+            print(f"Рабочие файлы прогона: {tmp}")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    total = args.users * args.requests
+    return {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+        "git": _git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "keep", "label")},
+        "results": {
+            "requests": total,
+            **outcomes,
+            "wall_s": round(wall, 3),
+            "throughput_rps": round(outcomes["ok"] / wall, 3) if wall > 0 else 0.0,
+            "latency_s": percentiles(latencies),
+            "preliminary_s": percentiles(preliminary),
+            "loop_lag_ms": percentiles(lag, 1000),
+            # ru_maxrss в Linux — в килобайтах
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "traced_peak_mb": round(traced_peak / 2**20, 1) if traced_peak is not None else None,
+        },
+        "upstreams": {"telegram": FakeTelegramClient.stats(), "tgstat": tgstat.stats(), "openai": openai_srv.stats()},
+        "stages": telemetry.snapshot()["series"],
+    }
+
+
+def format_run(run: Dict[str, Any]) -> str:
+    r = run["results"]
+    lat, pre, lag = r["latency_s"], r["preliminary_s"], r["loop_lag_ms"]
+    lines = [
+        f"[{run['ts']}] {run.get('label') or ''} git={run.get('git')}",
+        f"Запросов: {r['requests']} (ok {r['ok']}, ошибок {r['error']}, отклонено {r['rejected']}, таймаутов {r['timeout']})",
+        f"Время: {r['wall_s']} с, пропускная способность {r['throughput_rps']} анализов/с",
+    ]
+    if lat.get("count"):
+        lines.append(f"Задержка, с: p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} max={lat['max']}")
+    if pre.get("count"):
+        lines.append(f"Предварительный вывод, с: p50={pre['p50']} p95={pre['p95']}")
+    if lag.get("count"):
+        lines.append(f"Лаг event loop, мс: p99={lag['p99']} max={lag['max']}")
+    lines.append(f"Память: RSS {r['peak_rss_mb']} МБ" +
+                 (f", tracemalloc {r['traced_peak_mb']} МБ" if r.get("traced_peak_mb") is not None else ""))
+    return "\n".join(lines)
+
+
+def compare(path: str) -> str:
+    """Сводка двух последних прогонов из файла результатов: ключевые метрики и изменение в %."""
+    with open(path, encoding="utf-8") as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if len(runs) < 2:
+        return "Для сравнения нужно хотя бы два прогона."
+    a, b = runs[-2], runs[-1]
+    rows = [
+        ("throughput_rps", lambda r: r["results"]["throughput_rps"]),
+        ("latency p50, s", lambda r: r["results"]["latency_s"].get("p50")),
+        ("latency p95, s", lambda r: r["results"]["latency_s"].get("p95")),
+        ("latency p99, s", lambda r: r["results"]["latency_s"].get("p99")),
+        ("errors", lambda r: r["results"]["error"] + r["results"]["timeout"]),
+        ("loop lag p99, ms", lambda r: r["results"]["loop_lag_ms"].get("p99")),
+        ("peak RSS, MB", lambda r: r["results"]["peak_rss_mb"]),
+    ]
+    lines = [f"{'':18} {a.get('label') or a['ts']:>20} {b.get('label') or b['ts']:>20}"]
+    for name, get in rows:
+        va, vb = get(a), get(b)
+        delta = f"{(vb - va) / va * 100:+.1f}%" if va and vb is not None else ""
+        lines.append(f"{name:18} {va!s:>20} {vb!s:>20} {delta}")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m bench.run", description="Нагрузочный прогон бота на локальных заглушках")
+    p.add_argument("--users", type=int, default=10, help="одновременных пользователей")
+    p.add_argument("--requests", type=int, default=3, help="ссылок от каждого пользователя (последовательно)")
+    p.add_argument("--channels", type=int, default=0, help="число разных каналов (0 — все разные, без попаданий в кэш)")
+    p.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между запросами, с")
+    p.add_argument("--timeout", type=float, default=120.0, help="сколько ждать ответа на один запрос, с")
+    p.add_argument("--concurrency", type=int, default=int(os.getenv("ANALYSIS_CONCURRENCY", "4")), help="воркеров очереди анализа")
+    p.add_argument("--queue-size", type=int, default=int(os.getenv("ANALYSIS_QUEUE_SIZE", "100")))
+    p.add_argument("--no-stream", dest="stream", action="store_false", help="OpenAI без стриминга")
+    for name, latency in (("telegram", 0.15), ("tgstat", 0.08), ("openai", 1.0)):
+        p.add_argument(f"--{name}-latency", type=float, default=latency, help=f"средняя задержка {name}, с")
+        p.add_argument(f"--{name}-jitter", type=float, default=latency / 4, help=f"разброс задержки {name}, с")
+        p.add_argument(f"--{name}-errors", type=float, default=0.0, help=f"доля ошибок {name} (0..1)")
+    p.add_argument("--openai-token-delay", type=float, default=0.005, help="пауза между чанками стрима, с")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--tracemalloc", action="store_true", help="пик памяти Python-объектов (замедляет прогон)")
+    p.add_argument("--label", default="", help="метка прогона для сравнения")
+    p.add_argument("--out", default=DEFAULT_OUT, help="файл результатов (JSONL, дописывается)")
+    p.add_argument("--keep", action="store_true", help="не удалять временные базы и журналы")
+    p.add_argument("--compare", action="store_true", help="сравнить два последних прогона из --out и выйти")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.compare:
+        print(compare(args.out))
+        return
+    run = asyncio.run(run_benchmark(args))
+    with open(args.out, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run, ensure_ascii=False) + "\n")
+    print(format_run(run))
+    print(f"Результат записан в {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+# File: bench/webhook_sim.py — прогон режима webhook: имитация потока апдейтов Telegram, приёмник и воркеры-процессы
+
+"""
+Запуск (из корня репозитория):
+
+    python -m bench.webhook_sim --workers 3 --users 40 --links 3
+    python -m bench.webhook_sim --workers 4 --users 100 --duplicates 0.3 --kill-worker
+
+Приёмник (main.webhook_app) вызывается напрямую как ASGI-приложение, воркеры — настоящие процессы
+`main.py worker` на заглушках Bot API, TGStat, OpenAI и Telethon. Апдейты пользователей перемешиваются
+между собой (порядок внутри пользователя сохраняется), часть доставляется повторно, как при ретраях Telegram.
+В конце проверяется: апдейты каждого пользователя обработаны по порядку, ни один не потерян,
+пробные анализы списаны ровно по одному на принятую ссылку и по каждой принятой ссылке пришёл отчёт
+(в том числе если принявший её воркер убит). Нарушения — код выхода 1.
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+from bench.fakes import FakeBotAPI, FakeOpenAI, FakeTGStat, install_fake_telethon
+from bench.run import percentiles
+
+SECRET = "bench-secret"
+_WELCOME = "Добро пожаловать"
+_REPORT = "Светофор:"
+_FAILED = ("Ошибка при анализе", "⏳ Сервисы сейчас перегружены")
+_RESUMED = "🔄 Анализ"
+
+
+def _message(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench_user_{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def build_feed(users: int, links: int, duplicates: float, rnd: random.Random) -> List[Dict[str, Any]]:
+    """Диалоги пользователей, перемешанные между собой; update_id растут в порядке доставки."""
+    dialogs = []
+    for i in range(users):
+        user_id = 200_000 + i
+        texts = ["/start", "Предоставить свои данные"]
+        texts += [f"https://t.me/bench_channel_{rnd.randrange(users * links)}" for _ in range(links)]
+        dialogs.append([(user_id, text) for text in texts])
+    feed: List[Dict[str, Any]] = []
+    while dialogs:
+        dialog = rnd.choice(dialogs)
+        user_id, text = dialog.pop(0)
+        if not dialog:
+            dialogs.remove(dialog)
+        update = _message(len(feed) + 1, user_id, text)
+        feed.append(update)
+        if rnd.random() < duplicates:
+            feed.append(update)  # повторная доставка того же update_id
+    return feed
+
+
+async def post_update(app, update: Dict[str, Any]) -> Tuple[int, float]:
+    """Один POST в ASGI-приложение без сервера: (статус, время ответа)."""
+    body = json.dumps(update).encode("utf-8")
+    sent: List[Dict[str, Any]] = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/telegram",
+             "headers": [(b"content-type", b"application/json"), (b"x-telegram-bot-api-secret-token", SECRET.encode())]}
+    t0 = time.perf_counter()
+    await app(scope, receive, send)
+    return sent[0]["status"], time.perf_counter() - t0
+
+
+def _db_rows(path: str, sql: str) -> List[tuple]:
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def check(state_db: str, users_db: str, bot_api: FakeBotAPI) -> Dict[str, Any]:
+    """Порядок обработки по пользователям, списание пробных анализов и отчёты по принятым ссылкам."""
+    rows = _db_rows(state_db, "SELECT user_id, update_id, status, done_at, received_at FROM updates ORDER BY user_id, update_id")
+    order_violations = 0
+    last: Dict[int, float] = {}
+    for user_id, _, status, done_at, _ in rows:
+        if status != "done":
+            continue
+        if done_at < last.get(user_id, 0.0):
+            order_violations += 1
+        last[user_id] = done_at
+    trials = dict(_db_rows(users_db, "SELECT user_id, trials_used FROM users"))
+    # Принятые ссылки — по общему состоянию: воркер мог упасть, не успев отправить «Принято»
+    accepted_by_user = dict(_db_rows(
+        state_db, "SELECT u.user_id, COUNT(*) FROM accepted_updates a JOIN updates u USING (update_id) GROUP BY u.user_id"))
+    trial_mismatches = 0
+    welcome_violations = 0
+    missing_reports = reports_failed = resumed = 0
+    for chat_id, messages in bot_api.messages.items():
+        sent = [text for method, text in messages if method == "sendMessage"]
+        accepted = accepted_by_user.get(chat_id, 0)
+        if trials.get(chat_id, 0) != accepted:
+            trial_mismatches += 1
+        reports = sum(1 for text in sent if _REPORT in text)
+        failed = sum(1 for text in sent if text.startswith(_FAILED))
+        missing_reports += max(accepted - reports - failed, 0)
+        reports_failed += failed
+        resumed += sum(1 for text in sent if text.startswith(_RESUMED))
+        if not messages or not messages[0][1].startswith(_WELCOME):
+            welcome_violations += 1
+    return {
+        "updates": len(rows),
+        "not_done": sum(1 for r in rows if r[2] != "done"),
+        "order_violations": order_violations,
+        "welcome_violations": welcome_violations,
+        "trial_mismatches": trial_mismatches,
+        "trials_charged": sum(trials.values()),
+        "missing_reports": missing_reports,
+        "reports_failed": reports_failed,
+        "resumed": resumed,
+        "handle_latency": percentiles([r[3] - r[4] for r in rows if r[3] is not None]),
+    }
+
+
+async def run_sim(args: argparse.Namespace) -> Dict[str, Any]:
+    tmp = tempfile.mkdtemp(prefix="arhy-webhook-")
+    bot_api = FakeBotAPI(args.botapi_latency, seed=args.seed)
+    tgstat = FakeTGStat(0.08, 0.02, seed=args.seed)
+    openai_srv = FakeOpenAI(args.openai_latency, args.openai_latency / 4, seed=args.seed)
+    bot_api_url = await bot_api.start()
+    tgstat_url = await tgstat.start()
+    openai_url = await openai_srv.start()
+
+    os.environ.pop("METRICS_PORT", None)
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "BOT_API_URL": bot_api_url,
+        "WEBHOOK_SECRET": SECRET,
+        "TGSTAT_BASE_URL": tgstat_url,
+        "TGSTAT_TOKEN": "bench",
+        "OPENAI_BASE_URL": openai_url + "/v1",
+        "OPENAI_API_KEY": "bench",
+        "WORKER_CONCURRENCY": str(args.worker_concurrency),
+        # По сессии Telethon на воркер (у заглушки это просто имена)
+        "TELEGRAM_SESSIONS": ",".join(f"bench_session_{i}" for i in range(args.workers)),
+        # Анализы убитого воркера подхватываются быстрее, чем в бою
+        "ANALYSIS_STALE_AFTER": "5",
+        "USER_DB_PATH": os.path.join(tmp, "users.db"),
+        "STATE_DB_PATH": os.path.join(tmp, "state.db"),
+        "CHANNEL_INDEX_PATH": os.path.join(tmp, "channels.db"),
+        "POST_STORE_PATH": os.path.join(tmp, "posts.db"),
+        # Дисковый уровень кэша у воркеров обязателен; каждый прогон начинается с пустого
+        "CACHE_DISK_PATH": os.path.join(tmp, "cache.db"),
+        "SNAPSHOT_DIR": os.path.join(tmp, "snapshots"),
+        "SNAPSHOT_ENABLED": "0",
+        "USER_LOG_PATH": os.path.join(tmp, "user_log.csv"),
+        "APP_LOG_PATH": os.path.join(tmp, "app_log.jsonl"),
+    })
+    import main as bot
+
+    rnd = random.Random(args.seed)
+    feed = build_feed(args.users, args.links, args.duplicates, rnd)
+    command = [sys.executable, "-m", "bench.webhook_sim", "--worker", "--telegram-latency", str(args.telegram_latency)]
+    workers = bot.spawn_workers(args.workers, command)
+    await bot.shared_state.open()
+    # Воркер готов, когда приложение бота инициализировано (getMe) и post_init отработал
+    started = time.monotonic()
+    while bot_api.calls.get("getMe", 0) < len(workers) and time.monotonic() - started < 60:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1.0)
+    killed_with = 0
+    receive_times: List[float] = []
+    statuses: Dict[int, int] = {}
+    t0 = time.perf_counter()
+    try:
+        # Telegram шлёт апдейты пачками параллельных запросов
+        for i in range(0, len(feed), args.burst):
+            results = await asyncio.gather(*(post_update(bot.webhook_app, u) for u in feed[i:i + args.burst]))
+            for status, elapsed in results:
+                statuses[status] = statuses.get(status, 0) + 1
+                receive_times.append(elapsed)
+        if args.kill_worker and workers:
+            # Аварийное завершение воркера посреди анализов: его аренды истекут, апдейты заберут другие,
+            # принятые им анализы подхватят через adopt_analyses
+            until = time.monotonic() + 30
+            busy: List[tuple] = []
+            while not busy and time.monotonic() < until:
+                busy = _db_rows(os.environ["STATE_DB_PATH"],
+                                "SELECT worker, COUNT(*) FROM analyses GROUP BY worker ORDER BY 2 DESC LIMIT 1")
+                await asyncio.sleep(0.05)
+            victim = int(busy[0][0].rsplit(":w", 1)[1]) if busy else 0
+            workers[victim].kill()
+            killed_with = busy[0][1] if busy else 0
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            running = _db_rows(os.environ["STATE_DB_PATH"], "SELECT COUNT(*) FROM analyses")[0][0]
+            if await bot.shared_state.pending() == 0 and running == 0:
+                break
+            await asyncio.sleep(0.2)
+        wall = time.perf_counter() - t0
+        result = check(os.environ["STATE_DB_PATH"], os.environ["USER_DB_PATH"], bot_api)
+    finally:
+        for proc in workers:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in workers:
+            proc.wait()
+        bot.shared_state.close()
+        await bot_api.stop()
+        await tgstat.stop()
+        await openai_srv.stop()
+        if args.keep:
+            print(f"Рабочие файлы прогона: {tmp}")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        "workers": args.workers,
+        "users": args.users,
+        "deliveries": len(feed),
+        "statuses": statuses,
+        "wall_s": round(wall, 3),
+        "updates_per_s": round(result["updates"] / wall, 2) if wall else None,
+        "receive_ms": percentiles(receive_times, 1000),
+        "killed_with": killed_with,
+        **result,
+    }
+
+
+def passed(r: Dict[str, Any]) -> bool:
+    return not (r["not_done"] or r["order_violations"] or r["trial_mismatches"] or r["welcome_violations"]
+                or r["missing_reports"])
+
+
+def format_result(r: Dict[str, Any]) -> str:
+    return "\n".join([
+        f"Воркеров: {r['workers']}, пользователей: {r['users']}, доставок: {r['deliveries']} (уникальных апдейтов {r['updates']})",
+        f"Ответы приёмника: {r['statuses']}; время ответа, мс: p50={r['receive_ms'].get('p50')} p99={r['receive_ms'].get('p99')}",
+        f"Время: {r['wall_s']} с, {r['updates_per_s']} апдейтов/с; обработка апдейта от приёма, с: "
+        f"p50={r['handle_latency'].get('p50')} p95={r['handle_latency'].get('p95')}",
+        f"Убитый воркер вёл анализов: {r['killed_with']}",
+        f"Пробных анализов списано: {r['trials_charged']}; отчётов не пришло: {r['missing_reports']}, "
+        f"с ошибкой: {r['reports_failed']}, возобновлено после падения воркера: {r['resumed']}",
+        f"Не обработано: {r['not_done']}, нарушений порядка: {r['order_violations'] + r['welcome_violations']}, "
+        f"расхождений в пробных анализах: {r['trial_mismatches']}",
+        "OK" if passed(r) else "НАРУШЕНИЯ",
+    ])
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Имитация режима webhook: приёмник + воркеры на локальных заглушках")
+    p.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    p.add_argument("--workers", type=int, default=3, help="процессов-воркеров")
+    p.add_argument("--worker-concurrency", type=int, default=8, help="параллельных апдейтов в воркере")
+    p.add_argument("--users", type=int, default=30, help="пользователей")
+    p.add_argument("--links", type=int, default=3, help="ссылок от каждого пользователя")
+    p.add_argument("--duplicates", type=float, default=0.2, help="доля повторно доставленных апдейтов")
+    p.add_argument("--burst", type=int, default=20, help="апдейтов в одной пачке доставки")
+    p.add_argument("--kill-worker", action="store_true", help="убить один воркер посреди прогона")
+    p.add_argument("--telegram-latency", type=float, default=0.15)
+    p.add_argument("--openai-latency", type=float, default=0.5)
+    p.add_argument("--botapi-latency", type=float, default=0.01)
+    p.add_argument("--timeout", type=float, default=180.0, help="сколько ждать опустошения очереди, с")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--keep", action="store_true", help="не удалять временные базы и журналы")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.worker:
+        # Процесс-воркер: те же хендлеры бота, Telethon подменён заглушкой
+        install_fake_telethon(args.telegram_latency, args.telegram_latency / 4, seed=os.getpid())
+        import main as bot
+        asyncio.run(bot.run_worker())
+        return
+    result = asyncio.run(run_sim(args))
+    print(format_result(result))
+    if not passed(result):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
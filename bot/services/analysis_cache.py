@@ -0,0 +1,223 @@
+# File: bot/services/analysis_cache.py — кэш результатов анализа по этапам (Telegram, TGStat, вердикт ИИ)
+
+from __future__ import annotations
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Awaitable, Callable, Optional, Tuple
+
+# TTL по умолчанию для этапов (секунды)
+DEFAULT_TTLS: Dict[str, float] = {
+    "telegram": 10 * 60,
+    "tgstat": 30 * 60,
+    "verdict": 60 * 60,
+}
+
+
+class _DiskTier:
+    """
+    Второй уровень кэша в SQLite: переживает перезапуск бота и общий для всех процессов на одном файле.
+    Таблица loading объединяет загрузки между процессами: ключ грузит тот, кто первым его занял.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "stage TEXT, key TEXT, expires_at REAL, value TEXT, PRIMARY KEY (stage, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS loading ("
+            "stage TEXT, key TEXT, owner TEXT NOT NULL, until REAL NOT NULL, PRIMARY KEY (stage, key))"
+        )
+        self._lock = threading.Lock()
+
+    def get(self, stage: str, key: str) -> Optional[Tuple[float, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, value FROM cache WHERE stage = ? AND key = ? AND expires_at > ?",
+                (stage, key, time.time()),
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def put(self, stage: str, key: str, expires_at: float, value: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (stage, key, expires_at, value) VALUES (?, ?, ?, ?)",
+                (stage, key, expires_at, json.dumps(value, ensure_ascii=False)),
+            )
+
+    def claim(self, stage: str, key: str, owner: str, lease: float) -> bool:
+        """Занимает загрузку ключа на lease секунд; False — ключ уже грузит другой процесс."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM loading WHERE stage = ? AND key = ? AND until <= ?", (stage, key, now))
+                cur = self._conn.execute(
+                    "INSERT OR IGNORE INTO loading (stage, key, owner, until) VALUES (?, ?, ?, ?)",
+                    (stage, key, owner, now + lease),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cur.rowcount == 1
+
+    def release(self, stage: str, key: str, owner: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM loading WHERE stage = ? AND key = ? AND owner = ?", (stage, key, owner))
+
+    def purge_expired(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            self._conn.execute("DELETE FROM loading WHERE until <= ?", (time.time(),))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class AnalysisCache:
+    """
+    LRU-кэш с отдельным TTL на каждый этап и ограничением по памяти (оценка — размер JSON).
+    Одновременные запросы одного ключа объединяются: выполняется одна загрузка,
+    все ожидающие получают один и тот же результат. С дисковым уровнем — и между процессами:
+    пока ключ грузит другой процесс (не дольше load_lease), ждём его результат на диске.
+    """
+
+    def __init__(self, ttls: Optional[Dict[str, float]] = None, max_bytes: int = 64 * 1024 * 1024,
+                 disk_path: Optional[str] = None, load_lease: float = 120.0, poll_interval: float = 0.25):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_bytes = max_bytes
+        self.load_lease = load_lease
+        self.poll_interval = poll_interval
+        self._mem: "OrderedDict[Tuple[str, str], Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._disk = _DiskTier(disk_path) if disk_path else None
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0}
+
+    def use_disk(self, path: str) -> None:
+        """Включает дисковый уровень, если его ещё нет (воркеры режима webhook делят кэш только через диск)."""
+        if self._disk is None:
+            self._disk = _DiskTier(path)
+
+    @property
+    def bytes_used(self) -> int:
+        """Оценка памяти, занятой уровнем в памяти (байты JSON)."""
+        return self._bytes
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._mem:
+            _, (_, _, size) = self._mem.popitem(last=False)
+            self._bytes -= size
+
+    def _put_mem(self, k: Tuple[str, str], expires_at: float, value: Any) -> None:
+        size = len(json.dumps(value, ensure_ascii=False, default=str))
+        if size > self.max_bytes:
+            return
+        old = self._mem.pop(k, None)
+        if old:
+            self._bytes -= old[2]
+        self._mem[k] = (expires_at, value, size)
+        self._bytes += size
+        self._evict()
+
+    def get(self, stage: str, key: str) -> Any:
+        """Значение из памяти или None (без обращения к диску)."""
+        k = (stage, key)
+        item = self._mem.get(k)
+        if item is None:
+            return None
+        if item[0] <= time.time():
+            self._mem.pop(k)
+            self._bytes -= item[2]
+            return None
+        self._mem.move_to_end(k)
+        return item[1]
+
+    async def lookup(self, stage: str, key: str) -> Any:
+        """Значение из памяти или с диска (попадание с диска поднимается в память); None — промах."""
+        value = self.get(stage, key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+        if self._disk is not None:
+            hit = await asyncio.to_thread(self._disk.get, stage, key)
+            if hit is not None:
+                self.stats["disk_hits"] += 1
+                self._put_mem((stage, key), hit[0], hit[1])
+                return hit[1]
+        return None
+
+    async def put(self, stage: str, key: str, value: Any) -> None:
+        expires_at = time.time() + self.ttls.get(stage, 0)
+        self._put_mem((stage, key), expires_at, value)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.put, stage, key, expires_at, value)
+
+    async def get_or_fetch(self, stage: str, key: str, fetch: Callable[[], Awaitable[Any]],
+                           cacheable: Callable[[Any], bool] = lambda v: True) -> Any:
+        """
+        Возвращает значение этапа из кэша или вызывает fetch().
+        Результаты, не прошедшие cacheable (например, ответы с ошибкой), отдаются, но не кэшируются.
+        """
+        value = self.get(stage, key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+
+        k = (stage, key)
+        task = self._inflight.get(k)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+            return await asyncio.shield(task)
+
+        async def load():
+            disk = self._disk
+            if disk is None:
+                self.stats["misses"] += 1
+                result = await fetch()
+                if result is not None and cacheable(result):
+                    await self.put(stage, key, result)
+                return result
+            waited = False
+            while True:
+                hit = await asyncio.to_thread(disk.get, stage, key)
+                if hit is not None:
+                    self.stats["coalesced" if waited else "disk_hits"] += 1
+                    self._put_mem(k, hit[0], hit[1])
+                    return hit[1]
+                if await asyncio.to_thread(disk.claim, stage, key, self._owner, self.load_lease):
+                    break
+                # Ключ грузит другой процесс: ждём его результат (или истечения его аренды)
+                waited = True
+                await asyncio.sleep(self.poll_interval)
+            self.stats["misses"] += 1
+            try:
+                result = await fetch()
+                if result is not None and cacheable(result):
+                    await self.put(stage, key, result)
+                return result
+            finally:
+                await asyncio.to_thread(disk.release, stage, key, self._owner)
+
+        task = asyncio.create_task(load())
+        self._inflight[k] = task
+        task.add_done_callback(lambda _: self._inflight.pop(k, None))
+        return await asyncio.shield(task)
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.purge_expired()
+            self._disk.close()
+            self._disk = None
@@ -0,0 +1,165 @@
+# File: bot/services/analysis_jobs.py — очередь задач анализа каналов с пулом воркеров
+
+from __future__ import annotations
+import asyncio
+import itertools
+import time
+from typing import Dict, Any, Awaitable, Callable, List, Optional
+
+
+class QueueFullError(Exception):
+    """Очередь анализа переполнена — новую задачу принять нельзя."""
+
+
+class UserLimitError(Exception):
+    """У пользователя уже выполняется максимально допустимое число анализов."""
+
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+
+class AnalysisJob:
+    """Одна задача анализа: ссылка пользователя, текущий этап и отмена."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id: int, link: str, on_progress: Optional[ProgressCallback] = None,
+                 payload: Optional[Dict[str, Any]] = None, priority: int = 0):
+        self.job_id = next(self._ids)
+        self.user_id = user_id
+        self.link = link
+        self.payload = payload or {}
+        self.priority = priority
+        self.stage = "queued"
+        self.cancelled = False
+        self.created_at = time.monotonic()
+        self._on_progress = on_progress
+        self._task: Optional[asyncio.Task] = None
+
+    async def progress(self, stage: str) -> None:
+        """Сообщает о смене этапа; ошибки колбэка (например, Telegram edit) не прерывают анализ."""
+        self.stage = stage
+        if self._on_progress and not self.cancelled:
+            try:
+                await self._on_progress(stage)
+            except Exception:
+                pass
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+class AnalysisQueue:
+    """
+    Ограниченная очередь с фиксированным числом воркеров.
+    runner(job) выполняет весь анализ асинхронно (сеть, ИИ, хранилища через to_thread),
+    поэтому event loop бота остаётся свободным для остальных пользователей.
+    """
+
+    def __init__(self, runner: Callable[[AnalysisJob], Awaitable[None]], concurrency: int = 4,
+                 per_user_limit: int = 1, max_queue: int = 100):
+        self.runner = runner
+        self.concurrency = concurrency
+        self.per_user_limit = per_user_limit
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._by_user: Dict[int, List[AnalysisJob]] = {}
+        self._stopping = False
+        # Скользящее среднее длительности анализа — для оценки ожидания в очереди
+        self.avg_job_seconds = 30.0
+
+    async def start(self) -> None:
+        # Меньший приоритет обслуживается раньше; внутри приоритета — по порядку поступления
+        self._queue = asyncio.PriorityQueue(maxsize=self.max_queue)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """
+        Останавливает воркеры; выполняемые задачи отменяются вместе с ними.
+        Задачи не помечаются cancelled: это остановка процесса, а не отмена пользователем.
+        """
+        self._stopping = True
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def in_flight(self, user_id: int) -> int:
+        return len(self._by_user.get(user_id, []))
+
+    def jobs(self) -> List[AnalysisJob]:
+        """Задачи процесса: в очереди и выполняемые."""
+        return [job for jobs in self._by_user.values() for job in jobs]
+
+    def depth(self) -> int:
+        """Сколько задач ждут в очереди (ещё не взяты воркерами)."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def position(self, job: AnalysisJob) -> int:
+        """Сколько задач в очереди впереди этой (0 — уже выполняется или следующая)."""
+        if job.stage != "queued":
+            return 0
+        key = (job.priority, job.job_id)
+        return sum(1 for j in self.jobs() if j.stage == "queued" and (j.priority, j.job_id) < key)
+
+    def estimate_wait(self, job: AnalysisJob) -> float:
+        """Примерное ожидание до начала анализа, секунды."""
+        if job.stage != "queued":
+            return 0.0
+        running = sum(1 for j in self.jobs() if j.stage != "queued")
+        excess = self.position(job) + running - self.concurrency + 1
+        return max(0.0, excess / self.concurrency * self.avg_job_seconds)
+
+    def submit(self, user_id: int, link: str, on_progress: Optional[ProgressCallback] = None,
+               payload: Optional[Dict[str, Any]] = None, priority: int = 0) -> AnalysisJob:
+        if self._queue is None:
+            raise RuntimeError("AnalysisQueue is not started")
+        if self.in_flight(user_id) >= self.per_user_limit:
+            raise UserLimitError(f"user {user_id} already has {self.per_user_limit} analyses in flight")
+        job = AnalysisJob(user_id, link, on_progress, payload, priority)
+        try:
+            self._queue.put_nowait((job.priority, job.job_id, job))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"analysis queue is full ({self.max_queue})")
+        self._by_user.setdefault(user_id, []).append(job)
+        return job
+
+    def cancel_user(self, user_id: int) -> int:
+        """Отменяет все задачи пользователя (в очереди и выполняемые). Возвращает их число."""
+        jobs = self._by_user.pop(user_id, [])
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def _release(self, job: AnalysisJob) -> None:
+        jobs = self._by_user.get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._by_user[job.user_id]
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.cancelled:
+                    continue
+                job.stage = "started"
+                started = time.monotonic()
+                job._task = asyncio.create_task(self.runner(job))
+                try:
+                    await job._task
+                    self.avg_job_seconds += 0.2 * (time.monotonic() - started - self.avg_job_seconds)
+                except asyncio.CancelledError:
+                    # Отменили задачу, а не воркер — продолжаем обслуживать очередь
+                    if self._stopping or not job.cancelled:
+                        raise
+                except Exception:
+                    # runner сам сообщает пользователю об ошибке; воркер не должен умирать
+                    pass
+            finally:
+                self._release(job)
+                self._queue.task_done()
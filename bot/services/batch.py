@@ -0,0 +1,178 @@
+# File: bot/services/batch.py — пакетный анализ списка каналов с возобновлением и JSONL-выводом
+
+from __future__ import annotations
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime
+from typing import Dict, Any, Awaitable, Callable, Iterator, List, Optional, Set, Tuple
+
+_LINK_RE = re.compile(r"(?:https?://)?t\.me/([A-Za-z0-9_]+)|@([A-Za-z0-9_]{4,})")
+
+Stage = Tuple[str, Callable[[Dict[str, Any]], Awaitable[Any]]]
+
+
+def iter_links(path: str) -> Iterator[str]:
+    """Потоково читает ссылки/@username из файла (по одной или несколько в строке, # — комментарий)."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0]
+            for m in _LINK_RE.finditer(line):
+                yield "@" + (m.group(1) or m.group(2))
+
+
+def default_output_path(links_path: str) -> str:
+    base, _ = os.path.splitext(links_path)
+    return base + ".results.jsonl"
+
+
+def load_done(out_path: str) -> Set[str]:
+    """Чекпоинт — сам файл результатов: каналы с status=ok повторно не обрабатываются."""
+    done: Set[str] = set()
+    try:
+        with open(out_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # недописанная строка после аварийной остановки
+                if rec.get("status") == "ok":
+                    done.add(rec.get("channel"))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class BatchStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ok = 0
+        self.failed = 0
+        self.skipped = 0
+        self.timings: Dict[str, List[float]] = {}
+
+    def add_timing(self, stage: str, seconds: float) -> None:
+        self.timings.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        processed = self.ok + self.failed
+        return {
+            "processed": processed,
+            "ok": self.ok,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_per_min": round(processed / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            "stages": {
+                name: {
+                    "count": len(v),
+                    "mean_s": round(sum(v) / len(v), 3),
+                    "p50_s": round(_percentile(v, 0.5), 3),
+                    "p95_s": round(_percentile(v, 0.95), 3),
+                }
+                for name, v in self.timings.items() if v
+            },
+        }
+
+    def format(self) -> str:
+        s = self.summary()
+        lines = [
+            f"Обработано: {s['processed']} (успешно {s['ok']}, ошибок {s['failed']}, пропущено {s['skipped']})",
+            f"Время: {s['elapsed_s']} с, {s['throughput_per_min']} каналов/мин",
+        ]
+        for name, t in s["stages"].items():
+            lines.append(f"  {name}: n={t['count']} mean={t['mean_s']}s p50={t['p50_s']}s p95={t['p95_s']}s")
+        return "\n".join(lines)
+
+
+async def run_batch(
+    links_path: str,
+    stages: List[Stage],
+    out_path: Optional[str] = None,
+    limits: Optional[Dict[str, int]] = None,
+    workers: int = 8,
+    resume: bool = True,
+    key_fn: Callable[[str], str] = lambda link: link.lower(),
+    record_fn: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+    on_record: Optional[Callable[[Dict[str, Any], BatchStats], Awaitable[None]]] = None,
+) -> BatchStats:
+    """
+    Прогоняет каналы из файла через этапы конвейера.
+    stages — [(имя, async fn(ctx))]; результат этапа кладётся в ctx[имя].
+    limits — параллелизм на этап (апстрим), workers — сколько каналов в работе одновременно.
+    Каждый результат или ошибка сразу дописывается строкой в out_path.
+    """
+    out_path = out_path or default_output_path(links_path)
+    limits = limits or {}
+    sems = {name: asyncio.Semaphore(limits.get(name, workers)) for name, _ in stages}
+    done = load_done(out_path) if resume else set()
+    stats = BatchStats()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    out = open(out_path, "a", encoding="utf-8")
+
+    async def process(link: str) -> None:
+        ctx: Dict[str, Any] = {"link": link}
+        timings: Dict[str, float] = {}
+        record: Dict[str, Any] = {"channel": key_fn(link), "link": link}
+        try:
+            for name, fn in stages:
+                async with sems[name]:
+                    t0 = time.monotonic()
+                    try:
+                        ctx[name] = await fn(ctx)
+                    finally:
+                        timings[name] = round(time.monotonic() - t0, 3)
+                        stats.add_timing(name, timings[name])
+            record["status"] = "ok"
+            if record_fn:
+                record.update(record_fn(ctx))
+            stats.ok += 1
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = f"{type(e).__name__}: {e}"
+            stats.failed += 1
+        record["timings"] = timings
+        record["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        out.flush()
+        if on_record:
+            await on_record(record, stats)
+
+    async def worker() -> None:
+        while True:
+            link = await queue.get()
+            try:
+                if link is None:
+                    return
+                await process(link)
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        seen: Set[str] = set()
+        for link in iter_links(links_path):
+            key = key_fn(link)
+            if key in done or key in seen:
+                stats.skipped += 1
+                continue
+            seen.add(key)
+            await queue.put(link)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+        out.close()
+    return stats
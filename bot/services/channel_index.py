@@ -0,0 +1,219 @@
+# File: bot/services/channel_index.py — индекс метрик и вердиктов каналов для /compare и /top с фоновым обновлением
+
+from __future__ import annotations
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Awaitable, Callable, Iterable, List, Optional, Set
+
+from bot.services.event_log import event_log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    channel TEXT PRIMARY KEY,              -- @username в нижнем регистре
+    title TEXT,
+    category TEXT,                         -- casefold(): NOCASE в SQLite не складывает кириллицу
+    lang TEXT,                             -- casefold()
+    subscribers INTEGER,
+    err_pct REAL,
+    reach_pct REAL,
+    color TEXT,
+    color_rank INTEGER NOT NULL DEFAULT 3, -- green=0, yellow=1, red=2, нет вердикта=3
+    fake_pct REAL,
+    signals TEXT,                          -- JSON-список сигналов метрик
+    analyzed_at REAL NOT NULL              -- unix time анализа
+);
+CREATE INDEX IF NOT EXISTS channels_category_rank ON channels (category, color_rank, err_pct DESC);
+CREATE INDEX IF NOT EXISTS channels_lang ON channels (lang);
+CREATE INDEX IF NOT EXISTS channels_subscribers ON channels (subscribers);
+CREATE INDEX IF NOT EXISTS channels_err ON channels (err_pct);
+CREATE INDEX IF NOT EXISTS channels_color ON channels (color_rank);
+CREATE INDEX IF NOT EXISTS channels_analyzed ON channels (analyzed_at);
+"""
+
+_COLUMNS = ("channel", "title", "category", "lang", "subscribers", "err_pct", "reach_pct", "color", "color_rank",
+            "fake_pct", "signals", "analyzed_at")
+COLOR_RANK = {"green": 0, "yellow": 1, "red": 2}
+
+
+def _tgstat_info(tgstat_data: Dict[str, Any]) -> Dict[str, Any]:
+    block = (tgstat_data or {}).get("get")
+    data = block.get("response", block.get("result")) if isinstance(block, dict) else None
+    return data if isinstance(data, dict) else {}
+
+
+def _fold(value: Optional[str]) -> Optional[str]:
+    """Ключ сравнения категории и языка: casefold работает и для кириллицы («Новости» == «новости»)."""
+    return value.strip().casefold() if isinstance(value, str) and value.strip() else None
+
+
+def build_entry(channel: str, parser_data: Dict[str, Any], tgstat_data: Dict[str, Any],
+                metrics: Dict[str, Any], verdict: Any) -> Dict[str, Any]:
+    """Строка индекса из данных анализа: канал, метрики (compute_channel_metrics) и ответ ИИ."""
+    info = parser_data.get("channel") or {}
+    # Категорию и язык знает только TGStat; в пакетном режиме его ответ не слит в данные канала
+    extra = _tgstat_info(tgstat_data)
+    if isinstance(verdict, str):
+        try:
+            verdict = json.loads(verdict)
+        except ValueError:
+            verdict = {}
+    verdict = verdict if isinstance(verdict, dict) else {}
+    color = (verdict.get("traffic_light") or {}).get("color")
+    return {
+        "channel": channel.lower(),
+        "title": info.get("title") or extra.get("title"),
+        "category": _fold(info.get("category") or extra.get("category")),
+        "lang": _fold(info.get("lang") or extra.get("language")),
+        "subscribers": metrics.get("subscribers"),
+        "err_pct": metrics.get("err_pct"),
+        "reach_pct": metrics.get("reach_pct"),
+        "color": color,
+        "color_rank": COLOR_RANK.get(color, 3),
+        "fake_pct": (verdict.get("fakes_estimate") or {}).get("fake_probability_percent"),
+        "signals": json.dumps(metrics.get("signals") or [], ensure_ascii=False),
+        "analyzed_at": time.time(),
+    }
+
+
+class ChannelIndex:
+    """
+    Последние метрики и вердикт каждого проанализированного канала в SQLite
+    со вторичными индексами (категория, язык, подписчики, ERR, цвет светофора).
+    Сравнение и рейтинги отвечают из индекса, без живого анализа.
+    """
+
+    def __init__(self, path: str = "channels.db"):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    # --- синхронная часть (выполняется в потоке) ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _rows(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        out = []
+        for row in rows:
+            item = dict(row)
+            item["signals"] = json.loads(item["signals"] or "[]")
+            out.append(item)
+        return out
+
+    def upsert(self, entry: Dict[str, Any]) -> None:
+        placeholders = ", ".join("?" for _ in _COLUMNS)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in _COLUMNS if c != "channel")
+        with self._lock:
+            self._connect().execute(
+                f"INSERT INTO channels ({', '.join(_COLUMNS)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(channel) DO UPDATE SET {updates}",
+                tuple(entry.get(c) for c in _COLUMNS),
+            )
+
+    def get_many(self, channels: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        keys = [c.lower() for c in channels]
+        if not keys:
+            return {}
+        rows = self._rows(f"SELECT * FROM channels WHERE channel IN ({', '.join('?' for _ in keys)})", tuple(keys))
+        return {row["channel"]: row for row in rows}
+
+    def top(self, category: str, limit: int = 10, lang: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Лучшие каналы категории: сначала зелёные, внутри цвета — по убыванию ERR (идёт по индексу)."""
+        sql = "SELECT * FROM channels WHERE category = ?"
+        params: tuple = (_fold(category),)
+        if lang:
+            sql += " AND lang = ?"
+            params += (_fold(lang),)
+        sql += " ORDER BY color_rank, err_pct DESC LIMIT ?"
+        return self._rows(sql, params + (int(limit),))
+
+    def categories(self, limit: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT category, COUNT(*) AS n FROM channels WHERE category IS NOT NULL "
+                "GROUP BY category ORDER BY n DESC LIMIT ?", (int(limit),)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # --- асинхронные обёртки ---
+
+    async def record(self, entry: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.upsert, entry)
+
+    async def lookup(self, channels: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        return await asyncio.to_thread(self.get_many, list(channels))
+
+    async def ranking(self, category: str, limit: int = 10, lang: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.top, category, limit, lang)
+
+    async def known_categories(self, limit: int = 20) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.categories, limit)
+
+
+RefreshFn = Callable[[str], Awaitable[Any]]
+
+
+class IndexRefresher:
+    """
+    Фоновое обновление устаревших записей индекса: каждая запись — не чаще одного
+    обновления одновременно, общее число параллельных обновлений ограничено.
+    """
+
+    def __init__(self, refresh_fn: RefreshFn, max_age: float = 24 * 3600, concurrency: int = 2):
+        self.refresh_fn = refresh_fn
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._inflight: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def is_stale(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["analyzed_at"] > self.max_age
+
+    def schedule(self, entries: Iterable[Dict[str, Any]]) -> List[str]:
+        """Ставит в фон обновление устаревших записей; возвращает каналы, которые будут обновлены."""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        scheduled = []
+        for entry in entries:
+            channel = entry["channel"]
+            if not self.is_stale(entry) or channel in self._inflight:
+                continue
+            self._inflight.add(channel)
+            task = asyncio.create_task(self._refresh(channel))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            scheduled.append(channel)
+        return scheduled
+
+    async def _refresh(self, channel: str) -> None:
+        try:
+            async with self._sem:
+                await self.refresh_fn(channel)
+        except Exception as e:
+            event_log.warning("channel_index_refresh_failed", channel=channel, error=str(e))
+        finally:
+            self._inflight.discard(channel)
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,180 @@
+# File: bot/services/event_log.py — буферизованный журнал: действия пользователей (CSV) и служебные события (JSONL)
+
+from __future__ import annotations
+import csv
+import io
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from bot.services.telemetry import current_trace
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+
+class EventLogger:
+    """
+    Запись в память (кольцевой буфер) и пакетный сброс на диск фоновым потоком.
+    user_log.csv сохраняет прежний формат: timestamp, user_id, username, action, data.
+    Служебные события — JSON-строки с уровнем в отдельном файле.
+    Оба файла ротируются по размеру и по времени. Ротацию никто не согласует между процессами,
+    поэтому у каждого процесса должны быть свои файлы (spawn_workers даёт воркерам свои пути).
+    """
+
+    def __init__(self, csv_path: str = "user_log.csv", log_path: str = "app_log.jsonl", level: str = "INFO",
+                 buffer_size: int = 100_000, flush_interval: float = 1.0, batch_size: int = 1000,
+                 max_bytes: int = 50 * 1024 * 1024, rotate_interval: float = 24 * 3600,
+                 payload_sample: float = 0.0, echo: bool = False):
+        self.csv_path = csv_path
+        self.log_path = log_path
+        self.level = LEVELS.get(level.upper(), 20)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.payload_sample = payload_sample
+        self.echo = echo
+        # (файл, строка); при переполнении вытесняются самые старые записи
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # После stop() записи отбрасываются: поток записи сам по себе больше не поднимается
+        self._closed = False
+        self._opened_at: Dict[str, float] = {}
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "EventLogger":
+        return cls(
+            csv_path=os.getenv("USER_LOG_PATH", "user_log.csv"),
+            log_path=os.getenv("APP_LOG_PATH", "app_log.jsonl"),
+            level=os.getenv("LOG_LEVEL", "INFO"),
+            flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", "1")),
+            max_bytes=int(os.getenv("LOG_MAX_MB", "50")) * 1024 * 1024,
+            rotate_interval=float(os.getenv("LOG_ROTATE_HOURS", "24")) * 3600,
+            payload_sample=float(os.getenv("LOG_PAYLOAD_SAMPLE", "0")),
+            echo=os.getenv("LOG_ECHO", "0") == "1",
+        )
+
+    # --- запись (потокобезопасно, без дискового I/O) ---
+
+    def _push(self, path: str, line: str) -> None:
+        if self._closed:
+            self.dropped += 1
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((path, line))
+        if self._thread is None:
+            self.start()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def user_action(self, user_id, username, action, data) -> None:
+        """Строка user_log.csv в прежнем формате."""
+        buf = io.StringIO()
+        csv.writer(buf).writerow([datetime.now().isoformat(), user_id, username, action, data])
+        self._push(self.csv_path, buf.getvalue())
+
+    def log(self, level: str, event: str, **fields) -> None:
+        lvl = LEVELS.get(level, 20)
+        if lvl < self.level:
+            return
+        record = {"ts": datetime.now().isoformat(timespec="milliseconds"), "level": level, "event": event}
+        trace_id = current_trace()
+        if trace_id:
+            record["trace_id"] = trace_id
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        if self.echo:
+            print(line)
+        self._push(self.log_path, line + "\n")
+
+    def debug(self, event: str, **fields) -> None:
+        self.log("DEBUG", event, **fields)
+
+    def info(self, event: str, **fields) -> None:
+        self.log("INFO", event, **fields)
+
+    def warning(self, event: str, **fields) -> None:
+        self.log("WARNING", event, **fields)
+
+    def error(self, event: str, **fields) -> None:
+        self.log("ERROR", event, **fields)
+
+    def payload(self, event: str, data: Any, **fields) -> None:
+        """Полный дамп данных — только для доли запросов payload_sample (по умолчанию выключено)."""
+        if self.payload_sample > 0 and random.random() < self.payload_sample:
+            self.log("DEBUG", event, payload=data, **fields)
+
+    # --- фоновый сброс ---
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._closed = False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="event-log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает поток записи и сбрасывает остаток буфера; дальнейшие записи отбрасываются."""
+        self._closed = True
+        if self._thread is None:
+            self.flush()
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[event_log] flush failed: {e}")
+
+    def flush(self) -> None:
+        batch: Dict[str, List[str]] = {}
+        while True:
+            try:
+                path, line = self._buffer.popleft()
+            except IndexError:
+                break
+            batch.setdefault(path, []).append(line)
+        for path, lines in batch.items():
+            self._maybe_rotate(path)
+            with open(path, "a", newline="", encoding="utf-8") as f:
+                f.write("".join(lines))
+
+    def _maybe_rotate(self, path: str) -> None:
+        now = time.time()
+        opened = self._opened_at.setdefault(path, now)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if size >= self.max_bytes or (size and now - opened >= self.rotate_interval):
+            base, ext = os.path.splitext(path)
+            target = f"{base}.{datetime.now():%Y%m%d-%H%M%S}{ext}"
+            n = 1
+            while os.path.exists(target):
+                target = f"{base}.{datetime.now():%Y%m%d-%H%M%S}-{n}{ext}"
+                n += 1
+            os.replace(path, target)
+            self._opened_at[path] = now
+
+
+event_log = EventLogger.from_env()
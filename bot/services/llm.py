@@ -0,0 +1,148 @@
+# File: bot/services/llm.py — асинхронный клиент OpenAI: общий пул соединений, ретраи, дедлайн, стриминг
+
+from __future__ import annotations
+import asyncio
+import os
+import random
+import re
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Tuple
+
+import openai
+
+from bot.services.quota import quota
+
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))        # жёсткий дедлайн на весь ответ, с ретраями
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "10"))
+# Другой адрес API (прокси, локальный стенд бенчмарка); пусто — api.openai.com
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Блок traffic_light выделяется из недописанного JSON, как только в нём появился цвет
+_TRAFFIC_RE = re.compile(r'"traffic_light"\s*:\s*\{(?P<body>[^{}]*)')
+_COLOR_RE = re.compile(r'"color"\s*:\s*"(?P<v>[a-z]+)"')
+_REC_RE = re.compile(r'"recommendation"\s*:\s*"(?P<v>(?:[^"\\]|\\.)*)"')
+
+PartialCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+_client: Optional[openai.AsyncOpenAI] = None
+
+
+def get_client(api_key: Optional[str] = None) -> openai.AsyncOpenAI:
+    """Общий AsyncOpenAI с keep-alive; встроенные ретраи отключены — ими управляет complete()."""
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, max_retries=0, timeout=OPENAI_TIMEOUT)
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def _retry_delay(attempt: int, error: Exception) -> Optional[float]:
+    """Пауза перед повтором или None, если ошибку повторять бессмысленно."""
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        retry_after = None
+    elif isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500):
+        retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+    else:
+        return None
+    if retry_after:
+        try:
+            return min(float(retry_after), OPENAI_BACKOFF_MAX)
+        except ValueError:
+            pass
+    # Экспоненциальная задержка с полным джиттером
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+
+def extract_traffic_light(partial: str) -> Optional[Dict[str, Any]]:
+    """Светофор из частично полученного JSON-ответа (или None, пока блок ещё не готов)."""
+    m = _TRAFFIC_RE.search(partial)
+    if not m:
+        return None
+    color = _COLOR_RE.search(m.group("body"))
+    if not color:
+        return None
+    rec = _REC_RE.search(m.group("body"))
+    closed = partial[m.end():m.end() + 1] == "}"
+    if not rec and not closed:
+        # Рекомендация может прийти следующим чанком — ждём её или закрытия блока
+        return None
+    return {"color": color.group("v"), "recommendation": rec.group("v") if rec else None}
+
+
+async def _stream_once(client, on_partial: Optional[PartialCallback], **kwargs) -> Tuple[str, Any]:
+    parts: List[str] = []
+    usage = None
+    announced = False
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        if on_partial and not announced:
+            light = extract_traffic_light("".join(parts))
+            if light:
+                announced = True
+                try:
+                    await on_partial(light)
+                except Exception:
+                    pass
+    return "".join(parts), usage
+
+
+async def _complete_once(client, **kwargs) -> Tuple[str, Any]:
+    response = await client.chat.completions.create(**kwargs)
+    return response.choices[0].message.content or "", getattr(response, "usage", None)
+
+
+async def complete(messages: List[Dict[str, str]], model: str, max_tokens: int, temperature: float = 0.1,
+                   stream: bool = False, on_partial: Optional[PartialCallback] = None,
+                   api_key: Optional[str] = None, deadline: Optional[float] = None,
+                   cost_tokens: Optional[int] = None) -> Tuple[str, Any]:
+    """
+    Запрос chat.completions с повторами на 429/5xx/сетевые ошибки и общим дедлайном.
+    Каждая попытка сначала получает квоту токенов (cost_tokens — оценка промпта и ответа);
+    Retry-After на 429 блокирует квоту для всех запросов, а не только для этого.
+    В режиме stream on_partial вызывается один раз — как только в ответе появился traffic_light.
+    Возвращает (текст ответа, usage).
+    """
+    client = get_client(api_key)
+    kwargs = dict(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature)
+    if cost_tokens is None:
+        cost_tokens = sum(len(m.get("content") or "") for m in messages) // 3 + max_tokens
+
+    async def attempt_loop():
+        attempt = 0
+        while True:
+            if attempt:
+                await quota.acquire("openai", cost_tokens)
+            try:
+                if stream:
+                    return await _stream_once(client, on_partial, **kwargs)
+                return await _complete_once(client, **kwargs)
+            except Exception as e:
+                delay = _retry_delay(attempt, e)
+                if delay is None or attempt >= OPENAI_RETRIES:
+                    raise
+                if isinstance(e, openai.APIStatusError) and e.status_code == 429:
+                    quota.penalize("openai", delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    # Ожидание первой квоты не входит в дедлайн ответа
+    await quota.acquire("openai", cost_tokens)
+    text, usage = await asyncio.wait_for(attempt_loop(), deadline or OPENAI_TIMEOUT)
+    if usage is not None and getattr(usage, "total_tokens", None):
+        quota.refund("openai", cost_tokens - usage.total_tokens)
+    return text, usage
@@ -1,14 +1,250 @@
-# File: bot/services/parser_adapter.py — адаптер для вызова парсера из бота
+# File: bot/services/parser_adapter.py — адаптер источников данных: реестр плагинов, параллельный сбор и слияние
 
 from __future__ import annotations
-from typing import Dict
-from parser_core import collect_channel_data
+import asyncio
+import importlib
+import json
+import os
+import time
+from typing import Dict, Any, Awaitable, Callable, Iterable, List, Optional
 
+from parser_core import normalize_username
+from bot.services.quota import QuotaExceeded, quota
+from bot.services.telemetry import telemetry
 
-def fetch_channel_summary(link_or_username: str) -> Dict:
+# Сколько ошибок подряд переводит источник в «нездоровые» и на сколько секунд он выключается
+SOURCE_FAILURE_THRESHOLD = int(os.getenv("SOURCE_FAILURE_THRESHOLD", "3"))
+SOURCE_COOLDOWN = float(os.getenv("SOURCE_COOLDOWN", "60"))
+
+
+class SourceEntry:
+    """
+    Запись реестра: плагин импортируется при первом обращении (target — "модуль:класс"),
+    у каждого свой таймаут и состояние здоровья.
+    Плагин: name, enabled(), async fetch(link), error(data), cacheable(data), merge(unified, data)
+    и необязательный quota_cost = (апстрим, стоимость) — квота, резервируемая до начала таймаута.
+    """
+
+    def __init__(self, name: str, target: str, timeout: float, required: bool = False, interactive: bool = True):
+        self.name = name
+        self.target = target
+        self.timeout = timeout
+        # Без обязательного источника анализ неполон: ошибка попадает в meta.error итоговых данных
+        self.required = required
+        # Неинтерактивный источник (долгий, фоновый) в сбор по умолчанию не входит — только по имени
+        self.interactive = interactive
+        self._plugin = None
+        self.load_error: Optional[str] = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error: Optional[str] = None
+        self.last_ok: Optional[float] = None
+
+    @property
+    def plugin(self):
+        if self._plugin is None and self.load_error is None:
+            module_name, _, attr = self.target.partition(":")
+            try:
+                self._plugin = getattr(importlib.import_module(module_name), attr)()
+            except Exception as e:
+                self.load_error = f"plugin load failed: {e}"
+        return self._plugin
+
+    def unavailable(self) -> Optional[str]:
+        """Причина, по которой источник сейчас не опрашивается (None — опрашивать)."""
+        if self.plugin is None:
+            return self.load_error
+        if not self.plugin.enabled():
+            return "disabled"
+        if self.down_until > time.monotonic():
+            return f"unhealthy after {self.failures} failures: {self.last_error}"
+        return None
+
+    def record(self, error: Optional[str]) -> None:
+        if error is None:
+            self.failures = 0
+            self.down_until = 0.0
+            self.last_ok = time.time()
+            return
+        self.failures += 1
+        self.last_error = error
+        if self.failures >= SOURCE_FAILURE_THRESHOLD:
+            # После паузы источник снова получит один пробный запрос
+            self.down_until = time.monotonic() + SOURCE_COOLDOWN
+
+    async def fetch(self, link: str) -> Dict[str, Any]:
+        """
+        Вызов плагина под таймаутом источника. Квота quota_cost резервируется до запуска таймаута,
+        а ожидание квоты внутри fetch ограничено таймаутом: очередь к апстриму заканчивается
+        QuotaExceeded, а не «timeout» в здоровье источника.
+        Здоровье источника обновляет только этот (настоящий) вызов — ответ из кэша его не трогает.
+        """
+        plugin = self.plugin
+        cost = getattr(plugin, "quota_cost", None)
+        if cost:
+            await quota.acquire(*cost)
+        max_wait = quota.current_max_wait()
+        max_wait = self.timeout if max_wait is None else min(max_wait, self.timeout)
+        try:
+            with quota.scope(quota.current_priority(), max_wait):
+                data = await asyncio.wait_for(plugin.fetch(link), self.timeout)
+        except asyncio.TimeoutError:
+            self.record(f"timeout after {self.timeout}s")
+            raise
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            self.record(f"{type(e).__name__}: {e}")
+            raise
+        self.record(plugin.error(data))
+        return data
+
+    def health(self) -> Dict[str, Any]:
+        reason = self.unavailable()
+        return {
+            "healthy": reason is None,
+            "reason": reason,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_ok": self.last_ok,
+            "timeout": self.timeout,
+        }
+
+
+_registry: Dict[str, SourceEntry] = {}
+
+# call(entry, link) — как именно вызывать entry.fetch (например, через кэш бота)
+SourceCall = Callable[[SourceEntry, str], Awaitable[Dict[str, Any]]]
+
+
+def register_source(name: str, target: str, timeout: float, required: bool = False,
+                    interactive: bool = True) -> SourceEntry:
+    """Добавляет (или заменяет) источник в реестре. Импорт модуля плагина — при первом сборе."""
+    _registry[name] = SourceEntry(name, target, timeout, required, interactive)
+    return _registry[name]
+
+
+def get_source(name: str) -> SourceEntry:
+    return _registry[name]
+
+
+def source_health() -> Dict[str, Dict[str, Any]]:
+    return {name: entry.health() for name, entry in _registry.items()}
+
+
+def default_sources(background: bool = False) -> List[str]:
     """
-    Тонкий адаптер между ботом и парсером.
-    Бот вызывает ЭТУ функцию, внутри она обращается к parser_core.
-    Позже мы сможем заменить реализацию (добавить Telethon/скрейп) без изменений в боте.
+    Источники сбора по умолчанию (DATA_SOURCES или весь реестр). Неинтерактивные (deep) входят
+    только в фоновый и пакетный сбор: анализ по запросу пользователя не ждёт их длинный таймаут.
     """
-    return collect_channel_data(link_or_username)
+    configured = os.getenv("DATA_SOURCES")
+    names = [n.strip() for n in configured.split(",")] if configured else list(_registry)
+    return [n for n in names if n in _registry and (background or _registry[n].interactive)]
+
+
+def _skeleton(link_or_username: str) -> Dict[str, Any]:
+    """Единая схема данных канала (как у parser_core) плюс sources и missing."""
+    return {
+        "channel": {"username": normalize_username(link_or_username)},
+        "stats": {},
+        "time_series": {},
+        "posts": [],
+        "mentions": [],
+        "forwards": [],
+        "adposts": [],
+        "meta": {"source": "parser_adapter"},
+        "sources": {},
+        "missing": {},
+    }
+
+
+async def _direct_call(entry: SourceEntry, link: str) -> Dict[str, Any]:
+    return await entry.fetch(link)
+
+
+async def _fetch_one(entry: SourceEntry, link: str, call: SourceCall) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    # Здоровье записывает entry.fetch; здесь — только причина для missing (в том числе у ответа из кэша)
+    try:
+        data = await call(entry, link)
+        error = entry.plugin.error(data)
+    except asyncio.TimeoutError:
+        data, error = None, f"timeout after {entry.timeout}s"
+    except QuotaExceeded:
+        # Квота — не поломка источника: решение за вызывающим
+        raise
+    except Exception as e:
+        data, error = None, f"{type(e).__name__}: {e}"
+    telemetry.observe("stage_seconds", f"source:{entry.name}", time.perf_counter() - t0, error=error is not None)
+    if data is not None:
+        telemetry.observe("payload_bytes", entry.name, len(json.dumps(data, ensure_ascii=False, default=str)))
+    return {"data": data, "error": error}
+
+
+async def fetch_channel_summary(link_or_username: str, names: Optional[Iterable[str]] = None,
+                                call: Optional[SourceCall] = None) -> Dict[str, Any]:
+    """
+    Опрашивает источники параллельно (по умолчанию — интерактивные, default_sources) и сливает ответы в единую схему.
+    Общее время — время самого медленного источника (каждый ограничен своим таймаутом).
+    Недоступный источник не роняет сбор: его причина — в missing[имя].
+    QuotaExceeded обязательного источника пробрасывается, чтобы бот предложил зайти позже.
+    """
+    if not link_or_username:
+        raise ValueError("Укажи ссылку на канал или @username")
+    unified = _skeleton(link_or_username)
+    call = call or _direct_call
+
+    active: List[SourceEntry] = []
+    for name in (list(names) if names is not None else default_sources()):
+        entry = _registry[name]
+        reason = entry.unavailable()
+        if reason:
+            unified["missing"][name] = reason
+        else:
+            active.append(entry)
+
+    results = await asyncio.gather(*(_fetch_one(e, link_or_username, call) for e in active), return_exceptions=True)
+    for entry, result in zip(active, results):
+        if isinstance(result, QuotaExceeded):
+            if entry.required:
+                raise result
+            unified["missing"][entry.name] = str(result)
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        if result["error"]:
+            unified["missing"][entry.name] = result["error"]
+        if result["data"] is not None:
+            entry.plugin.merge(unified, result["data"])
+
+    for name, reason in unified["missing"].items():
+        if name in _registry and _registry[name].required:
+            unified["meta"].setdefault("error", f"{name}: {reason}")
+    return unified
+
+
+def source_data(unified: Dict[str, Any], name: str) -> Dict[str, Any]:
+    """Сырые данные источника из sources или маркер {"skipped"/"error": причина}, если его нет."""
+    data = unified.get("sources", {}).get(name)
+    if data is not None:
+        return data
+    reason = unified.get("missing", {}).get(name)
+    if reason == "disabled" or reason is None:
+        return {"skipped": f"{name} source is disabled"}
+    return {"error": reason}
+
+
+def _health_gauges() -> Dict[str, float]:
+    return {f"source_{name}_healthy": int(entry.unavailable() is None) for name, entry in _registry.items()
+            if entry._plugin is not None}
+
+
+telemetry.add_collector(_health_gauges)
+
+# Встроенные источники; новые подключаются register_source и перечисляются в DATA_SOURCES
+register_source("telegram", "bot.services.sources:TelegramSource",
+                timeout=float(os.getenv("SOURCE_TIMEOUT_TELEGRAM", "45")), required=True)
+register_source("tgstat", "bot.services.sources:TGStatSource",
+                timeout=float(os.getenv("SOURCE_TIMEOUT_TGSTAT", "25")))
+register_source("deep", "bot.services.sources:DeepScanSource",
+                timeout=float(os.getenv("SOURCE_TIMEOUT_DEEP", "180")), interactive=False)
@@ -0,0 +1,132 @@
+# File: bot/services/prompt_builder.py — сборка промпта для ИИ с ограничением по токенам
+
+from __future__ import annotations
+import json
+from typing import Dict, Any, List, Optional, Tuple
+
+from parser_core import compute_channel_metrics
+
+# tiktoken — необязательная зависимость; без него считаем токены приближённо
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+SYSTEM_ROLE = "Ты — эксперт по анализу Telegram-каналов."
+DATA_HEADER = "Данные канала (метрики parser_core + TGStat, если доступен):\n"
+EXCERPT_CHARS = 160     # длина выдержки текста поста
+TOP_POSTS = 10          # сколько постов с выдержками попадает в промпт при достаточном бюджете
+
+
+def count_tokens(text: str) -> int:
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    # Кириллица в cl100k_base — примерно 3 символа на токен
+    return max(1, len(text) // 3)
+
+
+def dumps_compact(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _excerpt(text: Optional[str], limit: int = EXCERPT_CHARS) -> Optional[str]:
+    if not text:
+        return None
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+def _tgstat_items(block: Any) -> Optional[List[Any]]:
+    """Список элементов из ответа TGStat (response/result, в т.ч. вложенный items)."""
+    if not isinstance(block, dict):
+        return None
+    data = block.get("response", block.get("result"))
+    if isinstance(data, dict):
+        data = data.get("items")
+    return data if isinstance(data, list) else None
+
+
+def _sections(parser_data: Dict[str, Any], tgstat_data: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    """Блоки промпта в порядке убывания важности для метода TNG."""
+    channel = dict(parser_data.get("channel") or {})
+    channel["about"] = _excerpt(channel.get("about"), 300)
+    channel.pop("avatar_url", None)
+
+    posts = [p for p in parser_data.get("posts") or [] if p.get("views") is not None]
+    posts.sort(key=lambda p: p.get("views") or 0, reverse=True)
+    top_posts = [
+        {
+            "id": p.get("id"),
+            "date": p.get("date"),
+            "views": p.get("views"),
+            "forwards": p.get("forwards"),
+            "reactions": p.get("reactions_total"),
+            "text": _excerpt(p.get("message")),
+        }
+        for p in posts[:TOP_POSTS]
+    ]
+
+    errors = {
+        "parser_core": (parser_data.get("meta") or {}).get("error"),
+        "tgstat": tgstat_data.get("error") or tgstat_data.get("skipped"),
+    }
+    sections: List[Tuple[str, Any]] = [
+        ("metrics", compute_channel_metrics(parser_data, tgstat_data)),
+        ("channel", {k: v for k, v in channel.items() if v is not None}),
+        ("errors", {k: v for k, v in errors.items() if v}),
+        # Агрегаты глубокого скана истории (если включён); недельный ряд укорачивается по бюджету
+        ("deep_scan", {k: v for k, v in (parser_data.get("deep_scan") or {}).items() if k != "weekly"}),
+    ]
+    # Упоминания, пересылки и реклама нужны ИИ для блоков 3, 4 и 6 метода TNG
+    for key in ("mentions", "adposts", "forwards"):
+        items = _tgstat_items(tgstat_data.get(key))
+        if items:
+            sections.append((key, items))
+    sections.append(("top_posts", top_posts))
+    sections.append(("deep_scan_weekly", (parser_data.get("deep_scan") or {}).get("weekly")))
+    return sections
+
+
+def build_payload(parser_data: Dict[str, Any], tgstat_data: Dict[str, Any], budget_tokens: int) -> Dict[str, Any]:
+    """
+    Собирает компактный payload, укладывающийся в budget_tokens.
+    Блоки добавляются по важности; списки укорачиваются вдвое, пока не влезут; не влезшие блоки отбрасываются
+    и перечисляются в "truncated", чтобы ИИ мог пометить их как missing.
+    """
+    payload: Dict[str, Any] = {}
+    truncated: List[str] = []
+    used = 2
+    for name, value in _sections(parser_data, tgstat_data):
+        if not value:
+            continue
+        while True:
+            cost = count_tokens(dumps_compact({name: value}))
+            if used + cost <= budget_tokens:
+                payload[name] = value
+                used += cost
+                break
+            if isinstance(value, list) and len(value) > 1:
+                value = value[: len(value) // 2]
+                if name not in truncated:
+                    truncated.append(name)
+                continue
+            truncated.append(name)
+            break
+    if truncated:
+        payload["truncated"] = sorted(set(truncated))
+    return payload
+
+
+def build_messages(base_prompt: str, payload: Dict[str, Any]) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Сообщения для chat.completions и оценка числа токенов промпта.
+    BASE_PROMPT целиком в system — неизменный префикс, который провайдер может кэшировать между запросами.
+    """
+    system = SYSTEM_ROLE + "\n\n" + base_prompt
+    user = DATA_HEADER + dumps_compact(payload)
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+    return messages, count_tokens(system) + count_tokens(user)
@@ -0,0 +1,267 @@
+# File: bot/services/quota.py — общие квоты апстримов (Telegram, TGStat, OpenAI) и приоритетная очередь запросов
+
+from __future__ import annotations
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from bot.services.telemetry import telemetry
+
+# Меньше — раньше. Платные пользователи впереди пробных, интерактивные запросы — впереди пакетных и фоновых
+PRIORITY_PAID = 0
+PRIORITY_TRIAL = 1
+PRIORITY_BATCH = 2
+PRIORITY_BACKGROUND = 3
+
+PRIORITY_NAMES = {PRIORITY_PAID: "paid", PRIORITY_TRIAL: "trial", PRIORITY_BATCH: "batch", PRIORITY_BACKGROUND: "background"}
+
+# (приоритет, предельное ожидание квоты) текущей задачи; наследуется дочерними задачами asyncio
+_scope_var: contextvars.ContextVar[Tuple[int, Optional[float]]] = contextvars.ContextVar(
+    "quota_scope", default=(PRIORITY_TRIAL, None))
+
+
+class QuotaExceeded(Exception):
+    """Квота апстрима освободится позже, чем вызывающий готов ждать."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} quota exhausted, retry in {retry_after:.0f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Классическое ведро токенов: rate токенов в секунду, не больше burst.
+    Токены могут уйти в минус (списание по фактическому расходу) — долг гасится пополнением.
+    rate <= 0 — без ограничения.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        if self.rate <= 0:
+            return float("inf")
+        self._refill()
+        return self.tokens
+
+    def wait_time(self, cost: float) -> float:
+        """Через сколько секунд хватит токенов на cost (запросы дороже burst ждут полного ведра)."""
+        if self.rate <= 0:
+            return 0.0
+        need = min(cost, self.burst) - self.available()
+        return need / self.rate if need > 0 else 0.0
+
+    def take(self, cost: float) -> None:
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= cost
+
+    def give(self, tokens: float) -> None:
+        if self.rate > 0:
+            self._refill()
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+
+class Upstream:
+    """
+    Квота одного апстрима: ведро токенов, блокировка по FloodWait/Retry-After
+    и очередь ожидающих, которая обслуживается строго по приоритету.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.blocked_until = 0.0
+        self.granted = 0
+        self.rejected = 0
+        # (приоритет, порядковый номер, стоимость, future)
+        self._waiters: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def blocked_for(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def estimate_wait(self, cost: float = 1, priority: int = PRIORITY_TRIAL) -> float:
+        """Сколько примерно ждать запросу с таким приоритетом: очередь не ниже его приоритета + сам запрос."""
+        ahead = sum(c for p, _, c, f in self._waiters if p <= priority and not f.done())
+        wait = 0.0
+        if self.bucket.rate > 0:
+            need = ahead + min(cost, self.bucket.burst) - self.bucket.available()
+            wait = need / self.bucket.rate if need > 0 else 0.0
+        return max(wait, self.blocked_for())
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self._kick()
+
+    async def acquire(self, cost: float, priority: int, max_wait: Optional[float]) -> float:
+        """Ждёт своей очереди и списывает cost токенов. Возвращает время ожидания в секундах."""
+        if not self._waiters and self.blocked_for() == 0 and self.bucket.wait_time(cost) == 0:
+            self.bucket.take(cost)
+            self.granted += 1
+            return 0.0
+        if max_wait is not None:
+            estimate = self.estimate_wait(cost, priority)
+            if estimate > max_wait:
+                self.rejected += 1
+                raise QuotaExceeded(self.name, estimate)
+        t0 = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), cost, fut))
+        self._kick()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Диспетчер пропускает завершённые future; токены не списаны
+            fut.cancel()
+            raise
+        self.granted += 1
+        return time.monotonic() - t0
+
+    def _kick(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._waiters and (self._task is None or self._task.done()):
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            _, _, cost, fut = self._waiters[0]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = max(self.blocked_for(), self.bucket.wait_time(cost))
+            if wait <= 0:
+                heapq.heappop(self._waiters)
+                self.bucket.take(cost)
+                fut.set_result(None)
+                continue
+            # Просыпаемся раньше, если пришёл более приоритетный запрос или сняли блокировку
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "waiters": sum(1 for *_, f in self._waiters if not f.done()),
+            "blocked_s": round(self.blocked_for(), 1),
+            "granted": self.granted,
+            "rejected": self.rejected,
+        }
+
+
+class QuotaManager:
+    """
+    Единая точка согласования квот: каждый вызов внешнего API сначала получает
+    разрешение у своего апстрима. FloodWait и Retry-After блокируют апстрим для всех,
+    поэтому всплеск не превращается в шквал ошибок и повторов.
+    """
+
+    def __init__(self):
+        self.upstreams: Dict[str, Upstream] = {}
+
+    @classmethod
+    def from_env(cls) -> "QuotaManager":
+        manager = cls()
+        # Лимиты заданы на весь бот; при N процессах-воркерах каждый получает свою долю
+        share = max(int(os.getenv("QUOTA_WORKERS", "1")), 1)
+        # Telegram: стоимость — число вызовов API; TGStat — запросы; OpenAI — токены в минуту
+        manager.configure("telegram", float(os.getenv("QUOTA_TELEGRAM_RPS", "2")) / share,
+                          float(os.getenv("QUOTA_TELEGRAM_BURST", "20")) / share)
+        manager.configure("tgstat", float(os.getenv("QUOTA_TGSTAT_RPS", "20")) / share,
+                          float(os.getenv("QUOTA_TGSTAT_BURST", "60")) / share)
+        tpm = float(os.getenv("OPENAI_TPM", "0")) / share
+        manager.configure("openai", tpm / 60, tpm)
+        return manager
+
+    def configure(self, name: str, rate: float, burst: float) -> Upstream:
+        self.upstreams[name] = Upstream(name, rate, burst)
+        return self.upstreams[name]
+
+    def _get(self, name: str) -> Upstream:
+        upstream = self.upstreams.get(name)
+        if upstream is None:
+            upstream = self.configure(name, 0, 1)  # неизвестный апстрим — без лимита, но с учётом блокировок
+        return upstream
+
+    @contextmanager
+    def scope(self, priority: int, max_wait: Optional[float] = None) -> Iterator[None]:
+        """Приоритет и предельное ожидание для всех вызовов внутри блока (и порождённых задач)."""
+        token = _scope_var.set((priority, max_wait))
+        try:
+            yield
+        finally:
+            _scope_var.reset(token)
+
+    @staticmethod
+    def current_priority() -> int:
+        return _scope_var.get()[0]
+
+    @staticmethod
+    def current_max_wait() -> Optional[float]:
+        return _scope_var.get()[1]
+
+    async def acquire(self, name: str, cost: float = 1, priority: Optional[int] = None,
+                      max_wait: Optional[float] = None) -> float:
+        """
+        Разрешение на вызов апстрима. Приоритет и max_wait по умолчанию берутся из scope().
+        Если ждать дольше max_wait — QuotaExceeded с оценкой времени, вместо тихого ожидания.
+        """
+        scope_priority, scope_wait = _scope_var.get()
+        priority = scope_priority if priority is None else priority
+        max_wait = scope_wait if max_wait is None else max_wait
+        try:
+            waited = await self._get(name).acquire(cost, priority, max_wait)
+        except QuotaExceeded:
+            telemetry.incr("quota_rejected", name)
+            raise
+        telemetry.observe("quota_wait_seconds", f"{name}:{PRIORITY_NAMES.get(priority, priority)}", waited)
+        return waited
+
+    def penalize(self, name: str, retry_after: float) -> None:
+        """Апстрим попросил подождать (FloodWait, 429 Retry-After) — блокируем его для всех вызовов."""
+        if retry_after and retry_after > 0:
+            self._get(name).block(retry_after)
+            telemetry.incr("quota_penalty", name)
+
+    def refund(self, name: str, tokens: float) -> None:
+        """Поправка на фактический расход: вернуть (или при tokens < 0 — дополнительно списать) токены."""
+        upstream = self._get(name)
+        if tokens > 0:
+            upstream.bucket.give(tokens)
+        elif tokens < 0:
+            upstream.bucket.take(-tokens)
+
+    def estimate_wait(self, name: str, cost: float = 1, priority: Optional[int] = None) -> float:
+        return self._get(name).estimate_wait(cost, self.current_priority() if priority is None else priority)
+
+    def gauges(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for name, upstream in self.upstreams.items():
+            s = upstream.stats()
+            out[f"quota_{name}_waiters"] = s["waiters"]
+            out[f"quota_{name}_blocked_s"] = s["blocked_s"]
+        return out
+
+
+quota = QuotaManager.from_env()
+telemetry.add_collector(quota.gauges)
@@ -0,0 +1,425 @@
+# File: bot/services/shared_state.py — общее состояние воркеров: очередь апдейтов, анализы в работе, флаги пользователей
+
+from __future__ import annotations
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Any, Iterable, List, Optional, Set, Tuple
+
+from bot.services.user_store import UserStore
+
+# Апдейт, взятый воркером: (update_id, JSON апдейта Telegram, время приёма)
+ClaimedUpdate = Tuple[int, Dict[str, Any], float]
+# Анализ, подхваченный у упавшего воркера: analysis_id, user_id, link, payload, attempts
+AdoptedAnalysis = Dict[str, Any]
+
+
+class SharedState(ABC):
+    """
+    Интерфейс состояния, которое делят процессы бота (приёмник webhook и воркеры).
+    Воркеры сами ничего не хранят: пользователи (верификация, пробные анализы, подписка) — в users,
+    кэш этапов — в дисковом уровне AnalysisCache (у воркеров он включён всегда: CACHE_DISK_PATH
+    или cache.db), остальное — здесь.
+
+    Гарантии, на которые опираются воркеры:
+    - enqueue идемпотентен по update_id (повторная доставка Telegram не обрабатывается дважды);
+    - claim выдаёт апдейты пользователя строго по порядку и не больше одного одновременно;
+    - апдейт, не подтверждённый до истечения аренды, снова становится доступен (воркер упал);
+      живой воркер продлевает аренду (extend), пока обрабатывает апдейт;
+    - принятый анализ живёт здесь до end_analysis: анализ без heartbeat забирает adopt_analyses другого воркера.
+    """
+
+    users: UserStore
+
+    @abstractmethod
+    async def open(self) -> None:
+        ...
+
+    @abstractmethod
+    def close(self) -> None:
+        ...
+
+    # --- очередь апдейтов ---
+
+    @abstractmethod
+    async def enqueue(self, update_id: int, user_id: Optional[int], payload: Dict[str, Any]) -> bool:
+        """Ставит апдейт в очередь; False — такой update_id уже был."""
+
+    @abstractmethod
+    async def claim(self, worker: str, lease: float) -> Optional[ClaimedUpdate]:
+        ...
+
+    @abstractmethod
+    async def extend(self, update_id: int, worker: str, lease: float) -> bool:
+        """Продлевает аренду апдейта ещё на lease секунд; False — аренда уже у другого воркера."""
+
+    @abstractmethod
+    async def ack(self, update_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def fail(self, update_id: int, error: str) -> None:
+        ...
+
+    @abstractmethod
+    async def pending(self) -> int:
+        ...
+
+    @abstractmethod
+    async def purge(self, older_than: float) -> int:
+        """Забывает обработанные апдейты старше older_than секунд (окно защиты от повторной доставки)."""
+
+    # --- анализы в работе (лимит на пользователя и отмена через любой воркер) ---
+
+    @abstractmethod
+    async def begin_analysis(self, user_id: int, worker: str, link: str, limit: int,
+                             payload: Optional[Dict[str, Any]] = None, update_id: Optional[int] = None) -> Optional[int]:
+        """
+        Регистрирует анализ; None — у пользователя уже limit анализов в работе.
+        payload — всё, что нужно другому воркеру, чтобы довести анализ до отчёта (чат, приоритет).
+        """
+
+    @abstractmethod
+    async def analysis_for_update(self, update_id: int) -> Optional[int]:
+        """Анализ, уже принятый по этому апдейту (апдейт обрабатывается повторно после падения воркера)."""
+
+    @abstractmethod
+    async def end_analysis(self, analysis_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def heartbeat(self, worker: str, alive: Iterable[int]) -> Set[int]:
+        """Продлевает анализы воркера, забывает завершённые; возвращает id, которые просили отменить."""
+
+    @abstractmethod
+    async def adopt_analyses(self, worker: str, limit: int) -> List[AdoptedAnalysis]:
+        """Забирает до limit анализов, чей воркер перестал слать heartbeat (упал или остановлен)."""
+
+    @abstractmethod
+    async def release_analyses(self, worker: str, analysis_ids: Optional[Iterable[int]] = None) -> None:
+        """Отдаёт анализы воркера (все или перечисленные) другим воркерам сразу, не дожидаясь stale_after."""
+
+    @abstractmethod
+    async def cancel_analyses(self, user_id: int) -> int:
+        ...
+
+    # --- короткоживущие флаги диалога (вместо context.user_data, которое живёт в одном процессе) ---
+
+    @abstractmethod
+    async def set_flag(self, user_id: int, name: str, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def pop_flag(self, user_id: int, name: str) -> bool:
+        ...
+
+    async def charge_trial(self, user_id: int, username: Optional[str], update_id: int) -> int:
+        """Списывает пробный анализ один раз на апдейт, даже если апдейт обработан повторно."""
+        return await self.users.add_trial(user_id, username, charge_key=f"update:{update_id}")
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    update_id INTEGER PRIMARY KEY,
+    user_id INTEGER,                         -- ключ упорядочивания (NULL — апдейт без пользователя)
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | leased | done | failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    received_at REAL NOT NULL,
+    done_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS updates_open ON updates (update_id) WHERE status IN ('pending', 'leased');
+CREATE INDEX IF NOT EXISTS updates_open_user ON updates (user_id, update_id) WHERE status IN ('pending', 'leased');
+CREATE INDEX IF NOT EXISTS updates_done ON updates (done_at) WHERE status IN ('done', 'failed');
+CREATE TABLE IF NOT EXISTS analyses (
+    analysis_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    worker TEXT NOT NULL,
+    link TEXT,
+    started_at REAL NOT NULL,
+    heartbeat REAL NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    payload TEXT,                            -- JSON: чат для отчёта, приоритет
+    attempts INTEGER NOT NULL DEFAULT 1      -- сколько воркеров брались за анализ
+);
+CREATE INDEX IF NOT EXISTS analyses_user ON analyses (user_id);
+CREATE INDEX IF NOT EXISTS analyses_worker ON analyses (worker);
+CREATE INDEX IF NOT EXISTS analyses_heartbeat ON analyses (heartbeat);
+-- Апдейты со ссылкой, по которым принят анализ: повторная обработка апдейта не запускает второй анализ
+CREATE TABLE IF NOT EXISTS accepted_updates (
+    update_id INTEGER PRIMARY KEY,
+    analysis_id INTEGER NOT NULL,
+    accepted_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS accepted_updates_at ON accepted_updates (accepted_at);
+CREATE TABLE IF NOT EXISTS flags (
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+"""
+
+# Первый незавершённый апдейт каждого пользователя, если он свободен (или аренда истекла)
+_CLAIM_SQL = """
+SELECT u.update_id, u.payload, u.received_at FROM updates u
+WHERE u.status IN ('pending', 'leased') AND (u.status = 'pending' OR u.lease_until < ?)
+  AND NOT EXISTS (
+      SELECT 1 FROM updates p
+      WHERE p.user_id = u.user_id AND p.update_id < u.update_id AND p.status IN ('pending', 'leased'))
+ORDER BY u.update_id LIMIT 1
+"""
+
+
+class SQLiteSharedState(SharedState):
+    """
+    Бэкенд SharedState на одном файле SQLite (WAL): годится для нескольких процессов
+    на одной машине или на общем томе. Конкурирующие записи сериализует BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, path: str, users: UserStore, max_attempts: int = 5, stale_after: float = 30.0):
+        self.path = path
+        self.users = users
+        self.max_attempts = max_attempts
+        # Анализ без heartbeat дольше stale_after считается брошенным (воркер упал)
+        self.stale_after = stale_after
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    # --- синхронная часть (выполняется в потоке) ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self, fn):
+        """fn(conn) внутри BEGIN IMMEDIATE: чтение и запись атомарны между процессами."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+                conn.execute("COMMIT")
+                return result
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def _enqueue(self, update_id: int, user_id: Optional[int], payload: Dict[str, Any]) -> bool:
+        cur = self._execute(
+            "INSERT OR IGNORE INTO updates (update_id, user_id, payload, received_at) VALUES (?, ?, ?, ?)",
+            (int(update_id), user_id, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        return cur.rowcount == 1
+
+    def _claim(self, worker: str, lease: float) -> Optional[ClaimedUpdate]:
+        def claim(conn: sqlite3.Connection) -> Optional[ClaimedUpdate]:
+            now = time.time()
+            row = conn.execute(_CLAIM_SQL, (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE updates SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE update_id = ?", (worker, now + lease, row[0]))
+            return row[0], json.loads(row[1]), row[2]
+        return self._transaction(claim)
+
+    def _extend(self, update_id: int, worker: str, lease: float) -> bool:
+        cur = self._execute(
+            "UPDATE updates SET lease_until = ? WHERE update_id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + lease, int(update_id), worker))
+        return cur.rowcount == 1
+
+    def _ack(self, update_id: int) -> None:
+        self._execute("UPDATE updates SET status = 'done', done_at = ?, error = NULL WHERE update_id = ?",
+                      (time.time(), int(update_id)))
+
+    def _fail(self, update_id: int, error: str) -> None:
+        def fail(conn: sqlite3.Connection) -> None:
+            row = conn.execute("SELECT attempts FROM updates WHERE update_id = ?", (int(update_id),)).fetchone()
+            if row and row[0] >= self.max_attempts:
+                conn.execute("UPDATE updates SET status = 'failed', done_at = ?, error = ? WHERE update_id = ?",
+                             (time.time(), error, int(update_id)))
+            elif row:
+                # Остаётся арендованным до конца паузы: повтор не раньше, и следующие апдейты пользователя ждут
+                backoff = min(2.0 ** row[0], 60.0)
+                conn.execute("UPDATE updates SET lease_until = ?, error = ? WHERE update_id = ?",
+                             (time.time() + backoff, error, int(update_id)))
+        self._transaction(fail)
+
+    def _pending(self) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM updates WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+    def _purge(self, older_than: float) -> int:
+        def purge(conn: sqlite3.Connection) -> int:
+            cutoff = time.time() - older_than
+            conn.execute("DELETE FROM accepted_updates WHERE accepted_at < ?", (cutoff,))
+            return conn.execute("DELETE FROM updates WHERE status IN ('done', 'failed') AND done_at < ?",
+                                (cutoff,)).rowcount
+        return self._transaction(purge)
+
+    def _begin_analysis(self, user_id: int, worker: str, link: str, limit: int,
+                        payload: Optional[Dict[str, Any]], update_id: Optional[int]) -> Optional[int]:
+        def begin(conn: sqlite3.Connection) -> Optional[int]:
+            now = time.time()
+            # Анализ упавшего воркера тоже считается: его доведёт до отчёта другой воркер
+            running = conn.execute("SELECT COUNT(*) FROM analyses WHERE user_id = ?", (int(user_id),)).fetchone()[0]
+            if running >= limit:
+                return None
+            cur = conn.execute(
+                "INSERT INTO analyses (user_id, worker, link, started_at, heartbeat, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                (int(user_id), worker, link, now, now, json.dumps(payload or {}, ensure_ascii=False)))
+            if update_id is not None:
+                conn.execute("INSERT OR REPLACE INTO accepted_updates (update_id, analysis_id, accepted_at) VALUES (?, ?, ?)",
+                             (int(update_id), cur.lastrowid, now))
+            return cur.lastrowid
+        return self._transaction(begin)
+
+    def _analysis_for_update(self, update_id: int) -> Optional[int]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT analysis_id FROM accepted_updates WHERE update_id = ?", (int(update_id),)).fetchone()
+        return row[0] if row else None
+
+    def _end_analysis(self, analysis_id: int) -> None:
+        self._execute("DELETE FROM analyses WHERE analysis_id = ?", (int(analysis_id),))
+
+    def _heartbeat(self, worker: str, alive: List[int]) -> Set[int]:
+        def beat(conn: sqlite3.Connection) -> Set[int]:
+            now = time.time()
+            # Только что зарегистрированный анализ может ещё не дойти до очереди воркера — его не трогаем
+            settled = now - 5.0
+            marks = ", ".join("?" for _ in alive)
+            exclude = f" AND analysis_id NOT IN ({marks})" if alive else ""
+            conn.execute(f"DELETE FROM analyses WHERE worker = ? AND started_at < ?{exclude}", (worker, settled, *alive))
+            conn.execute("UPDATE analyses SET heartbeat = ? WHERE worker = ?", (now, worker))
+            rows = conn.execute("SELECT analysis_id FROM analyses WHERE worker = ? AND cancel_requested = 1",
+                                (worker,)).fetchall()
+            return {r[0] for r in rows}
+        return self._transaction(beat)
+
+    def _adopt_analyses(self, worker: str, limit: int) -> List[AdoptedAnalysis]:
+        def adopt(conn: sqlite3.Connection) -> List[AdoptedAnalysis]:
+            now = time.time()
+            # Отмену запросили, а воркер упал раньше, чем её увидел — доводить нечего
+            conn.execute("DELETE FROM analyses WHERE heartbeat < ? AND cancel_requested = 1", (now - self.stale_after,))
+            rows = conn.execute(
+                "SELECT analysis_id, user_id, link, payload, attempts FROM analyses "
+                "WHERE heartbeat < ? AND cancel_requested = 0 ORDER BY analysis_id LIMIT ?",
+                (now - self.stale_after, int(limit))).fetchall()
+            for row in rows:
+                conn.execute(
+                    "UPDATE analyses SET worker = ?, started_at = ?, heartbeat = ?, attempts = attempts + 1 "
+                    "WHERE analysis_id = ?", (worker, now, now, row[0]))
+            return [{"analysis_id": r[0], "user_id": r[1], "link": r[2], "payload": json.loads(r[3] or "{}"),
+                     "attempts": r[4] + 1} for r in rows]
+        return self._transaction(adopt)
+
+    def _release_analyses(self, worker: str, analysis_ids: Optional[List[int]]) -> None:
+        if analysis_ids is None:
+            self._execute("UPDATE analyses SET heartbeat = 0 WHERE worker = ?", (worker,))
+        elif analysis_ids:
+            marks = ", ".join("?" for _ in analysis_ids)
+            self._execute(f"UPDATE analyses SET heartbeat = 0 WHERE worker = ? AND analysis_id IN ({marks})",
+                          (worker, *analysis_ids))
+
+    def _cancel_analyses(self, user_id: int) -> int:
+        def cancel(conn: sqlite3.Connection) -> int:
+            stale = time.time() - self.stale_after
+            # Анализ без воркера отменяем сразу, идущий — при ближайшем heartbeat его воркера
+            orphaned = conn.execute("DELETE FROM analyses WHERE user_id = ? AND heartbeat < ?",
+                                    (int(user_id), stale)).rowcount
+            running = conn.execute(
+                "UPDATE analyses SET cancel_requested = 1 WHERE user_id = ? AND cancel_requested = 0",
+                (int(user_id),)).rowcount
+            return orphaned + running
+        return self._transaction(cancel)
+
+    def _set_flag(self, user_id: int, name: str, ttl: float) -> None:
+        self._execute("INSERT OR REPLACE INTO flags (user_id, name, expires_at) VALUES (?, ?, ?)",
+                      (int(user_id), name, time.time() + ttl))
+
+    def _pop_flag(self, user_id: int, name: str) -> bool:
+        with self._lock:
+            row = self._connect().execute(
+                "DELETE FROM flags WHERE user_id = ? AND name = ? RETURNING expires_at", (int(user_id), name)
+            ).fetchone()
+        return bool(row and row[0] > time.time())
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # --- асинхронный API ---
+
+    async def open(self) -> None:
+        await asyncio.to_thread(self._connect)
+
+    async def enqueue(self, update_id: int, user_id: Optional[int], payload: Dict[str, Any]) -> bool:
+        return await asyncio.to_thread(self._enqueue, update_id, user_id, payload)
+
+    async def claim(self, worker: str, lease: float) -> Optional[ClaimedUpdate]:
+        return await asyncio.to_thread(self._claim, worker, lease)
+
+    async def extend(self, update_id: int, worker: str, lease: float) -> bool:
+        return await asyncio.to_thread(self._extend, update_id, worker, lease)
+
+    async def ack(self, update_id: int) -> None:
+        await asyncio.to_thread(self._ack, update_id)
+
+    async def fail(self, update_id: int, error: str) -> None:
+        await asyncio.to_thread(self._fail, update_id, error)
+
+    async def pending(self) -> int:
+        return await asyncio.to_thread(self._pending)
+
+    async def purge(self, older_than: float) -> int:
+        return await asyncio.to_thread(self._purge, older_than)
+
+    async def begin_analysis(self, user_id: int, worker: str, link: str, limit: int,
+                             payload: Optional[Dict[str, Any]] = None, update_id: Optional[int] = None) -> Optional[int]:
+        return await asyncio.to_thread(self._begin_analysis, user_id, worker, link, limit, payload, update_id)
+
+    async def analysis_for_update(self, update_id: int) -> Optional[int]:
+        return await asyncio.to_thread(self._analysis_for_update, update_id)
+
+    async def end_analysis(self, analysis_id: int) -> None:
+        await asyncio.to_thread(self._end_analysis, analysis_id)
+
+    async def heartbeat(self, worker: str, alive: Iterable[int]) -> Set[int]:
+        return await asyncio.to_thread(self._heartbeat, worker, list(alive))
+
+    async def adopt_analyses(self, worker: str, limit: int) -> List[AdoptedAnalysis]:
+        return await asyncio.to_thread(self._adopt_analyses, worker, limit)
+
+    async def release_analyses(self, worker: str, analysis_ids: Optional[Iterable[int]] = None) -> None:
+        ids = None if analysis_ids is None else [int(i) for i in analysis_ids]
+        await asyncio.to_thread(self._release_analyses, worker, ids)
+
+    async def cancel_analyses(self, user_id: int) -> int:
+        return await asyncio.to_thread(self._cancel_analyses, user_id)
+
+    async def set_flag(self, user_id: int, name: str, ttl: float) -> None:
+        await asyncio.to_thread(self._set_flag, user_id, name, ttl)
+
+    async def pop_flag(self, user_id: int, name: str) -> bool:
+        return await asyncio.to_thread(self._pop_flag, user_id, name)
@@ -0,0 +1,133 @@
+# File: bot/services/sources.py — встроенные источники данных для реестра parser_adapter: Telegram (parser_core) и TGStat
+
+from __future__ import annotations
+import os
+from typing import Dict, Any
+
+from bot.services.quota import PRIORITY_BACKGROUND, quota
+
+# Стоимость полного сбора канала в единицах квоты Telegram (вызовы API)
+TELEGRAM_ANALYSIS_COST = 3
+
+
+class TelegramSource:
+    """Ядро parser_core на Telegram API: канал, посты, ряды из снимков."""
+
+    name = "telegram"
+    # Резервируется до таймаута источника (см. SourceEntry.fetch)
+    quota_cost = ("telegram", TELEGRAM_ANALYSIS_COST)
+
+    def enabled(self) -> bool:
+        return True
+
+    async def fetch(self, link: str) -> Dict[str, Any]:
+        # Telethon тянет много зависимостей — импортируем при первом сборе
+        from parser_core import collect_channel_data
+
+        data = await collect_channel_data(link)
+        # Все аккаунты во FloodWait — остальные запросы к Telegram ждут вместе с этим
+        quota.penalize("telegram", data.get("meta", {}).get("retry_after") or 0)
+        return data
+
+    def error(self, data: Dict[str, Any]) -> str | None:
+        return (data.get("meta") or {}).get("error")
+
+    def cacheable(self, data: Dict[str, Any]) -> bool:
+        return self.error(data) is None
+
+    def merge(self, unified: Dict[str, Any], data: Dict[str, Any]) -> None:
+        channel = unified["channel"]
+        channel.update({k: v for k, v in (data.get("channel") or {}).items() if v is not None})
+        for key in ("stats", "time_series"):
+            unified[key].update(data.get(key) or {})
+        for key in ("posts", "mentions", "forwards", "adposts"):
+            if data.get(key):
+                unified[key] = data[key]
+        unified["meta"].update(data.get("meta") or {})
+
+
+class DeepScanSource:
+    """Глубокий скан истории (parser_core.deep_scan_channel): только агрегаты, без постов. Включается DEEP_SCAN=1."""
+
+    name = "deep"
+    # Первая страница истории — до таймаута источника, остальные — постранично в ходе скана
+    quota_cost = ("telegram", 1)
+
+    def enabled(self) -> bool:
+        return os.getenv("DEEP_SCAN", "0") == "1"
+
+    async def fetch(self, link: str) -> Dict[str, Any]:
+        from parser_core import deep_scan_channel
+
+        # Каждая следующая страница (100 сообщений) — один вызов API с фоновым приоритетом:
+        # длинный скан не занимает квоту разом и пропускает вперёд сбор данных для анализов.
+        # Квоты не хватило посреди скана — результат частичный (meta.partial)
+        return await deep_scan_channel(link, gate=lambda: quota.acquire("telegram", 1, PRIORITY_BACKGROUND))
+
+    def error(self, data: Dict[str, Any]) -> str | None:
+        return (data.get("meta") or {}).get("error")
+
+    def cacheable(self, data: Dict[str, Any]) -> bool:
+        return self.error(data) is None and not data["meta"].get("partial")
+
+    def merge(self, unified: Dict[str, Any], data: Dict[str, Any]) -> None:
+        deep = dict(data.get("deep_scan") or {})
+        subscribers = unified["channel"].get("subscribers")
+        mean = (deep.get("views") or {}).get("mean")
+        if subscribers and mean:
+            deep["err_pct"] = round(mean / subscribers * 100, 2)
+        if data["meta"].get("partial"):
+            deep["partial"] = data["meta"]["partial"]
+        unified["deep_scan"] = deep
+
+
+class TGStatSource:
+    """TGStat API: статистика, ряды, упоминания и реклама. Без TGSTAT_TOKEN выключен."""
+
+    name = "tgstat"
+
+    def enabled(self) -> bool:
+        return bool(os.getenv("TGSTAT_TOKEN"))
+
+    async def fetch(self, link: str) -> Dict[str, Any]:
+        from bot.services.tgstat import collect_tgstat_data
+
+        return await collect_tgstat_data(link)
+
+    def error(self, data: Dict[str, Any]) -> str | None:
+        if "error" in data:
+            return str(data["error"])
+        # Отказали все эндпоинты — источник фактически недоступен
+        blocks = [v for k, v in data.items() if k != "partial" and isinstance(v, dict)]
+        if blocks and all("error" in b for b in blocks):
+            return f"all TGStat endpoints failed: {blocks[0]['error']}"
+        # Частичный ответ годится для анализа, но не для кэша — см. cacheable
+        return None
+
+    def cacheable(self, data: Dict[str, Any]) -> bool:
+        return self.error(data) is None and not data.get("partial")
+
+    def merge(self, unified: Dict[str, Any], data: Dict[str, Any]) -> None:
+        # Сырые ответы нужны метрикам и промпту как есть
+        unified["sources"]["tgstat"] = data
+        # Заполняем поля канала, которых нет у Telegram (или Telegram недоступен)
+        info = _response(data.get("get"))
+        stat = _response(data.get("stat"))
+        channel = unified["channel"]
+        for field, value in (
+            ("title", info.get("title")),
+            ("about", info.get("about")),
+            ("category", info.get("category")),
+            ("lang", info.get("language")),
+            ("country", info.get("country")),
+            ("subscribers", info.get("participants_count") or stat.get("participants_count")),
+        ):
+            if channel.get(field) is None and value is not None:
+                channel[field] = value
+
+
+def _response(block: Any) -> Dict[str, Any]:
+    if not isinstance(block, dict):
+        return {}
+    data = block.get("response", block.get("result"))
+    return data if isinstance(data, dict) else {}
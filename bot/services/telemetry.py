@@ -0,0 +1,194 @@
+# File: bot/services/telemetry.py — трассировка запросов и задержки по этапам (гистограммы, /stats, Prometheus)
+
+from __future__ import annotations
+import asyncio
+import contextvars
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
+
+# Идентификатор трассы текущего анализа; наследуется дочерними задачами asyncio
+trace_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def new_trace() -> str:
+    trace_id = uuid.uuid4().hex[:12]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+def current_trace() -> Optional[str]:
+    return trace_id_var.get()
+
+
+class Series:
+    """Наблюдения одной метрики: общие count/sum/errors и скользящее окно для перцентилей."""
+
+    __slots__ = ("count", "total", "errors", "window")
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.window: deque = deque(maxlen=window)
+
+    def observe(self, value: float, error: bool = False) -> None:
+        self.count += 1
+        self.total += value
+        if error:
+            self.errors += 1
+        self.window.append(value)
+
+    def quantiles(self) -> Dict[float, float]:
+        values = sorted(self.window)
+        if not values:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+class Telemetry:
+    """Внутрипроцессные метрики: задержки этапов, размеры payload, токены, счётчики и внешние коллекторы."""
+
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self.series: Dict[Tuple[str, str], Series] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+        self._collectors: List[Callable[[], Dict[str, float]]] = []
+        self.started = time.time()
+
+    def observe(self, metric: str, label: str, value: float, error: bool = False) -> None:
+        key = (metric, label)
+        s = self.series.get(key)
+        if s is None:
+            s = self.series[key] = Series(self.window)
+        s.observe(value, error)
+
+    def incr(self, metric: str, label: str = "", n: int = 1) -> None:
+        self.counters[(metric, label)] = self.counters.get((metric, label), 0) + n
+
+    def add_collector(self, fn: Callable[[], Dict[str, float]]) -> None:
+        """fn() -> {имя: значение}; вызывается при каждом снимке (например, статистика кэша)."""
+        self._collectors.append(fn)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Засекает длительность этапа в stage_seconds{stage}; исключение считается ошибкой этапа."""
+        t0 = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe("stage_seconds", stage, time.perf_counter() - t0, error)
+
+    def gauges(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for fn in self._collectors:
+            try:
+                out.update(fn())
+            except Exception:
+                pass
+        return out
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "uptime_s": round(time.time() - self.started),
+            "series": {
+                f"{m}:{l}": {
+                    "count": s.count,
+                    "errors": s.errors,
+                    "error_rate": round(s.errors / s.count, 4) if s.count else 0.0,
+                    "mean": s.total / s.count if s.count else 0.0,
+                    **{f"p{int(q * 100)}": v for q, v in s.quantiles().items()},
+                }
+                for (m, l), s in sorted(self.series.items())
+            },
+            "counters": {f"{m}:{l}" if l else m: v for (m, l), v in sorted(self.counters.items())},
+            "gauges": self.gauges(),
+        }
+
+    def format_text(self) -> str:
+        """Сводка для команды /stats."""
+        snap = self.snapshot()
+        lines = [f"⏱ Аптайм: {snap['uptime_s'] // 60} мин"]
+        current = None
+        for name, s in snap["series"].items():
+            metric, label = name.split(":", 1)
+            if metric != current:
+                lines.append(f"\n{metric}:")
+                current = metric
+            scale, unit = (1000, "ms") if metric.endswith("_seconds") else (1, "")
+            lines.append(
+                f"  {label}: n={s['count']} p50={s['p50'] * scale:.0f}{unit} p95={s['p95'] * scale:.0f}{unit} "
+                f"p99={s['p99'] * scale:.0f}{unit} err={s['error_rate'] * 100:.1f}%"
+            )
+        if snap["counters"]:
+            lines.append("\nСчётчики:")
+            lines.extend(f"  {k}: {v}" for k, v in snap["counters"].items())
+        if snap["gauges"]:
+            lines.append("\nСостояние:")
+            lines.extend(f"  {k}: {v}" for k, v in snap["gauges"].items())
+        return "\n".join(lines)
+
+    def render_prometheus(self, prefix: str = "arhymetrix") -> str:
+        """Текстовый формат Prometheus: summary с квантилями окна, счётчики ошибок и событий, gauge."""
+        out: List[str] = []
+        by_metric: Dict[str, List[Tuple[str, Series]]] = {}
+        for (m, l), s in sorted(self.series.items()):
+            by_metric.setdefault(m, []).append((l, s))
+        for metric, items in by_metric.items():
+            name = f"{prefix}_{metric}"
+            out.append(f"# TYPE {name} summary")
+            for label, s in items:
+                for q, v in s.quantiles().items():
+                    out.append(f'{name}{{label="{label}",quantile="{q}"}} {v}')
+                out.append(f'{name}_sum{{label="{label}"}} {s.total}')
+                out.append(f'{name}_count{{label="{label}"}} {s.count}')
+            # Ошибки — отдельное семейство-счётчик, а не строки внутри summary
+            out.append(f"# TYPE {name}_errors_total counter")
+            out.extend(f'{name}_errors_total{{label="{label}"}} {s.errors}' for label, s in items)
+        by_counter: Dict[str, List[Tuple[str, float]]] = {}
+        for (m, l), v in sorted(self.counters.items()):
+            by_counter.setdefault(m, []).append((l, v))
+        for metric, items in by_counter.items():
+            name = f"{prefix}_{metric}_total"
+            out.append(f"# TYPE {name} counter")
+            out.extend(f'{name}{{label="{label}"}} {v}' for label, v in items)
+        for k, v in self.gauges().items():
+            out.append(f"# TYPE {prefix}_{k} gauge")
+            out.append(f"{prefix}_{k} {v}")
+        return "\n".join(out) + "\n"
+
+
+async def serve_prometheus(telemetry: Telemetry, host: str = "127.0.0.1", port: int = 9108) -> asyncio.AbstractServer:
+    """Минимальный HTTP-эндпоинт /metrics на asyncio, без внешних зависимостей."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                body, status = telemetry.render_prometheus().encode(), "200 OK"
+            else:
+                body, status = b"not found\n", "404 Not Found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+telemetry = Telemetry()
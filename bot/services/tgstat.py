@@ -0,0 +1,146 @@
+# File: bot/services/tgstat.py — асинхронный сбор данных TGStat на общем пуле соединений
+
+from __future__ import annotations
+import asyncio
+import os
+import time
+from typing import Dict, Any, Optional
+
+import httpx
+
+from bot.services.event_log import event_log
+from bot.services.quota import quota, QuotaExceeded
+from bot.services.telemetry import telemetry
+
+TGSTAT_BASE_URL = os.getenv("TGSTAT_BASE_URL", "https://api.tgstat.ru")
+# Таймаут одного запроса и общий дедлайн на весь сбор (секунды)
+TGSTAT_CALL_TIMEOUT = float(os.getenv("TGSTAT_CALL_TIMEOUT", "10"))
+TGSTAT_DEADLINE = float(os.getenv("TGSTAT_DEADLINE", "20"))
+# Сколько запросов posts/stat выполняется параллельно
+TGSTAT_POSTS_CONCURRENCY = int(os.getenv("TGSTAT_POSTS_CONCURRENCY", "5"))
+
+# Независимые эндпоинты channels/*: ключ в ответе -> (эндпоинт, доп. параметры)
+CHANNEL_ENDPOINTS: Dict[str, tuple] = {
+    "get": ("channels/get", {}),
+    "stat": ("channels/stat", {}),
+    "subscribers": ("channels/subscribers", {"period": "month"}),  # динамика за месяц
+    "views": ("channels/views", {"period": "month"}),
+    "err": ("channels/err", {"period": "month"}),
+    "mentions": ("channels/mentions", {"limit": 10}),  # последние 10 упоминаний
+    "forwards": ("channels/forwards", {"limit": 10}),  # последние 10 форвардов
+    "adposts": ("channels/adposts", {"limit": 5}),  # реклама
+}
+POSTS_LIMIT = 5  # последние 5 постов, по каждому — posts/stat
+
+# Порядок ключей в итоговом словаре (как в прежней синхронной версии)
+_RESULT_ORDER = ["get", "stat", "subscribers", "views", "err", "mentions", "forwards", "posts", "posts_stat", "adposts"]
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент с keep-alive; создаётся при первом обращении."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=TGSTAT_BASE_URL,
+            timeout=TGSTAT_CALL_TIMEOUT,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _retry_after(value: Optional[str], default: float = 5.0) -> float:
+    try:
+        return float(value) if value else default
+    except ValueError:
+        return default
+
+
+async def collect_tgstat_data(
+    channel_link: str,
+    token: Optional[str] = None,
+    call_timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Собирает все необходимые данные TGStat для промпта.
+    Эндпоинты channels/* запрашиваются параллельно, posts/stat — веером с ограничением.
+    Медленный или упавший эндпоинт не роняет весь сбор: на его месте будет {"error": ...}.
+    """
+    channel = channel_link.replace("https://t.me/", "").strip("/")
+    token = token if token is not None else os.getenv("TGSTAT_TOKEN")
+    call_timeout = TGSTAT_CALL_TIMEOUT if call_timeout is None else call_timeout
+    deadline = TGSTAT_DEADLINE if deadline is None else deadline
+    client = get_client()
+
+    async def get(endpoint: str, **kwargs) -> Dict[str, Any]:
+        params = {"token": token, "channelId": channel}
+        params.update(kwargs)
+        try:
+            # Ожидание квоты не входит в таймаут запроса
+            await quota.acquire("tgstat")
+        except QuotaExceeded as e:
+            return {"error": str(e), "retry_after": round(e.retry_after)}
+        t0 = time.perf_counter()
+        try:
+            resp = await asyncio.wait_for(client.get(f"/{endpoint}", params=params), call_timeout)
+            if resp.status_code == 429:
+                # Лимит TGStat: остальные запросы подождут, а не получат такой же отказ
+                quota.penalize("tgstat", _retry_after(resp.headers.get("retry-after")))
+            result = resp.json()
+        except asyncio.TimeoutError:
+            result = {"error": f"timeout after {call_timeout}s"}
+        except Exception as e:
+            result = {"error": str(e)}
+        telemetry.observe("stage_seconds", f"tgstat:{endpoint}", time.perf_counter() - t0,
+                          error=isinstance(result, dict) and "error" in result)
+        return result
+
+    data: Dict[str, Any] = {"posts_stat": []}
+
+    async def fetch_channel(key: str, endpoint: str, params: Dict[str, Any]) -> None:
+        data[key] = await get(endpoint, **params)
+
+    async def fetch_posts() -> None:
+        posts_resp = await get("channels/posts", limit=POSTS_LIMIT)
+        data["posts"] = posts_resp
+        if not (posts_resp.get("ok") and posts_resp.get("result")):
+            return
+        sem = asyncio.Semaphore(TGSTAT_POSTS_CONCURRENCY)
+
+        async def fetch_post_stat(post_id) -> None:
+            async with sem:
+                stat = await get("posts/stat", postId=post_id)
+            # Пишем сразу, чтобы при срабатывании дедлайна не потерять готовые ответы
+            data["posts_stat"].append({"post_id": post_id, "stat": stat})
+
+        post_ids = [p.get("id") for p in posts_resp["result"] if p.get("id")]
+        await asyncio.gather(*(fetch_post_stat(pid) for pid in post_ids))
+
+    tasks = [asyncio.create_task(fetch_channel(k, ep, params)) for k, (ep, params) in CHANNEL_ENDPOINTS.items()]
+    tasks.append(asyncio.create_task(fetch_posts()))
+    _, pending = await asyncio.wait(tasks, timeout=deadline)
+    for t in pending:
+        t.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    result: Dict[str, Any] = {}
+    for key in _RESULT_ORDER:
+        result[key] = data.get(key, {"error": f"deadline {deadline}s exceeded"})
+    if pending:
+        result["partial"] = True
+
+    event_log.info("tgstat_collected", channel=channel, partial=bool(pending),
+                   errors=[k for k in _RESULT_ORDER if isinstance(result[k], dict) and "error" in result[k]])
+    # Полный ответ — только в выборке (LOG_PAYLOAD_SAMPLE), по умолчанию не пишется
+    event_log.payload("tgstat_response", result, channel=channel)
+    return result
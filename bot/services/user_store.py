@@ -0,0 +1,212 @@
+# File: bot/services/user_store.py — хранилище состояния пользователей (верификация, пробные анализы, подписка)
+
+from __future__ import annotations
+import asyncio
+import csv
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+# Действия из user_log.csv, по которым восстанавливается состояние при импорте
+VERIFY_ACTION = "Верификация"
+TRIAL_ACTION = "Пробный анализ — ссылка"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    verified_at TEXT,
+    trials_used INTEGER NOT NULL DEFAULT 0,
+    subscription_until TEXT
+);
+CREATE TABLE IF NOT EXISTS trial_charges (
+    charge_key TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UserStore:
+    """
+    Состояние пользователей в SQLite: поиск по первичному ключу user_id вместо
+    полного чтения user_log.csv на каждое сообщение.
+    Асинхронные методы выполняют запросы в отдельном потоке, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, path: str = "users.db"):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    # --- синхронная часть (выполняется в потоке) ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # timeout: базу могут одновременно писать несколько процессов (режим webhook)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def _fetch_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT * FROM users WHERE user_id = ?", (int(user_id),)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _upsert_user(self, user_id: int, username: Optional[str]) -> None:
+        self._execute(
+            "INSERT INTO users (user_id, username) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET username = COALESCE(excluded.username, users.username)",
+            (int(user_id), username),
+        )
+
+    def _mark_verified(self, user_id: int, username: Optional[str]) -> None:
+        self._upsert_user(user_id, username)
+        self._execute(
+            "UPDATE users SET verified_at = COALESCE(verified_at, ?) WHERE user_id = ?",
+            (datetime.now().isoformat(), int(user_id)),
+        )
+
+    def _add_trial(self, user_id: int, username: Optional[str], charge_key: Optional[str] = None) -> int:
+        self._upsert_user(user_id, username)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                charged = charge_key is None or conn.execute(
+                    "INSERT OR IGNORE INTO trial_charges (charge_key, user_id) VALUES (?, ?)",
+                    (charge_key, int(user_id)),
+                ).rowcount == 1
+                if charged:
+                    row = conn.execute(
+                        "UPDATE users SET trials_used = trials_used + 1 WHERE user_id = ? RETURNING trials_used",
+                        (int(user_id),),
+                    ).fetchone()
+                else:
+                    row = conn.execute("SELECT trials_used FROM users WHERE user_id = ?", (int(user_id),)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return int(row[0]) if row else 0
+
+    def _set_subscription(self, user_id: int, until: datetime) -> None:
+        self._upsert_user(user_id, None)
+        self._execute(
+            "UPDATE users SET subscription_until = ? WHERE user_id = ?",
+            (until.isoformat(), int(user_id)),
+        )
+
+    def import_legacy_csv(self, csv_path: str) -> int:
+        """
+        Одноразовый импорт истории из user_log.csv.
+        Повторный вызов ничего не делает (флаг в таблице meta). Возвращает число импортированных пользователей.
+        """
+        with self._lock:
+            conn = self._connect()
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_csv_imported'").fetchone():
+                return 0
+
+        users: Dict[int, Dict[str, Any]] = {}
+        try:
+            with open(csv_path, "r", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    if len(row) < 4:
+                        continue
+                    try:
+                        uid = int(row[1])
+                    except ValueError:
+                        continue
+                    u = users.setdefault(uid, {"username": None, "verified_at": None, "trials_used": 0})
+                    u["username"] = row[2] or u["username"]
+                    if VERIFY_ACTION in row[3] and not u["verified_at"]:
+                        u["verified_at"] = row[0]
+                    if TRIAL_ACTION in row[3]:
+                        u["trials_used"] += 1
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Несколько процессов могут стартовать одновременно — импортирует только первый
+                if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_csv_imported'").fetchone():
+                    conn.execute("ROLLBACK")
+                    return 0
+                for uid, u in users.items():
+                    conn.execute(
+                        "INSERT INTO users (user_id, username, verified_at, trials_used) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET "
+                        "username = COALESCE(excluded.username, users.username), "
+                        "verified_at = COALESCE(users.verified_at, excluded.verified_at), "
+                        "trials_used = users.trials_used + excluded.trials_used",
+                        (uid, u["username"], u["verified_at"], u["trials_used"]),
+                    )
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('legacy_csv_imported', ?)",
+                    (datetime.now().isoformat(),),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(users)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # --- асинхронный API для хендлеров ---
+
+    async def open(self, legacy_csv: Optional[str] = None) -> None:
+        """Открывает базу и при первом запуске импортирует историю из CSV."""
+        await asyncio.to_thread(self._connect)
+        if legacy_csv:
+            await asyncio.to_thread(self.import_legacy_csv, legacy_csv)
+
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._fetch_user, user_id)
+
+    async def is_verified(self, user_id: int) -> bool:
+        user = await self.get_user(user_id)
+        return bool(user and user["verified_at"])
+
+    async def mark_verified(self, user_id: int, username: Optional[str]) -> None:
+        await asyncio.to_thread(self._mark_verified, user_id, username)
+
+    async def get_trial_count(self, user_id: int) -> int:
+        user = await self.get_user(user_id)
+        return int(user["trials_used"]) if user else 0
+
+    async def add_trial(self, user_id: int, username: Optional[str], charge_key: Optional[str] = None) -> int:
+        """
+        Атомарно увеличивает счётчик пробных анализов и возвращает новое значение.
+        С charge_key списание идемпотентно: повтор с тем же ключом счётчик не меняет.
+        """
+        return await asyncio.to_thread(self._add_trial, user_id, username, charge_key)
+
+    async def has_subscription(self, user_id: int) -> bool:
+        user = await self.get_user(user_id)
+        if not user or not user["subscription_until"]:
+            return False
+        return datetime.fromisoformat(user["subscription_until"]) > datetime.now()
+
+    async def set_subscription(self, user_id: int, until: datetime) -> None:
+        await asyncio.to_thread(self._set_subscription, user_id, until)
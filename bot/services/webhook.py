@@ -0,0 +1,213 @@
+# File: bot/services/webhook.py — режим webhook: ASGI-приёмник апдейтов и воркер, разбирающий общую очередь
+
+from __future__ import annotations
+import asyncio
+import json
+import time
+from typing import Dict, Any, Awaitable, Callable, List, Optional
+
+from bot.services.event_log import event_log
+from bot.services.shared_state import SharedState
+from bot.services.telemetry import telemetry
+
+MAX_BODY_BYTES = 1024 * 1024
+SECRET_HEADER = b"x-telegram-bot-api-secret-token"
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """Отправитель апдейта (message.from, callback_query.from, …) — ключ упорядочивания."""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+async def _respond(send, status: int, body: Dict[str, Any]) -> None:
+    payload = json.dumps(body).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]})
+    await send({"type": "http.response.body", "body": payload})
+
+
+class WebhookReceiver:
+    """
+    ASGI-приложение: принимает апдейты Telegram, кладёт их в общую очередь и сразу отвечает 200.
+    Сам ничего не обрабатывает, поэтому отвечает за миллисекунды при любой нагрузке на воркеры.
+    GET /healthz — длина очереди.
+    """
+
+    def __init__(self, state: SharedState, path: str = "/telegram", secret: Optional[str] = None,
+                 on_startup: Optional[Callable[[], Awaitable[None]]] = None,
+                 on_shutdown: Optional[Callable[[], Awaitable[None]]] = None):
+        self.state = state
+        self.path = path
+        self.secret = secret.encode() if secret else None
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.state.open()
+                    if self.on_startup:
+                        await self.on_startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.on_shutdown:
+                    await self.on_shutdown()
+                self.state.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send) -> None:
+        method, path = scope["method"], scope["path"]
+        if method == "GET" and path == "/healthz":
+            await _respond(send, 200, {"ok": True, "pending": await self.state.pending()})
+            return
+        if path != self.path or method != "POST":
+            await _respond(send, 404, {"ok": False})
+            return
+        if self.secret is not None and dict(scope.get("headers") or []).get(SECRET_HEADER) != self.secret:
+            telemetry.incr("webhook_updates", "forbidden")
+            await _respond(send, 403, {"ok": False})
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_BYTES:
+                await _respond(send, 413, {"ok": False})
+                return
+            if not message.get("more_body"):
+                break
+        try:
+            update = json.loads(body)
+            update_id = int(update["update_id"])
+        except (ValueError, KeyError, TypeError):
+            telemetry.incr("webhook_updates", "invalid")
+            await _respond(send, 400, {"ok": False})
+            return
+
+        # Telegram повторяет доставку, пока не получит 200; дубль просто подтверждаем
+        accepted = await self.state.enqueue(update_id, update_user_id(update), update)
+        telemetry.incr("webhook_updates", "accepted" if accepted else "duplicate")
+        await _respond(send, 200, {"ok": True})
+
+
+UpdateHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class UpdateWorker:
+    """
+    Разбирает общую очередь апдейтов: concurrency независимых циклов claim → handler → ack.
+    Порядок апдейтов одного пользователя обеспечивает claim; воркеров можно запускать сколько угодно
+    (процессы, машины) — лишь бы у всех было одно и то же SharedState.
+    """
+
+    def __init__(self, state: SharedState, handler: UpdateHandler, worker_id: str, concurrency: int = 8,
+                 lease: float = 60.0, retention: float = 24 * 3600):
+        self.state = state
+        self.handler = handler
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.lease = lease
+        # Сколько хранить обработанные update_id, чтобы отсеивать повторные доставки
+        self.retention = retention
+        self.processed = 0
+        self._loops: List[asyncio.Task] = []
+        self._stopping = False
+        self._last_purge = 0.0
+
+    async def start(self) -> None:
+        self._loops = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """Дожидается текущих апдейтов; новые не берёт."""
+        self._stopping = True
+        await asyncio.gather(*self._loops, return_exceptions=True)
+        self._loops = []
+
+    async def _loop(self) -> None:
+        idle, backoff = 0.05, 0.5
+        while not self._stopping:
+            try:
+                busy = await self._step()
+            except Exception as e:
+                # Ошибка общего состояния (например, "database is locked" при нескольких процессах)
+                # не должна молча останавливать цикл: пишем в журнал и пробуем снова после паузы
+                event_log.error("webhook_worker_error", worker=self.worker_id, error=f"{type(e).__name__}: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 10.0)
+                continue
+            backoff = 0.5
+            if busy:
+                idle = 0.05
+            else:
+                await asyncio.sleep(idle)
+                idle = min(idle * 2, 0.5)
+
+    async def _step(self) -> bool:
+        """Один апдейт: claim → handler (с продлением аренды) → ack (или fail). False — очередь пуста."""
+        claimed = await self.state.claim(self.worker_id, self.lease)
+        if claimed is None:
+            await self._maybe_purge()
+            return False
+        update_id, update, received_at = claimed
+        telemetry.observe("queue_wait_seconds", "webhook", time.time() - received_at)
+        t0 = time.perf_counter()
+        renewer = asyncio.create_task(self._renew(update_id))
+        try:
+            await self.handler(update)
+        except Exception as e:
+            telemetry.observe("stage_seconds", "update", time.perf_counter() - t0, error=True)
+            event_log.warning("webhook_update_failed", worker=self.worker_id, update_id=update_id,
+                              error=f"{type(e).__name__}: {e}")
+            await self.state.fail(update_id, f"{type(e).__name__}: {e}")
+            return True
+        finally:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+        telemetry.observe("stage_seconds", "update", time.perf_counter() - t0)
+        await self.state.ack(update_id)
+        self.processed += 1
+        return True
+
+    async def _renew(self, update_id: int) -> None:
+        """Пока хендлер работает, продлевает аренду каждые lease/3 секунд — долгий апдейт не уходит другому воркеру."""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await self.state.extend(update_id, self.worker_id, self.lease):
+                    event_log.warning("webhook_lease_lost", worker=self.worker_id, update_id=update_id)
+                    return
+            except Exception as e:
+                event_log.warning("webhook_lease_renew_failed", worker=self.worker_id, update_id=update_id,
+                                  error=f"{type(e).__name__}: {e}")
+
+    async def _maybe_purge(self) -> None:
+        if time.monotonic() - self._last_purge < 600:
+            return
+        self._last_purge = time.monotonic()
+        await self.state.purge(self.retention)
+
+
+async def serve_asgi(app, host: str, port: int) -> None:
+    """Запускает ASGI-приложение под uvicorn (необязательная зависимость режима webhook)."""
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("Для режима webhook нужен ASGI-сервер: pip install uvicorn")
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, lifespan="on", log_level="warning"))
+    await server.serve()
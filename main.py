@@ -1,126 +1,106 @@
 # File: main.py — основной бот Архиметрикс (логика Telegram-бота)
 
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 import os
-import requests
+import signal
+import socket
+import subprocess
+import sys
+import time
 import json
+import asyncio
 import re
-from bot.services.parser_adapter import fetch_channel_summary
-
-with open("Arhy_prompt_main.txt", encoding="utf-8") as f:
-    BASE_PROMPT = f.read()
-
-import csv
 from datetime import datetime
 
-def log_user_action(user_id, username, action, data):
-    with open("user_log.csv", "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([datetime.now().isoformat(), user_id, username, action, data])
-
-# Функция для подсчета количества пробных анализов по user_id
-def get_trial_count(user_id):
-    try:
-        with open("user_log.csv", "r", encoding="utf-8") as f:
-            return sum(
-                int(row[1]) == int(user_id) and "Пробный анализ — ссылка" in row[3]
-                for row in csv.reader(f)
-            )
-    except FileNotFoundError:
-        return 0
-
-# Функция для сбора данных TGStat
-def collect_tgstat_data(channel_link):
-    """
-    Собирает все необходимые данные TGStat для промпта.
-    """
-    channel = channel_link.replace("https://t.me/", "").strip("/")
-    print("TGStat channelId:", channel)
-    base_url = "https://api.tgstat.ru"
-    token = TGSTAT_TOKEN
-
-    def get(endpoint, **kwargs):
-        url = f"{base_url}/{endpoint}"
-        params = {"token": token, "channelId": channel}
-        params.update(kwargs)
-        try:
-            resp = requests.get(url, params=params, timeout=10)
-            return resp.json()
-        except Exception as e:
-            return {"error": str(e)}
-
-    data = {}
-
-    # 1. channels/get
-    data["get"] = get("channels/get")
-
-    # 2. channels/stat
-    data["stat"] = get("channels/stat")
-
-    # 3. channels/subscribers
-    data["subscribers"] = get("channels/subscribers", period="month")  # динамика за месяц
-
-    # 4. channels/views
-    data["views"] = get("channels/views", period="month")
-
-    # 5. channels/err
-    data["err"] = get("channels/err", period="month")
-
-    # 6. channels/mentions
-    data["mentions"] = get("channels/mentions", limit=10)  # последние 10 упоминаний
-
-    # 7. channels/forwards
-    data["forwards"] = get("channels/forwards", limit=10)  # последние 10 форвардов
-
-    # 8. channels/posts
-    posts_resp = get("channels/posts", limit=5)  # последние 5 постов
-    data["posts"] = posts_resp
+from dotenv import load_dotenv
 
-    # 9. posts/stat для каждого поста (если есть посты)
-    if posts_resp.get("ok") and posts_resp.get("result"):
-        data["posts_stat"] = []
-        for post in posts_resp["result"]:
-            post_id = post.get("id")
-            if post_id:
-                stat = get("posts/stat", postId=post_id)
-                data["posts_stat"].append({"post_id": post_id, "stat": stat})
-    else:
-        data["posts_stat"] = []
+# .env читаем до импорта модулей бота: их настройки и синглтоны берутся из окружения при импорте
+load_dotenv()
 
-    # 10. channels/adposts (реклама)
-    data["adposts"] = get("channels/adposts", limit=5)
+from bot.services.parser_adapter import default_sources, fetch_channel_summary, source_data
+from bot.services.sources import TELEGRAM_ANALYSIS_COST
+from parser_core import start_clients, stop_clients, normalize_username, compute_channel_metrics
+from parser_core import track_channel, start_snapshots, stop_snapshots
+from bot.services.analysis_cache import AnalysisCache
+from bot.services.prompt_builder import build_payload, build_messages
+from bot.services.batch import run_batch, default_output_path
+from bot.services.llm import complete as llm_complete, close_client as close_llm_client
+from bot.services.user_store import UserStore
+from bot.services.event_log import event_log
+from bot.services.telemetry import telemetry, new_trace, serve_prometheus
+from bot.services.quota import quota, QuotaExceeded, PRIORITY_PAID, PRIORITY_TRIAL, PRIORITY_BATCH, PRIORITY_BACKGROUND
+from bot.services.analysis_jobs import AnalysisQueue, AnalysisJob, QueueFullError, UserLimitError
+from bot.services.tgstat import close_client as close_tgstat_client
+from bot.services.channel_index import ChannelIndex, IndexRefresher, build_entry
+from bot.services.shared_state import SQLiteSharedState
+from bot.services.webhook import WebhookReceiver, UpdateWorker, serve_asgi
 
-    print("TGStat ответ:", json.dumps(data, ensure_ascii=False, indent=2))
-    return data
+with open("Arhy_prompt_main.txt", encoding="utf-8") as f:
+    BASE_PROMPT = f.read()
 
-from dotenv import load_dotenv
+def log_user_action(user_id, username, action, data):
+    # Строка уходит в буфер журнала; на диск пишет фоновый поток пачками
+    event_log.user_action(user_id, username, action, data)
+
+# Состояние пользователей (верификация, счётчик пробных анализов, подписка)
+user_store = UserStore(os.getenv("USER_DB_PATH", "users.db"))
+# Общее состояние процессов бота: очередь апдейтов webhook, анализы в работе, флаги диалогов
+# Анализ без heartbeat дольше ANALYSIS_STALE_AFTER секунд подхватывает другой воркер
+shared_state = SQLiteSharedState(os.getenv("STATE_DB_PATH", "state.db"), user_store,
+                                 stale_after=float(os.getenv("ANALYSIS_STALE_AFTER", "30")))
+# Имя процесса в общем состоянии (в режиме webhook задаётся запускающим процессом)
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# Последние метрики и вердикты проанализированных каналов (для /compare и /top)
+channel_index = ChannelIndex(os.getenv("CHANNEL_INDEX_PATH", "channels.db"))
 
-load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 TGSTAT_TOKEN = os.getenv("TGSTAT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 # OpenAI integration
-import openai
-
-def ask_chatgpt(analysis_json: str):
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "1000"))
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "1") == "1"
+# Бюджет на блок данных канала в промпте (без BASE_PROMPT)
+PROMPT_DATA_BUDGET = int(os.getenv("PROMPT_DATA_BUDGET", "2500"))
+
+# Квоты апстримов: сколько интерактивный запрос готов ждать, прежде чем попросить пользователя зайти позже
+QUOTA_MAX_WAIT = float(os.getenv("QUOTA_MAX_WAIT", "120"))
+# Стоимость фонового снимка в единицах квоты Telegram (вызовы API)
+TELEGRAM_SNAPSHOT_COST = 2
+
+async def ask_chatgpt(payload: dict, on_partial=None):
     """
-    Отправляет единый промпт: BASE_PROMPT + объединённые данные канала
-    (parser_core + tgstat), переданные строкой JSON.
+    Отправляет промпт: BASE_PROMPT как неизменный system-префикс + компактный JSON
+    с данными канала в user-сообщении. Записывает оценку и фактический расход токенов.
+    В режиме стриминга on_partial получает светофор до окончания ответа.
     """
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    full_prompt = BASE_PROMPT + "\n\nДанные канала (parser_core + TGStat, если доступен):\n" + analysis_json
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Ты — эксперт по анализу Telegram-каналов."},
-            {"role": "user", "content": full_prompt}
-        ],
-        max_tokens=1000,
-        temperature=0.1,
+    messages, prompt_tokens_est = build_messages(BASE_PROMPT, payload)
+    telemetry.observe("payload_bytes", "user", len(messages[-1]["content"].encode("utf-8")))
+    with telemetry.timer("openai"):
+        text, usage = await llm_complete(
+            messages,
+            model=OPENAI_MODEL,
+            max_tokens=OPENAI_MAX_TOKENS,
+            temperature=0.1,
+            stream=OPENAI_STREAM,
+            on_partial=on_partial,
+            api_key=OPENAI_API_KEY,
+            cost_tokens=prompt_tokens_est + OPENAI_MAX_TOKENS,
+        )
+    telemetry.observe("tokens", "prompt_est", prompt_tokens_est)
+    if usage is not None:
+        telemetry.observe("tokens", "prompt", getattr(usage, "prompt_tokens", 0) or 0)
+        telemetry.observe("tokens", "completion", getattr(usage, "completion_tokens", 0) or 0)
+    event_log.info(
+        "openai_usage",
+        prompt_tokens_est=prompt_tokens_est,
+        prompt_tokens=getattr(usage, "prompt_tokens", None),
+        cached_tokens=getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None),
+        completion_tokens=getattr(usage, "completion_tokens", None),
     )
-    return response.choices[0].message.content.strip()
+    return text.strip()
 
 def format_gpt_reply(gpt_json_str):
     try:
@@ -167,17 +147,7 @@ back_keyboard = ReplyKeyboardMarkup([["Назад"]], resize_keyboard=True)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    print("user_id для проверки верификации:", user_id)
-    already_verified = False
-    try:
-        with open("user_log.csv", "r", encoding="utf-8") as f:
-            for row in csv.reader(f):
-                print("Проверяем строку:", row)
-                if int(row[1]) == int(user_id) and "Верификация" in row[3]:
-                    already_verified = True
-                    break
-    except FileNotFoundError:
-        pass
+    already_verified = await user_store.is_verified(user_id)
 
     if already_verified:
         await update.message.reply_text(
@@ -196,20 +166,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.from_user.username
 
     # Проверяем, был ли пользователь уже верифицирован
-    already_verified = False
-    try:
-        with open("user_log.csv", "r", encoding="utf-8") as f:
-            for row in csv.reader(f):
-                print("Проверяем строку:", row)
-                if int(row[1]) == int(user_id) and "Верификация" in row[3]:
-                    already_verified = True
-                    break
-    except FileNotFoundError:
-        pass
+    already_verified = await user_store.is_verified(user_id)
 
     if text == "Предоставить свои данные" and not already_verified:
-        print(f"Верифицирован пользователь: ID={user_id}, username={username}")
+        event_log.info("user_verified", user_id=user_id, username=username)
         log_user_action(user_id, username, "Верификация", "")
+        await user_store.mark_verified(user_id, username)
         await update.message.reply_text(
             "✅ Спасибо! Вы верифицированы.\n\nТеперь вы можете воспользоваться пробным анализом или оформить подписку.",
             reply_markup=ReplyKeyboardRemove()
@@ -220,7 +182,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif text == "Пробный анализ":
         max_trials = 5
-        used_trials = get_trial_count(user_id)
+        used_trials = await user_store.get_trial_count(user_id)
         left = max_trials - used_trials
         await update.message.reply_text(
             f"У вас осталось [{left}] из {max_trials} пробных анализов.\n\nСкопируйте адрес канала в строку сообщения и нажмите «Отправить».",
@@ -238,42 +200,617 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Выберите действие:", reply_markup=menu_keyboard)
 
     elif re.search(r"(https?://)?t\.me/[A-Za-z0-9_]+", text):
-        print(f"Пробный анализ для пользователя ID={user_id}, username={username}, ссылка={text}")
-        log_user_action(user_id, username, "Пробный анализ — ссылка", text)
-        await update.message.reply_text("🟢 Принято! Ваш запрос на пробный анализ принят. Выполняется анализ…")
+        if await shared_state.analysis_for_update(update.update_id) is not None:
+            # Апдейт обрабатывается повторно после падения воркера: анализ уже принят и будет доведён
+            await shared_state.charge_trial(user_id, username, update.update_id)
+            return
+        priority = PRIORITY_PAID if await user_store.has_subscription(user_id) else PRIORITY_TRIAL
+        # Лимит на пользователя общий для всех воркеров: предыдущий анализ мог запустить другой процесс.
+        # Принятый анализ хранится в общем состоянии, пока не отправлен отчёт: если этот воркер упадёт,
+        # анализ доведёт другой (adopt_analyses)
+        analysis_id = await shared_state.begin_analysis(
+            user_id, WORKER_ID, text, analysis_queue.per_user_limit,
+            payload={"chat_id": update.effective_chat.id, "priority": priority}, update_id=update.update_id)
+        if analysis_id is None:
+            await update.message.reply_text("⏳ Предыдущий анализ ещё выполняется. Дождитесь результата или отправьте /cancel.")
+            return
+        event_log.info("trial_link", user_id=user_id, username=username, link=text)
+        status_msg = await update.message.reply_text("🟢 Принято! Ваш запрос на пробный анализ принят. Выполняется анализ…")
+
+        async def on_progress(stage: str):
+            await status_msg.edit_text(f"🟢 Принято! Ваш запрос на пробный анализ принят. Выполняется анализ…\n{stage}")
 
         try:
-            # 1) Сбор из parser_core (ядро на Telegram API)
-            parser_data = fetch_channel_summary(text)
-
-            # 2) TGStat как дополнительный источник (если токен задан)
-            tgstat_data = {}
-            if TGSTAT_TOKEN:
-                try:
-                    tgstat_data = collect_tgstat_data(text)
-                except Exception as e:
-                    tgstat_data = {"error": f"TGStat failed: {e}"}
-            else:
-                tgstat_data = {"skipped": "TGSTAT_TOKEN not set"}
-
-            # 3) Объединяем и отправляем в ИИ
-            analysis_payload = {
-                "parser_core": parser_data,
-                "tgstat": tgstat_data,
-            }
-            analysis_json = json.dumps(analysis_payload, ensure_ascii=False, indent=2)
-
-            gpt_reply = ask_chatgpt(analysis_json)
-            formatted_reply = format_gpt_reply(gpt_reply)
-            await update.message.reply_text(formatted_reply)
-            await update.message.reply_text("Выберите действие:", reply_markup=menu_keyboard)
-        except Exception as e:
-            await update.message.reply_text(f"Ошибка при анализе: {e}")
+            job = analysis_queue.submit(user_id, text, on_progress, priority=priority,
+                                        payload={"reply": update.message.reply_text, "analysis_id": analysis_id})
+        except (QueueFullError, UserLimitError):
+            await shared_state.end_analysis(analysis_id)
+            await status_msg.edit_text("⏳ Сейчас слишком много запросов на анализ. Попробуйте через пару минут.")
+            return
+        wait = estimated_wait(job)
+        if wait >= 5 and job.stage == "queued":
+            await on_progress(f"Ориентировочное ожидание: {format_wait(wait)}")
+        log_user_action(user_id, username, "Пробный анализ — ссылка", text)
+        # Повторная доставка того же апдейта не списывает пробный анализ второй раз
+        await shared_state.charge_trial(user_id, username, update.update_id)
     else:
         await update.message.reply_text("Не понимаю. Пожалуйста, используйте кнопки.")
 
-if __name__ == "__main__":
-    app = ApplicationBuilder().token(TOKEN).build()
+# Кэш этапов анализа по нормализованному username (TTL в секундах; диск — опционально, у воркеров webhook всегда)
+analysis_cache = AnalysisCache(
+    ttls={
+        "telegram": float(os.getenv("CACHE_TTL_TELEGRAM", "600")),
+        "tgstat": float(os.getenv("CACHE_TTL_TGSTAT", "1800")),
+        "deep": float(os.getenv("CACHE_TTL_DEEP", str(6 * 3600))),
+        "verdict": float(os.getenv("CACHE_TTL_VERDICT", "3600")),
+    },
+    max_bytes=int(os.getenv("CACHE_MAX_MB", "64")) * 1024 * 1024,
+    disk_path=os.getenv("CACHE_DISK_PATH") or None,
+    # Сколько другие процессы ждут ключ, который грузит этот (дольше самого долгого источника — deep)
+    load_lease=float(os.getenv("CACHE_LOAD_LEASE", "200")),
+)
+
+def _parser_ok(data) -> bool:
+    return not data.get("meta", {}).get("error")
+
+def _verdict_ok(reply) -> bool:
+    try:
+        return isinstance(json.loads(reply), dict)
+    except Exception:
+        return False
+
+def _channel_key(link: str) -> str:
+    return normalize_username(link).lower()
+
+async def _cached_source_call(source, link: str) -> dict:
+    """Каждый источник кэшируется отдельно (пространство кэша = имя источника)."""
+    return await analysis_cache.get_or_fetch(
+        source.name, _channel_key(link), lambda: source.fetch(link), cacheable=source.plugin.cacheable)
+
+async def stage_sources(link: str, names=None) -> dict:
+    """Этапы 1–2: все включённые источники (Telegram, TGStat, …) параллельно, результат — в единой схеме."""
+    data = await fetch_channel_summary(link, names=names, call=_cached_source_call)
+    if "telegram" in (names or ["telegram"]) and "telegram" not in data["missing"]:
+        # Канал попадает в периодический сбор снимков — со временем у него появятся time_series
+        await track_channel(link)
+    return data
+
+# Подписи светофора для предварительного вывода во время стриминга
+TRAFFIC_LIGHT_EMOJI = {"green": "🟢", "yellow": "🟡", "red": "🔴"}
+
+async def stage_verdict(link: str, parser_data: dict, tgstat_data: dict, progress=None) -> str:
+    """Этап 3: метрики TNG считаются локально; в ИИ уходит компактный payload в рамках бюджета токенов."""
+    async def on_partial(light):
+        if progress:
+            emoji = TRAFFIC_LIGHT_EMOJI.get(light["color"], "⚪️")
+            await progress(f"Предварительный вывод: {emoji} {light.get('recommendation') or light['color']}\nФормируем полный отчёт…")
+
+    async def compute():
+        payload = build_payload(parser_data, tgstat_data, PROMPT_DATA_BUDGET)
+        return await ask_chatgpt(payload, on_partial=on_partial)
+    return await analysis_cache.get_or_fetch("verdict", _channel_key(link), compute, cacheable=_verdict_ok)
+
+async def analyze_channel(link: str, progress=None, names=None) -> str:
+    """
+    Конвейер анализа канала: источники данных параллельно → ИИ. Возвращает сырой ответ ИИ (JSON-строку).
+    Каждый источник и вердикт кэшируются отдельно; одновременные запросы одного канала объединяются.
+    names — источники (по умолчанию интерактивные, без глубокого скана).
+    """
+    async def report(stage: str):
+        if progress:
+            await progress(stage)
+
+    # Вердикт из любого уровня кэша (память или диск) — источники не опрашиваем
+    cached = await analysis_cache.lookup("verdict", _channel_key(link))
+    if cached is not None:
+        return cached
+    await report("Этап 1/2: сбор данных (Telegram, TGStat)…")
+    data = await stage_sources(link, names=names)
+    await report("Этап 2/2: анализ ИИ…")
+    tgstat_data = source_data(data, "tgstat")
+    reply = await stage_verdict(link, data, tgstat_data, progress)
+    await index_analysis(link, data, tgstat_data, reply)
+    return reply
+
+async def index_analysis(link: str, parser_data: dict, tgstat_data: dict, reply: str) -> None:
+    """Сохраняет метрики и вердикт в индекс каналов; неполный анализ индекс не перезаписывает."""
+    if not (_parser_ok(parser_data) and _verdict_ok(reply)):
+        return
+    try:
+        metrics = compute_channel_metrics(parser_data, tgstat_data)
+        await channel_index.record(build_entry(_channel_key(link), parser_data, tgstat_data, metrics, reply))
+    except Exception as e:
+        event_log.warning("channel_index_failed", link=link, error=str(e))
+
+# Пакетный режим: источники опрашиваются отдельными этапами, параллелизм задаётся для каждого апстрима
+async def _batch_stage_telegram(ctx: dict) -> dict:
+    # Ошибка parser_core делает строку неуспешной — при возобновлении канал будет обработан снова.
+    # Глубокий скан (если DEEP_SCAN=1) идёт вместе с Telegram: в пакете его долгий таймаут никого не держит
+    parser_data = await stage_sources(ctx["link"], names=["telegram", "deep"])
+    if not _parser_ok(parser_data):
+        raise RuntimeError(parser_data["meta"]["error"])
+    return parser_data
+
+async def _batch_stage_tgstat(ctx: dict) -> dict:
+    return source_data(await stage_sources(ctx["link"], names=["tgstat"]), "tgstat")
+
+async def _batch_stage_llm(ctx: dict) -> str:
+    reply = await stage_verdict(ctx["link"], ctx["telegram"], ctx["tgstat"])
+    await index_analysis(ctx["link"], ctx["telegram"], ctx["tgstat"], reply)
+    return reply
+
+BATCH_STAGES = [
+    ("telegram", _batch_stage_telegram),
+    ("tgstat", _batch_stage_tgstat),
+    ("llm", _batch_stage_llm),
+]
+BATCH_LIMITS = {
+    "telegram": int(os.getenv("BATCH_TELEGRAM_CONCURRENCY", "4")),
+    "tgstat": int(os.getenv("BATCH_TGSTAT_CONCURRENCY", "8")),
+    "llm": int(os.getenv("BATCH_LLM_CONCURRENCY", "4")),
+}
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "16"))
+
+def _batch_record(ctx: dict) -> dict:
+    """Строка результата: вердикт ИИ и ключевые метрики (без сырых данных)."""
+    try:
+        verdict = json.loads(ctx["llm"])
+    except Exception:
+        verdict = {"raw": ctx["llm"]}
+    metrics = compute_channel_metrics(ctx["telegram"], ctx["tgstat"])
+    return {
+        "verdict": verdict,
+        "color": (verdict.get("traffic_light") or {}).get("color") if isinstance(verdict, dict) else None,
+        "subscribers": metrics.get("subscribers"),
+        "err_pct": metrics.get("err_pct"),
+        "signals": metrics.get("signals"),
+        "tgstat_error": ctx["tgstat"].get("error") or ctx["tgstat"].get("skipped"),
+    }
+
+async def run_batch_file(links_path: str, out_path=None, resume: bool = True, on_record=None):
+    # Пакет уступает квоты интерактивным запросам пользователей и ждёт их без ограничения
+    with quota.scope(PRIORITY_BATCH):
+        return await run_batch(
+            links_path, BATCH_STAGES, out_path=out_path, limits=BATCH_LIMITS, workers=BATCH_WORKERS,
+            resume=resume, key_fn=_channel_key, record_fn=_batch_record, on_record=on_record,
+        )
+
+async def run_analysis(job: AnalysisJob):
+    """
+    Полный цикл анализа одной ссылки; выполняется воркером очереди.
+    Все этапы асинхронные, этапы и предварительный светофор отображаются в статусном сообщении.
+    payload["reply"](text, **kwargs) отправляет сообщение в чат пользователя.
+    """
+    reply = job.payload["reply"]
+    trace_id = new_trace()
+    # Остановка процесса (не /cancel) оставляет анализ в общем состоянии — его доведёт другой воркер
+    keep = False
+    telemetry.observe("queue_wait_seconds", "analysis", time.monotonic() - job.created_at)
+    event_log.info("analysis_started", user_id=job.user_id, link=job.link)
+    try:
+        with telemetry.timer("total"), quota.scope(job.priority, QUOTA_MAX_WAIT):
+            gpt_reply = await analyze_channel(job.link, job.progress)
+            with telemetry.timer("format"):
+                formatted_reply = format_gpt_reply(gpt_reply)
+        await job.progress("Готово ✅")
+        await reply(formatted_reply)
+        await reply("Выберите действие:", reply_markup=menu_keyboard)
+    except QuotaExceeded as e:
+        event_log.warning("analysis_quota_exceeded", upstream=e.upstream, retry_after=round(e.retry_after))
+        await reply(
+            f"⏳ Сервисы сейчас перегружены ({e.upstream}). Попробуйте через {format_wait(e.retry_after)}.",
+            reply_markup=menu_keyboard)
+    except asyncio.CancelledError:
+        keep = not job.cancelled
+        raise
+    except Exception as e:
+        event_log.error("analysis_failed", error=str(e))
+        await reply(f"Ошибка при анализе: {e}\nКод запроса: {trace_id}")
+    finally:
+        if job.payload.get("analysis_id") is not None and not keep:
+            await shared_state.end_analysis(job.payload["analysis_id"])
+
+# Очередь анализов: ограниченное число параллельных задач и не больше N задач на пользователя
+analysis_queue = AnalysisQueue(
+    run_analysis,
+    concurrency=int(os.getenv("ANALYSIS_CONCURRENCY", "4")),
+    per_user_limit=int(os.getenv("ANALYSIS_PER_USER_LIMIT", "1")),
+    max_queue=int(os.getenv("ANALYSIS_QUEUE_SIZE", "100")),
+)
+
+def estimated_wait(job: AnalysisJob) -> float:
+    """Ожидание до результата сверх обычного времени анализа: очередь бота плюс самая загруженная квота."""
+    upstream_wait = max(
+        quota.estimate_wait("telegram", TELEGRAM_ANALYSIS_COST, job.priority),
+        quota.estimate_wait("tgstat", 1, job.priority) if TGSTAT_TOKEN else 0.0,
+        quota.estimate_wait("openai", PROMPT_DATA_BUDGET + OPENAI_MAX_TOKENS, job.priority),
+    )
+    return analysis_queue.estimate_wait(job) + upstream_wait
+
+def format_wait(seconds: float) -> str:
+    if seconds < 60:
+        return f"~{max(int(seconds), 1)} с"
+    return f"~{int(seconds // 60) + 1} мин"
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    # Анализы этого процесса отменяются сразу, других воркеров — при их ближайшем heartbeat
+    cancelled_here = analysis_queue.cancel_user(user_id)
+    cancelled_elsewhere = await shared_state.cancel_analyses(user_id)
+    if cancelled_here or cancelled_elsewhere:
+        await update.message.reply_text("Анализ отменён.", reply_markup=menu_keyboard)
+    else:
+        await update.message.reply_text("Нет активных анализов.", reply_markup=menu_keyboard)
+
+# Администраторы бота (id через запятую): пакетный анализ и служебные команды
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+async def batch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    # Файл может прийти на другой воркер — флаг хранится в общем состоянии
+    await shared_state.set_flag(update.message.from_user.id, "awaiting_batch", ttl=600)
+    await update.message.reply_text("Пришлите .txt файл со списком каналов (ссылки t.me/… или @username, по одной в строке).")
+
+async def handle_batch_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await shared_state.pop_flag(update.message.from_user.id, "awaiting_batch"):
+        return
+    user_id = update.message.from_user.id
+    os.makedirs("batch", exist_ok=True)
+    links_path = os.path.join("batch", f"{user_id}_{datetime.now():%Y%m%d_%H%M%S}.txt")
+    tg_file = await update.message.document.get_file()
+    await tg_file.download_to_drive(links_path)
+    status_msg = await update.message.reply_text("📦 Пакетный анализ запущен…")
+
+    async def on_record(record, stats):
+        processed = stats.ok + stats.failed
+        if processed % 10 == 0:
+            try:
+                await status_msg.edit_text(f"📦 Пакетный анализ: обработано {processed} (ошибок {stats.failed})…")
+            except Exception:
+                pass
+
+    async def run():
+        out_path = default_output_path(links_path)
+        try:
+            stats = await run_batch_file(links_path, out_path, on_record=on_record)
+            await update.message.reply_text("✅ Пакетный анализ завершён.\n" + stats.format())
+            with open(out_path, "rb") as f:
+                await update.message.reply_document(f, filename=os.path.basename(out_path))
+        except Exception as e:
+            await update.message.reply_text(f"Ошибка пакетного анализа: {e}")
+
+    # Не блокируем обработку других апдейтов на всё время пакета
+    context.application.create_task(run())
+
+# Индекс каналов: записи старше INDEX_MAX_AGE секунд обновляются в фоне при обращении к ним
+INDEX_MAX_AGE = float(os.getenv("INDEX_MAX_AGE", str(24 * 3600)))
+COMPARE_MAX_CHANNELS = 10
+
+async def _refresh_indexed(channel: str):
+    # Фоновое обновление уступает квоты пользователям и пакетам
+    with quota.scope(PRIORITY_BACKGROUND):
+        await analyze_channel(channel, names=default_sources(background=True))
+
+index_refresher = IndexRefresher(
+    _refresh_indexed, max_age=INDEX_MAX_AGE, concurrency=int(os.getenv("INDEX_REFRESH_CONCURRENCY", "2")))
+
+def format_age(seconds: float) -> str:
+    if seconds < 3600:
+        return f"{max(int(seconds // 60), 1)} мин назад"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч назад"
+    return f"{int(seconds // 86400)} дн назад"
+
+def format_index_row(entry: dict) -> str:
+    emoji = TRAFFIC_LIGHT_EMOJI.get(entry["color"], "⚪️")
+    parts = [f"{emoji} {entry['channel']}"]
+    if entry["subscribers"] is not None:
+        parts.append(f"{entry['subscribers']:,} подп.".replace(",", " "))
+    if entry["err_pct"] is not None:
+        parts.append(f"ERR {entry['err_pct']}%")
+    if entry["fake_pct"] is not None:
+        parts.append(f"накрутка ~{entry['fake_pct']}%")
+    return " · ".join(parts) + f" (данные {format_age(time.time() - entry['analyzed_at'])})"
+
+def _refresh_note(entries) -> str:
+    refreshing = index_refresher.schedule(entries)
+    return f"\n\n🔄 Обновляются в фоне: {', '.join(refreshing)}" if refreshing else ""
+
+async def compare_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/compare @a @b @c — сравнение каналов по индексу, без живого анализа."""
+    keys = list(dict.fromkeys(_channel_key(arg) for arg in context.args))[:COMPARE_MAX_CHANNELS]
+    if len(keys) < 2:
+        await update.message.reply_text("Укажите от 2 до 10 каналов: /compare @channel1 @channel2 …")
+        return
+    with telemetry.timer("index_compare"):
+        found = await channel_index.lookup(keys)
+    lines = ["📊 Сравнение каналов:"]
+    for key in keys:
+        entry = found.get(key)
+        lines.append(format_index_row(entry) if entry else f"❔ {key} — ещё не анализировался: пришлите ссылку на канал")
+    await update.message.reply_text("\n".join(lines) + _refresh_note(found.values()))
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/top <категория> — лучшие каналы категории из индекса."""
+    category = " ".join(context.args).strip()
+    if not category:
+        known = await channel_index.known_categories()
+        hint = ", ".join(c["category"] for c in known) or "индекс пока пуст"
+        await update.message.reply_text(f"Укажите категорию: /top <категория>\nИзвестные категории: {hint}")
+        return
+    with telemetry.timer("index_top"):
+        entries = await channel_index.ranking(category, limit=10)
+    if not entries:
+        await update.message.reply_text(f"В категории «{category}» пока нет проанализированных каналов.")
+        return
+    lines = [f"🏆 Топ каналов «{category}»:"] + [f"{i}. {format_index_row(e)}" for i, e in enumerate(entries, 1)]
+    await update.message.reply_text("\n".join(lines) + _refresh_note(entries))
+
+def _runtime_gauges() -> dict:
+    stats = analysis_cache.stats
+    lookups = stats["hits"] + stats["disk_hits"] + stats["misses"] + stats["coalesced"]
+    return {
+        "cache_hit_rate": round((stats["hits"] + stats["disk_hits"] + stats["coalesced"]) / lookups, 3) if lookups else 0.0,
+        "cache_bytes": analysis_cache.bytes_used,
+        "analysis_queue_depth": analysis_queue.depth(),
+        "event_log_dropped": event_log.dropped,
+    }
+
+telemetry.add_collector(_runtime_gauges)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    await update.message.reply_text(telemetry.format_text())
+
+ANALYSIS_HEARTBEAT = 2.0
+# Сколько раз анализ подхватывается заново после падения воркеров, прежде чем сообщить об ошибке
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3"))
+
+async def _resume_analysis(bot, adopted: dict):
+    """Анализ упавшего (или остановленного) воркера: ставим в свою очередь, отчёт — новым сообщением в чат."""
+    payload, link = adopted["payload"], adopted["link"]
+    reply = lambda text, **kwargs: bot.send_message(payload["chat_id"], text, **kwargs)
+    if adopted["attempts"] > ANALYSIS_MAX_ATTEMPTS:
+        event_log.error("analysis_abandoned", user_id=adopted["user_id"], link=link, attempts=adopted["attempts"])
+        await shared_state.end_analysis(adopted["analysis_id"])
+        await reply(f"Ошибка при анализе {link}: анализ прерывался несколько раз. Попробуйте отправить ссылку ещё раз.",
+                    reply_markup=menu_keyboard)
+        return
+    status_msg = await reply(f"🔄 Анализ {link} возобновлён после перезапуска сервиса…")
+
+    async def on_progress(stage: str):
+        await status_msg.edit_text(f"🔄 Анализ {link} возобновлён после перезапуска сервиса…\n{stage}")
+
+    try:
+        analysis_queue.submit(adopted["user_id"], link, on_progress, priority=payload.get("priority", PRIORITY_TRIAL),
+                              payload={"reply": reply, "analysis_id": adopted["analysis_id"]})
+    except (QueueFullError, UserLimitError):
+        # Очередь заполнилась — анализ снова ничей и достанется следующему свободному воркеру
+        await shared_state.release_analyses(WORKER_ID, [adopted["analysis_id"]])
+        return
+    event_log.info("analysis_resumed", user_id=adopted["user_id"], link=link, attempts=adopted["attempts"])
+
+async def _watch_analyses(bot):
+    """
+    Heartbeat анализов процесса в общем состоянии, отмена, запрошенная через другой воркер,
+    и подхват анализов, чей воркер перестал слать heartbeat.
+    """
+    while True:
+        await asyncio.sleep(ANALYSIS_HEARTBEAT)
+        jobs = {job.payload.get("analysis_id"): job for job in analysis_queue.jobs()}
+        try:
+            cancelled = await shared_state.heartbeat(WORKER_ID, [i for i in jobs if i is not None])
+            free = analysis_queue.max_queue - len(jobs)
+            adopted = await shared_state.adopt_analyses(WORKER_ID, min(free, analysis_queue.concurrency))
+        except Exception as e:
+            event_log.warning("analysis_heartbeat_failed", error=str(e))
+            continue
+        for analysis_id in cancelled:
+            if analysis_id in jobs:
+                analysis_queue.cancel_user(jobs[analysis_id].user_id)
+        for item in adopted:
+            try:
+                await _resume_analysis(bot, item)
+            except Exception as e:
+                event_log.warning("analysis_resume_failed", analysis_id=item["analysis_id"], error=str(e))
+                try:
+                    await shared_state.release_analyses(WORKER_ID, [item["analysis_id"]])
+                except Exception:
+                    pass  # общее состояние недоступно — ошибка уже в журнале
+
+async def post_init(application):
+    # Открываем хранилище; при первом запуске переносим историю из user_log.csv
+    await user_store.open(legacy_csv="user_log.csv")
+    await shared_state.open()
+    await analysis_queue.start()
+    application.bot_data["analysis_watcher"] = asyncio.create_task(_watch_analyses(application.bot))
+    # Telethon-клиенты живут всё время работы бота на его event loop
+    await start_clients()
+    if os.getenv("SNAPSHOT_ENABLED", "1") == "1":
+        # Снимки идут с фоновым приоритетом и уступают квоту Telegram запросам пользователей
+        await start_snapshots(
+            gate=lambda: quota.acquire("telegram", TELEGRAM_SNAPSHOT_COST, PRIORITY_BACKGROUND),
+            on_error=lambda channel, error: event_log.warning("snapshot_failed", channel=channel, error=error))
+    # Необязательный эндпоинт /metrics в формате Prometheus
+    if os.getenv("METRICS_PORT"):
+        application.bot_data["metrics_server"] = await serve_prometheus(
+            telemetry, os.getenv("METRICS_HOST", "127.0.0.1"), int(os.getenv("METRICS_PORT")))
+
+async def post_shutdown(application):
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    watcher = application.bot_data.pop("analysis_watcher", None)
+    if watcher is not None:
+        watcher.cancel()
+    await analysis_queue.stop()
+    # Незавершённые анализы процесса остались в общем состоянии — отдаём их другим воркерам сразу
+    await shared_state.release_analyses(WORKER_ID)
+    await index_refresher.stop()
+    channel_index.close()
+    await stop_snapshots()
+    await stop_clients()
+    analysis_cache.close()
+    shared_state.close()
+    await close_tgstat_client()
+    await close_llm_client()
+    event_log.stop()
+
+async def _batch_startup():
+    # Пакету нужны только источники и ИИ: без хранилища пользователей, очереди анализов и снимков
+    await start_clients()
+
+async def _batch_shutdown():
+    await stop_clients()
+    channel_index.close()
+    analysis_cache.close()
+    await close_tgstat_client()
+    await close_llm_client()
+    event_log.stop()
+
+async def _batch_cli(args):
+    """Пакетный анализ из командной строки: python main.py batch channels.txt [--out results.jsonl]."""
+    await _batch_startup()
+    try:
+        stats = await run_batch_file(args.links, args.out, resume=not args.no_resume)
+        print(stats.format())
+    finally:
+        await _batch_shutdown()
+
+# Режим webhook: приёмник (ASGI) кладёт апдейты в общую очередь, воркеры-процессы их обрабатывают
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Свой сервер Bot API (или локальная заглушка); по умолчанию — api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL")
+
+def _bot_base_url() -> str:
+    return (BOT_API_URL.rstrip("/") if BOT_API_URL else "https://api.telegram.org") + "/bot"
+
+def build_application(webhook: bool = False):
+    builder = ApplicationBuilder().token(TOKEN).base_url(_bot_base_url())
+    builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+    if webhook:
+        # Апдейты приходят из общей очереди, а не через getUpdates
+        builder = builder.updater(None)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("cancel", cancel))
+    app.add_handler(CommandHandler("batch", batch_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("compare", compare_command))
+    app.add_handler(CommandHandler("top", top_command))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_batch_file))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.run_polling()
\ No newline at end of file
+    return app
+
+async def _register_webhook():
+    if os.getenv("WEBHOOK_URL"):
+        async with Bot(TOKEN, base_url=_bot_base_url()) as bot:
+            await bot.set_webhook(os.getenv("WEBHOOK_URL"), secret_token=WEBHOOK_SECRET)
+
+# ASGI-приложение приёмника: python main.py webhook или любой ASGI-сервер (uvicorn main:webhook_app)
+webhook_app = WebhookReceiver(shared_state, WEBHOOK_PATH, WEBHOOK_SECRET, on_startup=_register_webhook)
+
+# Ошибки хендлеров по update_id: PTB ловит их внутри process_update и наружу не пробрасывает
+_handler_errors: dict = {}
+
+async def _remember_handler_error(update, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(update, Update):
+        _handler_errors[update.update_id] = context.error
+
+async def _process_update(app, data: dict) -> None:
+    """
+    Прогоняет апдейт через хендлеры и пробрасывает их ошибку: UpdateWorker тогда вызывает
+    state.fail (повтор с паузой), а не подтверждает апдейт как обработанный.
+    """
+    update = Update.de_json(data, app.bot)
+    await app.process_update(update)
+    error = _handler_errors.pop(update.update_id, None)
+    if error is not None:
+        raise error
+
+async def run_worker():
+    """Воркер режима webhook: берёт апдейты из общей очереди и прогоняет их через обычные хендлеры."""
+    app = build_application(webhook=True)
+    app.add_error_handler(_remember_handler_error)
+    # Воркеры делят кэш этапов (и объединяют загрузки одного канала) только через дисковый уровень
+    analysis_cache.use_disk(os.getenv("CACHE_DISK_PATH") or "cache.db")
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    worker = UpdateWorker(
+        shared_state, lambda data: _process_update(app, data), WORKER_ID,
+        concurrency=int(os.getenv("WORKER_CONCURRENCY", "8")), lease=float(os.getenv("UPDATE_LEASE", "60")),
+    )
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await worker.start()
+    event_log.info("worker_started", worker=WORKER_ID)
+    try:
+        await stop.wait()
+    finally:
+        await worker.stop()
+        await app.stop()
+        await post_shutdown(app)
+        await app.shutdown()
+
+def spawn_workers(count: int, command=None) -> list:
+    """
+    Запускает count процессов `main.py worker` (или command). Каждый получает свою долю квот, свои
+    сессии Telethon (файл сессии нельзя открывать из нескольких процессов) и свои файлы журналов;
+    снимки собирает только первый.
+    Воркеров не больше, чем сессий: два клиента на одной сессии ломают её файл и авторизацию.
+    """
+    from parser_core.telegram_parser import SESSION_NAMES as sessions
+    if count > len(sessions):
+        event_log.warning("webhook_workers_capped", requested=count, sessions=len(sessions))
+        count = len(sessions)
+    procs = []
+    for i in range(count):
+        env = dict(os.environ, WORKER_ID=f"{socket.gethostname()}:w{i}", QUOTA_WORKERS=os.getenv("QUOTA_WORKERS", str(count)),
+                   TELEGRAM_SESSIONS=",".join(sessions[i::count]))
+        if i > 0:
+            env["SNAPSHOT_ENABLED"] = "0"
+        # Журналы у каждого процесса свои: ротация одного файла из нескольких процессов теряет записи
+        for var, default in (("USER_LOG_PATH", "user_log.csv"), ("APP_LOG_PATH", "app_log.jsonl")):
+            base, ext = os.path.splitext(os.getenv(var, default))
+            env[var] = f"{base}.w{i}{ext}"
+        if os.getenv("METRICS_PORT"):
+            env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + i)
+        procs.append(subprocess.Popen(command or [sys.executable, os.path.abspath(__file__), "worker"], env=env))
+    return procs
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "batch":
+    import argparse
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Пакетный анализ каналов из файла")
+    parser.add_argument("links", help="файл со ссылками на каналы")
+    parser.add_argument("--out", default=None, help="JSONL с результатами (по умолчанию <links>.results.jsonl)")
+    parser.add_argument("--no-resume", action="store_true", help="не пропускать уже обработанные каналы")
+    asyncio.run(_batch_cli(parser.parse_args(sys.argv[2:])))
+elif __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "worker":
+    # Дополнительные воркеры (в том числе на других машинах с тем же общим состоянием)
+    asyncio.run(run_worker())
+elif __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "webhook":
+    import argparse
+    parser = argparse.ArgumentParser(prog="main.py webhook", description="Приёмник webhook и воркеры-процессы")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEBHOOK_WORKERS", "2")),
+                        help="сколько воркеров запустить на этой машине (0 — только приёмник)")
+    parser.add_argument("--host", default=os.getenv("WEBHOOK_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("WEBHOOK_PORT", "8080")))
+    args = parser.parse_args(sys.argv[2:])
+    workers = spawn_workers(args.workers)
+    try:
+        asyncio.run(serve_asgi(webhook_app, args.host, args.port))
+    finally:
+        for proc in workers:
+            proc.terminate()
+        for proc in workers:
+            proc.wait()
+elif __name__ == "__main__":
+    build_application().run_polling()
\ No newline at end of file
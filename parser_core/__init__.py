@@ -2,6 +2,10 @@ from __future__ import annotations
 
 # File: parser_core/__init__.py — экспорт публичных функций парсера
 
-from .telegram_parser import collect_channel_data
+from .telegram_parser import collect_channel_data, deep_scan_channel, start_clients, stop_clients
+from .telegram_parser import track_channel, start_snapshots, stop_snapshots
+from .telegram_parser import _normalize_username as normalize_username
+from .metrics import compute_channel_metrics
 
-__all__ = ["collect_channel_data"]
\ No newline at end of file
+__all__ = ["collect_channel_data", "deep_scan_channel", "start_clients", "stop_clients", "normalize_username", "compute_channel_metrics",
+           "track_channel", "start_snapshots", "stop_snapshots"]
\ No newline at end of file
@@ -0,0 +1,159 @@
+# File: parser_core/client_pool.py — пул долгоживущих Telethon-клиентов с кэшем сущностей
+
+from __future__ import annotations
+from typing import Dict, Any, List, Optional, Awaitable, Callable
+import asyncio
+import time
+
+try:
+    from telethon import TelegramClient
+    from telethon.errors import FloodWaitError
+except Exception:  # Telethon не установлен — telegram_parser сообщит об этом в meta
+    TelegramClient = None
+
+    class FloodWaitError(Exception):
+        seconds = 0
+
+
+class NoClientAvailable(Exception):
+    """В пуле нет подключённых авторизованных клиентов (или все во FloodWait)."""
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PooledClient:
+    """Один аккаунт пула: клиент, кэш сущностей и состояние FloodWait."""
+
+    def __init__(self, session: str, client):
+        self.session = session
+        self.client = client
+        self.in_flight = 0
+        self.flood_until = 0.0
+        # username -> InputPeer; access_hash привязан к аккаунту, поэтому кэш у каждого свой
+        self.entities: Dict[str, Any] = {}
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.flood_until
+
+
+class TelethonPool:
+    """
+    Держит клиенты подключёнными на event loop бота: рукопожатие и резолв каналов
+    выполняются один раз, а не на каждый запрос. Запросы распределяются по наименее
+    загруженному аккаунту; аккаунт во FloodWait временно исключается.
+    """
+
+    def __init__(self, sessions: List[str], api_id: int, api_hash: str, retry_interval: float = 30.0):
+        self.sessions = sessions
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.clients: List[PooledClient] = []
+        self.errors: Dict[str, str] = {}
+        # Не подключившиеся сессии пробуем снова не чаще раза в retry_interval секунд
+        self.retry_interval = retry_interval
+        self._started = False
+        self._last_attempt = 0.0
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        """
+        Подключает сессии, которых ещё нет в пуле. Пул считается запущенным, только когда
+        подключены все сессии; иначе следующий start (или run) повторит попытку для остальных.
+        """
+        async with self._lock:
+            if self._started or (self._last_attempt and time.monotonic() - self._last_attempt < self.retry_interval):
+                return
+            self._last_attempt = time.monotonic()
+            connected = {pc.session for pc in self.clients}
+            for session in self.sessions:
+                if session in connected:
+                    continue
+                client = TelegramClient(session, self.api_id, self.api_hash)
+                try:
+                    await client.connect()
+                    if not await client.is_user_authorized():
+                        self.errors[session] = "session is not authorized"
+                        await client.disconnect()
+                        continue
+                except Exception as e:
+                    self.errors[session] = f"connect failed: {e}"
+                    # Полуоткрытое соединение (или его фоновые задачи) не должно пережить неудачную попытку
+                    try:
+                        await client.disconnect()
+                    except Exception:
+                        pass
+                    continue
+                self.errors.pop(session, None)
+                self.clients.append(PooledClient(session, client))
+            self._started = len(self.clients) == len(self.sessions)
+
+    async def stop(self) -> None:
+        async with self._lock:
+            for pc in self.clients:
+                try:
+                    await pc.client.disconnect()
+                except Exception:
+                    pass
+            self.clients = []
+            self._started = False
+            self._last_attempt = 0.0
+
+    def _pick(self) -> PooledClient:
+        if not self.clients:
+            raise NoClientAvailable(f"no authorized Telethon sessions: {self.errors or self.sessions}")
+        ready = [pc for pc in self.clients if pc.available]
+        if not ready:
+            wait = min(pc.flood_until for pc in self.clients) - time.monotonic()
+            raise NoClientAvailable(f"all sessions in FloodWait, retry in {wait:.0f}s", retry_after=max(wait, 0.0))
+        return min(ready, key=lambda pc: pc.in_flight)
+
+    async def resolve(self, pc: PooledClient, username: str):
+        """InputPeer канала из кэша аккаунта; сеть — только при первом обращении."""
+        key = username.lower()
+        peer = pc.entities.get(key)
+        if peer is None:
+            peer = await pc.client.get_input_entity(username)
+            pc.entities[key] = peer
+        return peer
+
+    async def run(self, fn: Callable[[PooledClient], Awaitable[Any]]) -> Any:
+        """
+        Выполняет fn(pooled_client) на свободном аккаунте.
+        При FloodWait помечает аккаунт и повторяет на другом, пока есть доступные.
+        """
+        if not self._started:
+            await self.start()
+        tried = set()
+        while True:
+            pc = self._pick()
+            if pc.session in tried:
+                raise NoClientAvailable("all available sessions failed with FloodWait")
+            tried.add(pc.session)
+            pc.in_flight += 1
+            try:
+                return await fn(pc)
+            except FloodWaitError as e:
+                pc.flood_until = time.monotonic() + float(getattr(e, "seconds", 0) or 0)
+            finally:
+                pc.in_flight -= 1
+
+
+_pool: Optional[TelethonPool] = None
+
+
+def get_pool(sessions: List[str], api_id: int, api_hash: str) -> TelethonPool:
+    """Общий пул процесса (создаётся один раз; подключение — при первом run или start)."""
+    global _pool
+    if _pool is None:
+        _pool = TelethonPool(sessions, api_id, api_hash)
+    return _pool
+
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+        _pool = None
@@ -0,0 +1,217 @@
+# File: parser_core/deep_scan.py — глубокий потоковый скан истории канала: компактные записи и скользящие агрегаты
+
+from __future__ import annotations
+from typing import Dict, Any, AsyncIterable, AsyncIterator, Awaitable, Callable, List, Optional
+from bisect import bisect_left, insort
+from collections import deque
+import math
+
+# Флаги поста (битовая маска)
+FLAG_FORWARD = 1
+FLAG_MEDIA = 2
+FLAG_REPLY = 4
+FLAG_NO_VIEWS = 8
+
+WEEK = 7 * 24 * 3600
+ROLLING_WINDOW = 200       # постов в скользящем окне (медиана для поиска всплесков)
+SPIKE_RATIO = 3.0          # пост с просмотрами > SPIKE_RATIO × скользящей медианы — всплеск
+DIP_RATIO = 0.3            # и < DIP_RATIO × медианы — провал (часто после окончания накрутки)
+WEEKS_IN_RESULT = 52
+PAGE_SIZE = 100            # iter_messages забирает историю по 100 сообщений за вызов API
+
+
+class PostRecord:
+    """Пост без текста: только числовые поля (~100 байт вместо килобайт на dict с message)."""
+
+    __slots__ = ("id", "ts", "views", "forwards", "reactions", "flags")
+
+    def __init__(self, id: int, ts: int, views: int, forwards: int, reactions: int, flags: int):
+        self.id = id
+        self.ts = ts
+        self.views = views
+        self.forwards = forwards
+        self.reactions = reactions
+        self.flags = flags
+
+
+def compact(msg) -> Optional[PostRecord]:
+    """Telethon Message -> PostRecord (None для служебных сообщений без даты)."""
+    date = getattr(msg, "date", None)
+    if date is None:
+        return None
+    views = getattr(msg, "views", None)
+    flags = 0
+    if getattr(msg, "fwd_from", None):
+        flags |= FLAG_FORWARD
+    if getattr(msg, "media", None):
+        flags |= FLAG_MEDIA
+    if getattr(msg, "reply_to", None):
+        flags |= FLAG_REPLY
+    if views is None:
+        flags |= FLAG_NO_VIEWS
+    reactions = 0
+    results = getattr(getattr(msg, "reactions", None), "results", None)
+    if results:
+        reactions = sum(getattr(r, "count", 0) or 0 for r in results)
+    return PostRecord(int(msg.id), int(date.timestamp()), int(views or 0), int(getattr(msg, "forwards", None) or 0),
+                      reactions, flags)
+
+
+async def records(messages: AsyncIterable[Any]) -> AsyncIterator[PostRecord]:
+    """Поток сообщений -> поток компактных записей; сами сообщения сразу отпускаются."""
+    async for msg in messages:
+        rec = compact(msg)
+        if rec is not None:
+            yield rec
+
+
+async def paced(messages: AsyncIterable[Any], gate: Callable[[], Awaitable[Any]],
+                page_size: int = PAGE_SIZE) -> AsyncIterator[Any]:
+    """Перед запросом каждой следующей страницы истории ждёт gate() — квота расходуется постранично."""
+    n = 0
+    async for msg in messages:
+        yield msg
+        n += 1
+        if n % page_size == 0:
+            await gate()
+
+
+class RollingStats:
+    """
+    Агрегаты по истории в один проход (от новых постов к старым).
+    Память не зависит от числа постов: суммы и моменты, окно из ROLLING_WINDOW просмотров
+    и недельные корзины за последние WEEKS_IN_RESULT недель.
+    """
+
+    def __init__(self, window: int = ROLLING_WINDOW):
+        self.posts = 0
+        self.own = 0
+        self.forwarded = 0
+        self.media = 0
+        self.no_views = 0
+        self.views_sum = 0
+        self.views_sq = 0.0
+        self.views_min: Optional[int] = None
+        self.views_max = 0
+        self.forwards_sum = 0
+        self.reactions_sum = 0
+        self.spikes = 0
+        self.dips = 0
+        self.max_gap = 0
+        self.first_id: Optional[int] = None
+        self.last_id: Optional[int] = None
+        self.newest_ts: Optional[int] = None
+        self.oldest_ts: Optional[int] = None
+        # Скользящее окно просмотров: очередь по порядку и отсортированная копия для медианы
+        self._window: deque = deque()
+        self._sorted: List[int] = []
+        self._window_size = window
+        # неделя (от самого нового поста) -> [постов, просмотров, пересылок, реакций]
+        self.weeks: Dict[int, List[int]] = {}
+
+    def _median(self) -> float:
+        n = len(self._sorted)
+        mid = n // 2
+        return self._sorted[mid] if n % 2 else (self._sorted[mid - 1] + self._sorted[mid]) / 2
+
+    def add(self, rec: PostRecord) -> None:
+        self.posts += 1
+        if self.first_id is None:
+            self.first_id = rec.id
+            self.newest_ts = rec.ts
+        if self.oldest_ts is not None:
+            self.max_gap = max(self.max_gap, self.oldest_ts - rec.ts)
+        self.last_id = rec.id
+        self.oldest_ts = rec.ts
+        if rec.flags & FLAG_MEDIA:
+            self.media += 1
+        if rec.flags & FLAG_FORWARD:
+            self.forwarded += 1
+            return
+        self.own += 1
+        if rec.flags & FLAG_NO_VIEWS:
+            self.no_views += 1
+            return
+
+        v = rec.views
+        self.views_sum += v
+        self.views_sq += v * v
+        self.views_min = v if self.views_min is None else min(self.views_min, v)
+        self.views_max = max(self.views_max, v)
+        self.forwards_sum += rec.forwards
+        self.reactions_sum += rec.reactions
+
+        if len(self._sorted) >= self._window_size // 4:
+            median = self._median()
+            if median > 0:
+                if v > median * SPIKE_RATIO:
+                    self.spikes += 1
+                elif v < median * DIP_RATIO:
+                    self.dips += 1
+        self._window.append(v)
+        insort(self._sorted, v)
+        if len(self._window) > self._window_size:
+            old = self._window.popleft()
+            del self._sorted[bisect_left(self._sorted, old)]
+
+        week = (self.newest_ts - rec.ts) // WEEK
+        if week >= WEEKS_IN_RESULT:
+            return  # более старые недели учитываются только в общих агрегатах
+        bucket = self.weeks.get(week)
+        if bucket is None:
+            bucket = self.weeks[week] = [0, 0, 0, 0]
+        bucket[0] += 1
+        bucket[1] += v
+        bucket[2] += rec.forwards
+        bucket[3] += rec.reactions
+
+    def result(self) -> Dict[str, Any]:
+        counted = self.own - self.no_views
+        if not counted:
+            return {"posts_scanned": self.posts, "missing": True, "reason": "нет постов с просмотрами"}
+        mean = self.views_sum / counted
+        var = max(self.views_sq / counted - mean * mean, 0.0)
+        weekly = [
+            {
+                "week": -w,  # 0 — последняя неделя, -1 — предыдущая и т.д.
+                "posts": b[0],
+                "avg_views": round(b[1] / b[0], 1),
+                "forward_rate_pct": round(b[2] / b[1] * 100, 2) if b[1] else None,
+                "reaction_rate_pct": round(b[3] / b[1] * 100, 2) if b[1] else None,
+            }
+            for w, b in sorted(self.weeks.items())
+        ]
+        days = (self.newest_ts - self.oldest_ts) / 86400 if self.posts > 1 else 0
+        return {
+            "posts_scanned": self.posts,
+            "own_posts": self.own,
+            "forwarded_posts": self.forwarded,
+            "media_share_pct": round(self.media / self.posts * 100, 1),
+            "history_days": round(days, 1),
+            "posts_per_day": round(self.posts / days, 2) if days else None,
+            "max_gap_days": round(self.max_gap / 86400, 1),
+            "views": {
+                "mean": round(mean, 1),
+                "min": self.views_min,
+                "max": self.views_max,
+                "cv": round(math.sqrt(var) / mean, 3) if mean > 0 else None,
+            },
+            "forward_rate_pct": round(self.forwards_sum / self.views_sum * 100, 2) if self.views_sum else None,
+            "reaction_rate_pct": round(self.reactions_sum / self.views_sum * 100, 2) if self.views_sum else None,
+            # Доли постов, резко выбивающихся из скользящей медианы соседних постов
+            "view_spikes_pct": round(self.spikes / counted * 100, 2),
+            "view_dips_pct": round(self.dips / counted * 100, 2),
+            "weekly": weekly,
+            "id_range": [self.last_id, self.first_id],
+        }
+
+
+async def scan(messages: AsyncIterable[Any], stats: Optional[RollingStats] = None,
+               max_posts: Optional[int] = None) -> RollingStats:
+    """Прогоняет поток сообщений через агрегаты. stats можно передать повторно, чтобы продолжить скан."""
+    stats = stats or RollingStats()
+    async for rec in records(messages):
+        stats.add(rec)
+        if max_posts and stats.posts >= max_posts:
+            break
+    return stats
@@ -0,0 +1,241 @@
+# File: parser_core/metrics.py — локальный расчёт метрик TNG (ERR, охват, пересылки, динамика) до отправки в ИИ
+
+from __future__ import annotations
+from typing import Dict, Any, List, Optional
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Пороговые значения из метода TNG (Arhy_prompt_main.txt)
+ERR_HIGH = 25.0
+ERR_LOW = 10.0
+ERR24_LOW = 10.0
+REACH_LOW = 15.0
+VIRAL_FORWARD_PCT = 5.0
+DAILY_JUMP_SMALL_CHANNEL = 200      # прирост за сутки для канала до 10 000
+SMALL_CHANNEL = 10_000
+FLAT_VIEWS_CV = 0.10                # разброс просмотров ниже 10% — "плоские" просмотры
+UNSUBSCRIBE_STREAK_DAYS = 3
+PER_POST_LIMIT = 50                 # сколько значений per-post ERR отдаём в компактный блок
+ERR24_MAX_AGE_H = 72                # для ERR24 берём посты возрастом 24–72 ч: их просмотры близки к суточным
+
+
+def _post_timestamps(dates: List[Any]) -> np.ndarray:
+    """
+    ISO-даты постов -> unix time одним проходом NumPy; NaN, если даты нет или она не разбирается.
+    Telethon отдаёт даты в UTC с целыми секундами, поэтому суффикс смещения ("+00:00") и доли
+    секунды отрезаются приведением к U19 — datetime64 не умеет часовые пояса.
+    """
+    if not dates:
+        return np.empty(0)
+    raw = np.array([d if isinstance(d, str) and d else "NaT" for d in dates], dtype="U19")
+    try:
+        stamps = raw.astype("datetime64[s]")
+    except ValueError:
+        # Редкий случай — нестандартная строка: разбираем по одной, битые даты -> NaT
+        stamps = np.array([_parse_date(d) for d in raw], dtype="datetime64[s]")
+    out = stamps.astype(np.int64).astype(np.float64)
+    out[np.isnat(stamps)] = np.nan
+    return out
+
+
+def _parse_date(date: str) -> np.datetime64:
+    try:
+        return np.datetime64(date, "s")
+    except ValueError:
+        return np.datetime64("NaT", "s")
+
+
+def _post_columns(posts: List[Dict[str, Any]]) -> np.ndarray:
+    """Матрица (N, 4): просмотры, пересылки, реакции, время публикации собственных постов (без репостов); None -> NaN."""
+    nan = np.nan
+    flat: List[float] = []
+    dates: List[Any] = []
+    for p in posts:
+        if p.get("is_forward"):
+            continue
+        v, f, r = p.get("views"), p.get("forwards"), p.get("reactions_total")
+        flat.extend((nan if v is None else v, nan if f is None else f, nan if r is None else r))
+        dates.append(p.get("date"))
+    # fromiter по плоскому списку заметно быстрее np.array по списку кортежей с None
+    cols = np.fromiter(flat, dtype=np.float64, count=len(flat)).reshape(-1, 3)
+    return np.column_stack((cols, _post_timestamps(dates))) if dates else np.empty((0, 4))
+
+
+def _r(v, nd: int = 2) -> Optional[float]:
+    if v is None:
+        return None
+    v = float(v)
+    return None if np.isnan(v) or np.isinf(v) else round(v, nd)
+
+
+def _tgstat_result(tgstat: Dict[str, Any], key: str):
+    block = (tgstat or {}).get(key)
+    if not isinstance(block, dict):
+        return None
+    # TGStat отвечает {"status": "ok", "response": ...}; поддерживаем и вариант с "result"
+    return block.get("response", block.get("result"))
+
+
+def _series(rows, value_fields) -> np.ndarray:
+    """Ряд TGStat [{period, <value>}] -> массив значений в хронологическом порядке."""
+    if not isinstance(rows, list) or not rows:
+        return np.empty(0)
+    rows = sorted((r for r in rows if isinstance(r, dict)), key=lambda r: str(r.get("period", "")))
+    values = []
+    for r in rows:
+        v = next((r[f] for f in value_fields if r.get(f) is not None), None)
+        values.append(np.nan if v is None else v)
+    return np.array(values, dtype=np.float64)
+
+
+def post_metrics(posts: List[Dict[str, Any]], subscribers: Optional[int], now: Optional[float] = None) -> Dict[str, Any]:
+    """Метрики по постам из _message_to_dict: просмотры, ERR и ERR24, пересылки, реакции."""
+    cols = _post_columns(posts)
+    mask = ~np.isnan(cols[:, 0])
+    if not mask.any():
+        return {"missing": True, "reason": "нет постов с просмотрами"}
+
+    cols = cols[mask]
+    v = cols[:, 0]
+    forwards = np.where(np.isnan(cols[:, 1]), 0.0, cols[:, 1])
+    reactions = np.where(np.isnan(cols[:, 2]), 0.0, cols[:, 2])
+    age_h = ((datetime.now(timezone.utc).timestamp() if now is None else now) - cols[:, 3]) / 3600
+    total_views = v.sum()
+    mean = v.mean()
+    p25, median, p75, p90 = np.percentile(v, [25, 50, 75, 90])
+    cv = float(v.std() / mean) if mean > 0 else None
+
+    safe_v = np.where(v > 0, v, np.nan)
+    fwd_ratio = forwards / safe_v * 100
+
+    out: Dict[str, Any] = {
+        "posts_count": int(v.size),
+        "views": {
+            "mean": _r(mean, 1), "median": _r(median, 1),
+            "p25": _r(p25, 1), "p75": _r(p75, 1), "p90": _r(p90, 1),
+            "cv": _r(cv, 3),
+            "iqr_to_median": _r((p75 - p25) / median, 3) if median > 0 else None,
+        },
+        "forward_rate_pct": _r(forwards.sum() / total_views * 100) if total_views > 0 else None,
+        "reaction_rate_pct": _r(reactions.sum() / total_views * 100) if total_views > 0 else None,
+        "viral_posts_share_pct": _r((fwd_ratio > VIRAL_FORWARD_PCT).mean() * 100) if total_views > 0 else None,
+    }
+    if subscribers:
+        err = v / subscribers * 100
+        out["err_pct"] = _r(err.mean())
+        # Охват — медианный пост относительно подписчиков (устойчив к единичным вирусным постам)
+        out["reach_pct"] = _r(median / subscribers * 100)
+        # ERR24: просмотры за первые сутки знает только TGStat; локально — посты, которым уже
+        # исполнилось 24 ч, но не больше ERR24_MAX_AGE_H (NaN в возрасте сравнения не проходят)
+        day_old = (age_h >= 24) & (age_h <= ERR24_MAX_AGE_H)
+        out["err24_pct"] = _r(err[day_old].mean()) if day_old.any() else None
+        out["err_per_post"] = np.round(err[:PER_POST_LIMIT], 1).tolist()
+    return out
+
+
+def growth_metrics(subscribers_series: np.ndarray) -> Dict[str, Any]:
+    """Динамика подписчиков по дневному ряду: дельты за сутки/неделю/месяц, скачки, серии отписок."""
+    s = subscribers_series[~np.isnan(subscribers_series)]
+    if s.size < 2:
+        return {"missing": True, "reason": "нет истории подписчиков"}
+    daily = np.diff(s)
+    last = s[-1]
+
+    def delta(days: int):
+        return _r(last - s[-1 - days], 0) if s.size > days else None
+
+    # Самая длинная серия дней только с отписками
+    neg = (daily < 0).astype(np.int8)
+    if neg.any():
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], neg, [0]))))
+        streak = int((edges[1::2] - edges[::2]).max())
+    else:
+        streak = 0
+
+    jump_threshold = DAILY_JUMP_SMALL_CHANNEL if last < SMALL_CHANNEL else max(DAILY_JUMP_SMALL_CHANNEL, last * 0.02)
+    jumps = np.flatnonzero(daily > jump_threshold)
+    return {
+        "delta_day": delta(1),
+        "delta_week": delta(7),
+        "delta_month": delta(30),
+        "max_daily_gain": _r(daily.max(), 0),
+        "max_daily_loss": _r(daily.min(), 0),
+        "jump_days": int(jumps.size),
+        "jump_threshold": _r(jump_threshold, 0),
+        "max_unsubscribe_streak_days": streak,
+    }
+
+
+def views_dynamics(views_series: np.ndarray) -> Dict[str, Any]:
+    v = views_series[~np.isnan(views_series)]
+    if v.size < 2:
+        return {"missing": True}
+    prev = np.where(v[:-1] > 0, v[:-1], np.nan)
+    ratio = v[1:] / prev
+    return {
+        "days": int(v.size),
+        "max_jump_ratio": _r(np.nanmax(ratio), 2) if np.isfinite(ratio).any() else None,
+        "cv": _r(v.std() / v.mean(), 3) if v.mean() > 0 else None,
+    }
+
+
+def compute_channel_metrics(parser_data: Dict[str, Any], tgstat: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Компактный блок метрик TNG для промпта.
+    Считается детерминированно из постов parser_core и рядов TGStat; поля без данных помечаются missing.
+    """
+    tgstat = tgstat or {}
+    channel = parser_data.get("channel") or {}
+    stat = _tgstat_result(tgstat, "stat") or {}
+    if not isinstance(stat, dict):
+        stat = {}
+    subscribers = channel.get("subscribers") or stat.get("participants_count")
+
+    posts = post_metrics(parser_data.get("posts") or [], subscribers)
+    subs_series = _series(_tgstat_result(tgstat, "subscribers"), ("participants_count", "subscribers"))
+    views_series = _series(_tgstat_result(tgstat, "views"), ("views_count", "views"))
+    # Без TGStat — ряды из собственных снимков parser_core
+    time_series = parser_data.get("time_series") or {}
+    if subs_series.size < 2:
+        subs_series = _series(time_series.get("subscribers_daily"), ("subscribers",))
+    if views_series.size < 2:
+        views_series = _series(time_series.get("views_series"), ("avg_views",))
+    growth = growth_metrics(subs_series)
+
+    err = stat.get("err_percent", posts.get("err_pct"))
+    err24 = stat.get("err24_percent", posts.get("err24_pct"))
+    reach = posts.get("reach_pct")
+    if reach is None and stat.get("avg_post_reach") and subscribers:
+        reach = _r(stat["avg_post_reach"] / subscribers * 100)
+
+    signals: List[str] = []
+    if err is not None and err < ERR_LOW:
+        signals.append("err_low")
+    elif err is not None and err > ERR_HIGH:
+        signals.append("err_high")
+    if err24 is not None and err24 < ERR24_LOW:
+        signals.append("err24_low")
+    if reach is not None and reach < REACH_LOW:
+        signals.append("reach_low")
+    cv = (posts.get("views") or {}).get("cv")
+    if cv is not None and posts.get("posts_count", 0) >= 5 and cv < FLAT_VIEWS_CV:
+        signals.append("flat_views")
+    if (posts.get("forward_rate_pct") or 0) > VIRAL_FORWARD_PCT:
+        signals.append("viral_forwards")
+    if growth.get("jump_days"):
+        signals.append("subscriber_jump")
+    if growth.get("max_unsubscribe_streak_days", 0) >= UNSUBSCRIBE_STREAK_DAYS:
+        signals.append("unsubscribe_streak")
+
+    return {
+        "subscribers": subscribers,
+        "err_pct": _r(err),
+        "err24_pct": _r(err24),
+        "reach_pct": reach,
+        "posts": posts,
+        "growth": growth,
+        "views_dynamics": views_dynamics(views_series),
+        "signals": signals,
+        "computed_at": datetime.now().isoformat(timespec="seconds"),
+    }
@@ -0,0 +1,146 @@
+# File: parser_core/post_store.py — локальное хранилище постов каналов для инкрементальной загрузки
+
+from __future__ import annotations
+from typing import Dict, Any, List, Optional
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    channel TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    date TEXT,
+    views INTEGER,
+    forwards INTEGER,
+    reactions_total INTEGER,
+    is_forward INTEGER,
+    reply_to INTEGER,
+    message TEXT,
+    media INTEGER,
+    refreshed_at TEXT,
+    PRIMARY KEY (channel, id)
+);
+CREATE INDEX IF NOT EXISTS posts_channel_date ON posts (channel, date);
+CREATE TABLE IF NOT EXISTS history_exhausted (
+    channel TEXT PRIMARY KEY,              -- старше сохранённых постов у канала ничего нет
+    marked_at TEXT NOT NULL
+);
+"""
+
+_FIELDS = ("id", "date", "views", "forwards", "reactions_total", "is_forward", "reply_to", "message", "media")
+
+
+class PostStore:
+    """
+    Посты каналов в SQLite (формат _message_to_dict).
+    Позволяет догружать только новые сообщения (min_id) и обновлять счётчики
+    лишь у постов, которые ещё набирают просмотры.
+    """
+
+    def __init__(self, path: str = "posts.db"):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # posts.db общий для процессов-воркеров режима webhook: ждём чужую запись, а не падаем с "database is locked"
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def last_id(self, channel: str) -> int:
+        """Максимальный id сохранённого поста канала (0 — канала ещё нет)."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT MAX(id) FROM posts WHERE channel = ?", (channel.lower(),)
+            ).fetchone()
+        return int(row[0] or 0)
+
+    def upsert(self, channel: str, posts: List[Dict[str, Any]]) -> None:
+        if not posts:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [
+            (channel.lower(), *(p.get(f) for f in _FIELDS), now)
+            for p in posts if p.get("id") is not None
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO posts (channel, id, date, views, forwards, reactions_total, "
+                "is_forward, reply_to, message, media, refreshed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+
+    def update_counters(self, channel: str, posts: List[Dict[str, Any]]) -> None:
+        """Обновляет только просмотры/пересылки/реакции уже сохранённых постов."""
+        if not posts:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [
+            (p.get("views"), p.get("forwards"), p.get("reactions_total"), now, channel.lower(), p["id"])
+            for p in posts if p.get("id") is not None
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE posts SET views = ?, forwards = ?, reactions_total = ?, refreshed_at = ? "
+                "WHERE channel = ? AND id = ?",
+                rows,
+            )
+            conn.execute("COMMIT")
+
+    def engaging_ids(self, channel: str, window_hours: float) -> List[int]:
+        """id постов моложе window_hours — их счётчики ещё растут и требуют обновления."""
+        since = (datetime.now(timezone.utc) - timedelta(hours=window_hours)).isoformat()
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id FROM posts WHERE channel = ? AND date >= ? ORDER BY id DESC",
+                (channel.lower(), since),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def mark_exhausted(self, channel: str) -> None:
+        """Запоминает, что вся история канала уже в хранилище (Telegram отдал меньше, чем просили)."""
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO history_exhausted (channel, marked_at) VALUES (?, ?)",
+                (channel.lower(), datetime.now(timezone.utc).isoformat()),
+            )
+
+    def is_exhausted(self, channel: str) -> bool:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM history_exhausted WHERE channel = ?", (channel.lower(),)
+            ).fetchone()
+        return row is not None
+
+    def recent(self, channel: str, limit: int) -> List[Dict[str, Any]]:
+        """Последние limit постов канала (новые первыми), как из _message_to_dict."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT " + ", ".join(_FIELDS) + " FROM posts WHERE channel = ? ORDER BY id DESC LIMIT ?",
+                (channel.lower(), limit),
+            ).fetchall()
+        out = []
+        for r in rows:
+            p = dict(r)
+            p["is_forward"] = bool(p["is_forward"])
+            p["media"] = bool(p["media"])
+            out.append(p)
+        return out
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,186 @@
+# File: parser_core/snapshots.py — периодические снимки каналов (подписчики, просмотры) и ряды time_series
+
+from __future__ import annotations
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+import asyncio
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Одна запись снимка — 24 байта; файл канала только дописывается
+RECORD_DTYPE = np.dtype([
+    ("ts", "<u4"),           # unix time снимка
+    ("subscribers", "<i8"),
+    ("avg_views", "<f4"),    # средние просмотры последних постов
+    ("posts", "<u2"),        # сколько постов вошло в среднее
+    ("_pad", "<u2"),
+    ("err", "<f4"),          # avg_views / subscribers * 100
+])
+
+_PERIOD_SECONDS = {"day": 86400, "week": 7 * 86400, "month": 30 * 86400}
+_SAFE_NAME = re.compile(r"[^a-z0-9_]")
+
+
+class SnapshotStore:
+    """
+    Колоночное хранилище снимков: по файлу на канал, записи фиксированного размера.
+    Чтение через np.memmap — память не растёт с числом отслеживаемых каналов.
+    """
+
+    def __init__(self, root: str = "snapshots"):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._tracked_path = os.path.join(root, "tracked.txt")
+        self._tracked: Optional[set] = None
+
+    def _path(self, username: str) -> str:
+        name = _SAFE_NAME.sub("", username.lower().lstrip("@"))
+        return os.path.join(self.root, f"{name}.bin")
+
+    def append(self, username: str, subscribers: Optional[int], avg_views: Optional[float],
+               posts: int = 0, ts: Optional[float] = None) -> None:
+        rec = np.zeros(1, dtype=RECORD_DTYPE)
+        rec["ts"] = int(ts or time.time())
+        rec["subscribers"] = subscribers if subscribers is not None else -1
+        rec["avg_views"] = avg_views if avg_views is not None else np.nan
+        rec["posts"] = posts
+        rec["err"] = (avg_views / subscribers * 100) if subscribers and avg_views is not None else np.nan
+        with open(self._path(username), "ab") as f:
+            f.write(rec.tobytes())
+
+    def load(self, username: str) -> np.ndarray:
+        path = self._path(username)
+        if not os.path.exists(path) or os.path.getsize(path) < RECORD_DTYPE.itemsize:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+        return np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+
+    def series(self, username: str, period: str = "day", limit: int = 90) -> List[Dict[str, Any]]:
+        """Последний снимок в каждом интервале (день/неделя/месяц), не больше limit точек."""
+        recs = self.load(username)
+        if recs.size == 0:
+            return []
+        step = _PERIOD_SECONDS[period]
+        buckets = recs["ts"].astype(np.int64) // step
+        # Индекс последней записи каждого интервала (ts монотонно растут — файл только дописывается)
+        last_idx = np.flatnonzero(np.append(buckets[1:] != buckets[:-1], True))[-limit:]
+        out = []
+        for i in last_idx:
+            r = recs[i]
+            subs = int(r["subscribers"])
+            out.append({
+                "period": datetime.fromtimestamp(int(r["ts"]), timezone.utc).date().isoformat(),
+                "subscribers": subs if subs >= 0 else None,
+                "avg_views": None if np.isnan(r["avg_views"]) else round(float(r["avg_views"]), 1),
+                "err": None if np.isnan(r["err"]) else round(float(r["err"]), 2),
+            })
+        return out
+
+    def time_series(self, username: str) -> Dict[str, Any]:
+        """Блок time_series для схемы parser_core — без обращения к API."""
+        daily = self.series(username, "day")
+        return {
+            "subscribers_daily": [{"period": p["period"], "subscribers": p["subscribers"]} for p in daily],
+            "subscribers_weekly": [{"period": p["period"], "subscribers": p["subscribers"]}
+                                   for p in self.series(username, "week", 26)],
+            "subscribers_monthly": [{"period": p["period"], "subscribers": p["subscribers"]}
+                                    for p in self.series(username, "month", 12)],
+            "err_series": [{"period": p["period"], "err": p["err"]} for p in daily],
+            "views_series": [{"period": p["period"], "avg_views": p["avg_views"]} for p in daily],
+        }
+
+    # --- список отслеживаемых каналов ---
+
+    def tracked(self) -> List[str]:
+        try:
+            with open(self._tracked_path, encoding="utf-8") as f:
+                # Дубли (гонка нескольких процессов) схлопываем, порядок сохраняем
+                return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+        except FileNotFoundError:
+            return []
+
+    def track(self, username: str) -> bool:
+        """
+        Добавляет канал в обход планировщика; True, если канал новый.
+        Файл общий для всех процессов бота, поэтому перед дозаписью перечитываем его:
+        кэш процесса лишь отсекает каналы, которые точно уже есть.
+        """
+        username = username.lower()
+        if self._tracked is not None and username in self._tracked:
+            return False
+        self._tracked = set(self.tracked())
+        if username in self._tracked:
+            return False
+        with open(self._tracked_path, "a", encoding="utf-8") as f:
+            f.write(username + "\n")
+        self._tracked.add(username)
+        return True
+
+
+SnapshotFn = Callable[[str], Awaitable[Dict[str, Any]]]
+GateFn = Callable[[], Awaitable[Any]]
+ErrorFn = Callable[[str, str], Any]
+
+
+def _log_failure(username: str, error: str) -> None:
+    logger.warning("snapshot failed for %s: %s", username, error)
+
+
+class SnapshotScheduler:
+    """
+    Фоновый сбор снимков: за каждый интервал обходит все отслеживаемые каналы,
+    равномерно распределяя запросы по интервалу и не превышая max_rps.
+    """
+
+    def __init__(self, store: SnapshotStore, snapshot_fn: SnapshotFn, interval: float = 6 * 3600,
+                 max_rps: float = 0.5, gate: Optional[GateFn] = None, on_error: Optional[ErrorFn] = None):
+        self.store = store
+        self.snapshot_fn = snapshot_fn
+        self.gate = gate
+        # on_error(channel, error) — куда сообщать о неудачных снимках (по умолчанию logging)
+        self.on_error = on_error or _log_failure
+        self.interval = interval
+        self.max_rps = max_rps
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def snapshot(self, username: str) -> None:
+        if self.gate is not None:
+            await self.gate()
+        data = await self.snapshot_fn(username)
+        if data.get("error"):
+            self.on_error(username, str(data["error"]))
+            return
+        await asyncio.to_thread(
+            self.store.append, username, data.get("subscribers"), data.get("avg_views"), data.get("posts", 0))
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            channels = await asyncio.to_thread(self.store.tracked)
+            # Пауза между каналами: интервал делится поровну, но не чаще max_rps
+            gap = max(self.interval / max(len(channels), 1), 1.0 / self.max_rps)
+            for username in channels:
+                try:
+                    await self.snapshot(username)
+                except Exception as e:
+                    self.on_error(username, str(e))
+                    # Все аккаунты во FloodWait — ждём, сколько просит Telegram
+                    await asyncio.sleep(getattr(e, "retry_after", 0) or 0)
+                await asyncio.sleep(gap)
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
@@ -4,6 +4,7 @@ from __future__ import annotations
 from typing import Dict, Any, List
 import os
 import json
+import asyncio
 from datetime import datetime
 
 # Автозагрузка .env при импорте модуля
@@ -19,17 +20,54 @@ except Exception as e:
 
 # Пытаемся импортировать Telethon. Если не установлен — вернём аккуратную ошибку в meta.
 try:
-    from telethon import TelegramClient
     from telethon.tl.functions.channels import GetFullChannelRequest
     TELETHON_OK = True
 except Exception as _e:
     TELETHON_OK = False
     _TELETHON_IMPORT_ERROR = str(_e)
 
+from .client_pool import get_pool, close_pool, PooledClient
+from .snapshots import SnapshotStore, SnapshotScheduler
+from .post_store import PostStore
+from .deep_scan import RollingStats, paced, scan
+
 SESSION_NAME = os.getenv("TELEGRAM_SESSION", "archimetrix_session")
+# Несколько аккаунтов через запятую: запросы распределяются между ними, FloodWait обходится
+SESSION_NAMES = [s.strip() for s in os.getenv("TELEGRAM_SESSIONS", SESSION_NAME).split(",") if s.strip()]
 API_ID = int(os.getenv("API_ID", "0") or 0)
 API_HASH = os.getenv("API_HASH") or ""
 
+# Инкрементальная загрузка постов: сколько отдавать, окно обновления счётчиков, предел догрузки за раз
+POSTS_LIMIT = int(os.getenv("PARSER_POSTS_LIMIT", "30"))
+POST_REFRESH_HOURS = float(os.getenv("POST_REFRESH_HOURS", "72"))
+POSTS_FETCH_MAX = int(os.getenv("POSTS_FETCH_MAX", "1000"))
+POST_STORE_PATH = os.getenv("POST_STORE_PATH", "posts.db")
+# Глубокий скан истории: предел постов за один скан
+DEEP_SCAN_MAX_POSTS = int(os.getenv("DEEP_SCAN_MAX_POSTS", "10000"))
+_post_store: PostStore | None = None
+
+
+def get_post_store() -> PostStore:
+    global _post_store
+    if _post_store is None:
+        _post_store = PostStore(POST_STORE_PATH)
+    return _post_store
+
+# Периодические снимки подписчиков/просмотров для time_series
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", str(6 * 3600)))
+SNAPSHOT_MAX_RPS = float(os.getenv("SNAPSHOT_MAX_RPS", "0.5"))
+SNAPSHOT_POSTS = 10
+_snapshot_store: SnapshotStore | None = None
+_snapshot_scheduler: SnapshotScheduler | None = None
+
+
+def get_snapshot_store() -> SnapshotStore:
+    global _snapshot_store
+    if _snapshot_store is None:
+        _snapshot_store = SnapshotStore(SNAPSHOT_DIR)
+    return _snapshot_store
+
 
 def _normalize_username(link_or_username: str) -> str:
     norm = (link_or_username or "").strip()
@@ -78,7 +116,50 @@ def _message_to_dict(msg) -> Dict[str, Any]:
     }
 
 
-def _collect_with_telethon(username: str, posts_limit: int = 30) -> Dict[str, Any]:
+async def _fetch_posts_incremental(client, entity, username: str, posts_limit: int) -> List[Dict[str, Any]]:
+    """
+    Посты канала через локальное хранилище: из API берём только сообщения новее
+    последнего сохранённого (min_id) и обновляем счётчики постов внутри окна вовлечённости.
+    Старые посты отдаются из хранилища без запросов к Telegram.
+    """
+    store = get_post_store()
+    last_id = await asyncio.to_thread(store.last_id, username)
+
+    if last_id:
+        new_msgs = await client.get_messages(entity, limit=POSTS_FETCH_MAX, min_id=last_id)
+    else:
+        new_msgs = await client.get_messages(entity, limit=posts_limit)
+    await asyncio.to_thread(store.upsert, username, [_message_to_dict(m) for m in new_msgs if m])
+    if not last_id and len(new_msgs) < posts_limit:
+        # Первая загрузка уже вернула всю историю канала
+        await asyncio.to_thread(store.mark_exhausted, username)
+
+    if last_id:
+        new_ids = {m.id for m in new_msgs if m}
+        stale = [i for i in await asyncio.to_thread(store.engaging_ids, username, POST_REFRESH_HOURS)
+                 if i not in new_ids]
+        refreshed: List[Dict[str, Any]] = []
+        # get_messages(ids=...) — не больше 100 id за запрос
+        for i in range(0, len(stale), 100):
+            msgs = await client.get_messages(entity, ids=stale[i:i + 100])
+            refreshed.extend(_message_to_dict(m) for m in msgs if m)
+        await asyncio.to_thread(store.update_counters, username, refreshed)
+
+    posts = await asyncio.to_thread(store.recent, username, posts_limit)
+    if last_id and 0 < len(posts) < posts_limit and not await asyncio.to_thread(store.is_exhausted, username):
+        # Запрошена более глубокая история, чем сохранена: догружаем старые посты. Если Telegram
+        # отдал меньше, чем просили, — история кончилась, и следующие анализы не повторяют запрос
+        wanted = posts_limit - len(posts)
+        older = await client.get_messages(entity, limit=wanted, max_id=posts[-1]["id"])
+        if older:
+            await asyncio.to_thread(store.upsert, username, [_message_to_dict(m) for m in older if m])
+            posts = await asyncio.to_thread(store.recent, username, posts_limit)
+        if len(older) < wanted:
+            await asyncio.to_thread(store.mark_exhausted, username)
+    return posts
+
+
+async def _collect_with_telethon(username: str, posts_limit: int = 30) -> Dict[str, Any]:
     if not TELETHON_OK:
         return {
             "channel": {"username": username},
@@ -111,23 +192,22 @@ def _collect_with_telethon(username: str, posts_limit: int = 30) -> Dict[str, An
             },
         }
 
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    pool = get_pool(SESSION_NAMES, API_ID, API_HASH)
 
-    async def run():
-        # Получаем сущность канала
-        entity = await client.get_entity(username)
+    async def run(pc: PooledClient):
+        client = pc.client
+        # Сущность канала (из кэша аккаунта, если канал уже встречался)
+        entity = await pool.resolve(pc, username)
         # Полная информация о канале (about, participants_count и пр.)
         full = await client(GetFullChannelRequest(channel=entity))
         ch = getattr(full, "chats", [None])[0] if getattr(full, "chats", None) else None
         full_chat = getattr(full, "full_chat", None)
 
-        title = getattr(entity, "title", None) or getattr(ch, "title", None)
+        title = getattr(ch, "title", None)
         about = getattr(full_chat, "about", None)
         participants = getattr(full_chat, "participants_count", None)
 
-        # Последние N сообщений
-        msgs = await client.get_messages(entity, limit=posts_limit)
-        posts: List[Dict[str, Any]] = [_message_to_dict(m) for m in msgs]
+        posts = await _fetch_posts_incremental(client, entity, username, posts_limit)
 
         return {
             "channel": {
@@ -144,12 +224,8 @@ def _collect_with_telethon(username: str, posts_limit: int = 30) -> Dict[str, An
                 # Базовые агрегаты по последним постам — прикинем медианы/средние позже
                 "posts_count_sample": len(posts),
             },
-            "time_series": {
-                # Заполним позже, когда добавим периодические сборы
-                "subscribers_daily": [],
-                "err_series": [],
-                "views_series": [],
-            },
+            # Ряды из локальных снимков (SnapshotScheduler), без живых запросов к API
+            "time_series": await asyncio.to_thread(get_snapshot_store().time_series, username),
             "posts": posts,
             "mentions": [],
             "forwards": [],
@@ -160,14 +236,14 @@ def _collect_with_telethon(username: str, posts_limit: int = 30) -> Dict[str, An
             },
         }
 
-    with client:
-        return client.loop.run_until_complete(run())
+    return await pool.run(run)
 
 
-def collect_channel_data(link_or_username: str) -> Dict[str, Any]:
+async def collect_channel_data(link_or_username: str, posts_limit: int | None = None) -> Dict[str, Any]:
     """
     Единая точка входа парсера: нормализует ввод и собирает данные из Telegram.
     Возвращает словарь в формате, совместимом с Архиметрикс.
+    posts_limit — сколько последних постов вернуть (по умолчанию PARSER_POSTS_LIMIT).
     """
     if not link_or_username:
         raise ValueError("Укажи ссылку на канал или @username")
@@ -175,7 +251,7 @@ def collect_channel_data(link_or_username: str) -> Dict[str, Any]:
     username = _normalize_username(link_or_username)
 
     try:
-        return _collect_with_telethon(username=username, posts_limit=30)
+        return await _collect_with_telethon(username=username, posts_limit=posts_limit or POSTS_LIMIT)
     except Exception as e:
         # Никогда не падаем на весь бот — возвращаем структуру с ошибкой в meta
         return {
@@ -190,5 +266,102 @@ def collect_channel_data(link_or_username: str) -> Dict[str, Any]:
                 "source": "telethon_core",
                 "version": "0.2.0",
                 "error": f"collect failed: {e}",
+                # Все аккаунты во FloodWait: через сколько секунд Telegram снова ответит
+                "retry_after": getattr(e, "retry_after", None),
             },
-        }
\ No newline at end of file
+        }
+
+async def snapshot_channel(username: str) -> Dict[str, Any]:
+    """Лёгкий снимок для планировщика: число подписчиков и средние просмотры последних постов."""
+    if not TELETHON_OK or not API_ID or not API_HASH:
+        return {"error": "Telethon is not configured"}
+    pool = get_pool(SESSION_NAMES, API_ID, API_HASH)
+
+    async def run(pc: PooledClient):
+        entity = await pool.resolve(pc, username)
+        full = await pc.client(GetFullChannelRequest(channel=entity))
+        msgs = await pc.client.get_messages(entity, limit=SNAPSHOT_POSTS)
+        views = [m.views for m in msgs if getattr(m, "views", None) is not None]
+        return {
+            "subscribers": _safe_int(getattr(getattr(full, "full_chat", None), "participants_count", None)),
+            "avg_views": sum(views) / len(views) if views else None,
+            "posts": len(views),
+        }
+
+    return await pool.run(run)
+
+
+async def deep_scan_channel(link_or_username: str, max_posts: int | None = None, gate=None) -> Dict[str, Any]:
+    """
+    Глубокий скан истории через iter_messages: сообщения сразу сворачиваются в компактные записи
+    и скользящие агрегаты (без текста и без хранения постов), поэтому память не растёт с глубиной.
+    При FloodWait пул переключает аккаунт, и скан продолжается с последнего обработанного id.
+    gate — необязательная корутина без аргументов, которую скан ждёт перед каждой страницей,
+    кроме первой (например, общая квота Telegram с фоновым приоритетом).
+    """
+    username = _normalize_username(link_or_username)
+    max_posts = max_posts or DEEP_SCAN_MAX_POSTS
+    meta = {"source": "telethon_deep_scan", "version": "0.1.0", "max_posts": max_posts}
+    if not TELETHON_OK or not API_ID or not API_HASH:
+        return {"channel": username, "meta": {**meta, "error": "Telethon is not configured"}}
+    pool = get_pool(SESSION_NAMES, API_ID, API_HASH)
+    stats = RollingStats()
+
+    async def run(pc: PooledClient):
+        entity = await pool.resolve(pc, username)
+        remaining = max_posts - stats.posts
+        # offset_id: только сообщения старше последнего обработанного (продолжение после смены аккаунта)
+        messages = pc.client.iter_messages(entity, limit=remaining, offset_id=stats.last_id or 0)
+        if gate is not None:
+            if stats.posts:
+                await gate()  # продолжение после смены аккаунта — тоже новая страница
+            messages = paced(messages, gate)
+        await scan(messages, stats, max_posts)
+
+    try:
+        await pool.run(run)
+    except Exception as e:
+        if not stats.posts:
+            return {"channel": username, "meta": {**meta, "error": f"deep scan failed: {e}"}}
+        # Часть истории уже обработана — отдаём её с пометкой
+        meta["partial"] = f"stopped after {stats.posts} posts: {e}"
+    return {"channel": username, "deep_scan": stats.result(), "meta": meta}
+
+
+async def track_channel(link_or_username: str) -> bool:
+    """Добавляет канал в периодический сбор снимков (файловый ввод-вывод — в потоке)."""
+    return await asyncio.to_thread(get_snapshot_store().track, _normalize_username(link_or_username))
+
+
+async def start_snapshots(gate=None, on_error=None) -> None:
+    """
+    Запускает фоновый сбор снимков на текущем event loop.
+    gate — необязательная корутина без аргументов, которую планировщик ждёт перед каждым снимком
+    (например, общая квота Telegram с фоновым приоритетом).
+    on_error(channel, error) — куда сообщать о неудачных снимках; по умолчанию logging.
+    """
+    global _snapshot_scheduler
+    if _snapshot_scheduler is None:
+        _snapshot_scheduler = SnapshotScheduler(
+            get_snapshot_store(), snapshot_channel, interval=SNAPSHOT_INTERVAL, max_rps=SNAPSHOT_MAX_RPS, gate=gate,
+            on_error=on_error)
+        _snapshot_scheduler.start()
+
+
+async def stop_snapshots() -> None:
+    global _snapshot_scheduler
+    if _snapshot_scheduler is not None:
+        await _snapshot_scheduler.stop()
+        _snapshot_scheduler = None
+
+
+async def start_clients() -> None:
+    """Подключает пул Telethon-клиентов заранее (вызывать на event loop бота при старте)."""
+    if TELETHON_OK and API_ID and API_HASH:
+        await get_pool(SESSION_NAMES, API_ID, API_HASH).start()
+
+
+async def stop_clients() -> None:
+    await close_pool()
+    if _post_store is not None:
+        _post_store.close()